@@ -7,10 +7,18 @@ from slicer.util import VTKObservationMixin
 
 from RegularizedFastMarchingLib.Segmentation import *
 from RegularizedFastMarchingLib.Regularization import *
+from RegularizedFastMarchingLib.Cache import *
+from RegularizedFastMarchingLib.Instrumentation import Instrumentation
+from RegularizedFastMarchingLib.Export import *
+from RegularizedFastMarchingLib.Statistics import getLabelStatistics, getVolumeStatistics, getHistogramFraction
+from RegularizedFastMarchingLib.Sweep import sweepSegmentation, getSweepSummary, getSweepVariantName
 
 import numpy as np
 import os.path
 import time
+import tracemalloc
+import threading
+import concurrent.futures
 from csv import reader
 
 #
@@ -149,6 +157,8 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.segmentationsPath = self.globalPath + "Segmentations/"
 
         self.logic = RegularizedFastMarchingLogic()
+        # Intensities statistics of the selected volume, shown in the thresholds tooltips
+        self.volumeStatistics = None
         # self.logic.previousVolumeName = None
         # self.logic.imgLabel = np.array([])
         # self.logic.previousImgIds = np.array([])
@@ -440,6 +450,43 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.maxThresholdSlider.valueChanged.connect(self.setMaxThresholdValue)
         parametersFormLayout.addRow("Max Threshold (digital level)", self.maxThresholdSlider)
 
+        #
+        # Propagation engine
+        #
+        self.engineComboBox = qt.QComboBox()
+        self.engineComboBox.addItem("heap")
+        self.engineComboBox.addItem("compiled")
+        self.engineComboBox.addItem("bucket")
+        self.engineComboBox.addItem("vectorized")
+        self.engineComboBox.addItem("parallel")
+        self.engineComboBox.addItem("tiled")
+        self.engineComboBox.addItem("sweeping")
+        self.engineComboBox.addItem("wavefront")
+        self.engineComboBox.setToolTip("heap: fast marching, each voxel is settled once. compiled: heap engine compiled with numba if installed. "
+            "bucket: compiled engine with a bucket queue, the costs being rounded to 0.01. "
+            "vectorized: frontier relaxed with NumPy array operations. parallel: labels with non overlapping masks propagated on several CPU cores. "
+            "tiled: compiled engine run tile by tile, used for out of core volumes. "
+            "sweeping: fast sweeping, the planes of each axis relaxed in turn without a queue. wavefront: reference iterative propagation")
+        parametersFormLayout.addRow("Propagation engine", self.engineComboBox)
+
+        #
+        # Coarse to fine segmentation
+        #
+        self.pyramidComboBox = qt.QComboBox()
+        self.pyramidComboBox.addItem("Off", 1)
+        self.pyramidComboBox.addItem("2x", 2)
+        self.pyramidComboBox.addItem("4x", 4)
+        self.pyramidComboBox.setToolTip("Segment the volume downsampled by this factor first and display it as a preview, "
+            "then only segment again at full resolution a band around the coarse labels boundaries")
+        parametersFormLayout.addRow("Coarse to fine", self.pyramidComboBox)
+
+        self.pyramidBandWidthSpinBox = qt.QSpinBox()
+        self.pyramidBandWidthSpinBox.setRange(1, 16)
+        self.pyramidBandWidthSpinBox.setValue(1)
+        self.pyramidBandWidthSpinBox.setToolTip("Width in coarse voxels of the band segmented again at full resolution. "
+            "The coarse to fine labels are approximate: a wider band labels more voxels like the full resolution segmentation but takes longer")
+        parametersFormLayout.addRow("Coarse to fine band", self.pyramidBandWidthSpinBox)
+
         #
         # Add vertical spacing
         # 
@@ -459,6 +506,34 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.showBackGroundCheckBox = qt.QCheckBox("")
         self.showBackGroundCheckBox.setChecked(False)
         parametersFormLayout.addRow("Show background", self.showBackGroundCheckBox)
+
+        #
+        # Update the previous segmentation when only the seeds or only the thresholds changed
+        #
+        self.incrementalCheckBox = qt.QCheckBox("")
+        self.incrementalCheckBox.setChecked(True)
+        self.incrementalCheckBox.setToolTip("When only seeds were added, moved or removed, or only the thresholds changed, "
+            "update the previous segmentation instead of computing it again. Only with the heap, compiled and bucket engines "
+            "at full resolution without saving memory, which record the predecessors of the voxels")
+        parametersFormLayout.addRow("Incremental update", self.incrementalCheckBox)
+
+        #
+        # Compact labels and distances types
+        #
+        self.memoryLeanCheckBox = qt.QCheckBox("")
+        self.memoryLeanCheckBox.setChecked(False)
+        self.memoryLeanCheckBox.setToolTip("Store the labels in uint8/uint16 and the distances in float32, and report the peak memory of the run in the Instrumentation table")
+        parametersFormLayout.addRow("Memory lean", self.memoryLeanCheckBox)
+
+        #
+        # Edges costs kept in memory between the runs
+        #
+        self.cacheEdgeCostsCheckBox = qt.QCheckBox("")
+        self.cacheEdgeCostsCheckBox.setChecked(False)
+        self.cacheEdgeCostsCheckBox.setToolTip("Compute the edges costs of the volume once and keep them in memory (24 bytes by voxel) "
+            "for the next runs with other seeds. Only used by the heap and wavefront engines, and by the compiled and bucket engines "
+            "when numba is not installed")
+        parametersFormLayout.addRow("Cache edges costs", self.cacheEdgeCostsCheckBox)
         
         #
         # Add vertical spacing
@@ -473,8 +548,69 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.segmentButton.toolTip = "Run the algorithm."
         self.segmentButton.enabled = False
         parametersFormLayout.addRow(self.segmentButton)
+
+        # The segmentation runs in background, its progress is shown until it is displayed
+        horizontalLayout = qt.QHBoxLayout()
+        self.runProgressBar = qt.QProgressBar()
+        self.runProgressBar.setRange(0, 100)
+        horizontalLayout.addWidget(self.runProgressBar)
+        self.cancelButton = qt.QPushButton("Cancel")
+        self.cancelButton.toolTip = "Cancel the running segmentation."
+        horizontalLayout.addWidget(self.cancelButton)
+        self.runWidget = qt.QWidget()
+        self.runWidget.setLayout(horizontalLayout)
+        self.runWidget.setVisible(False)
+        parametersFormLayout.addRow(self.runWidget)
+        self.runJob = None
+        self.runTimer = qt.QTimer()
+        self.runTimer.setInterval(100)
+        self.runTimer.connect('timeout()', self.onRunTimer)
+
+        # The statistics and the regularization map of the selected volume are computed in background
+        self.prefetchJob = None
+        self.prefetchTimer = qt.QTimer()
+        self.prefetchTimer.setInterval(100)
+        self.prefetchTimer.connect('timeout()', self.onPrefetchTimer)
         #endregion 
 
+        #
+        #region Parameters sweep
+        #
+        sweepCollapsibleButton = ctk.ctkCollapsibleButton()
+        sweepCollapsibleButton.text = "Parameters sweep"
+        sweepCollapsibleButton.collapsed = True
+        self.layout.addWidget(sweepCollapsibleButton)
+        sweepFormLayout = qt.QFormLayout(sweepCollapsibleButton)
+
+        #
+        # Values of each parameter, the Parameters area value being used when a line is empty
+        #
+        self.sweepDistancesLineEdit = qt.QLineEdit()
+        self.sweepDistancesLineEdit.setPlaceholderText("130, 150, 170")
+        self.sweepDistancesLineEdit.setToolTip("Comma separated distances, computed by a single segmentation")
+        sweepFormLayout.addRow("Distances", self.sweepDistancesLineEdit)
+
+        self.sweepMarginsLineEdit = qt.QLineEdit()
+        self.sweepMarginsLineEdit.setPlaceholderText("15, 20")
+        self.sweepMarginsLineEdit.setToolTip("Comma separated masks margins")
+        sweepFormLayout.addRow("Mask margins", self.sweepMarginsLineEdit)
+
+        self.sweepGammasLineEdit = qt.QLineEdit()
+        self.sweepGammasLineEdit.setPlaceholderText("0.015, 0.025")
+        self.sweepGammasLineEdit.setToolTip("Comma separated regularization weights")
+        sweepFormLayout.addRow("Regularization weights", self.sweepGammasLineEdit)
+
+        self.sweepThresholdsLineEdit = qt.QLineEdit()
+        self.sweepThresholdsLineEdit.setPlaceholderText("10-255, 40-255")
+        self.sweepThresholdsLineEdit.setToolTip("Comma separated min-max thresholds")
+        sweepFormLayout.addRow("Thresholds", self.sweepThresholdsLineEdit)
+
+        self.sweepButton = qt.QPushButton("Sweep")
+        self.sweepButton.toolTip = "Segment the volume with each combination of the parameters values and compare the labels maps."
+        self.sweepButton.enabled = False
+        sweepFormLayout.addRow(self.sweepButton)
+        #endregion
+
         #
         #region Load Save segmentations
         #
@@ -504,6 +640,23 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.generateDataCsvCheckBox.setChecked(False)
         parametersFormLayout.addRow("Generate segments data CSV", self.generateDataCsvCheckBox)
 
+        #
+        # Percentiles added to the segments data
+        #
+        self.percentilesLineEdit = qt.QLineEdit()
+        self.percentilesLineEdit.setPlaceholderText("5, 50, 95")
+        self.percentilesLineEdit.setToolTip("Comma separated percentiles of the intensities added to the segments data")
+        parametersFormLayout.addRow("Percentiles", self.percentilesLineEdit)
+
+        #
+        # Compression of the saved images
+        #
+        self.compressionSpinBox = qt.QSpinBox()
+        self.compressionSpinBox.setRange(0, 9)
+        self.compressionSpinBox.setValue(1)
+        self.compressionSpinBox.setToolTip("gzip compression level of the saved images, from 1 (fastest) to 9 (smallest), 0 to save them uncompressed")
+        parametersFormLayout.addRow("Compression level", self.compressionSpinBox)
+
 
         #
         # Name of the segmentation to save
@@ -519,6 +672,15 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.saveSegmentationButton.toolTip = "Save this segmentation with used parameters."
         parametersFormLayout.addRow(self.saveSegmentationButton)   
 
+        # The files are written in background threads, the progress bar counts the written files
+        self.exportProgressBar = qt.QProgressBar()
+        self.exportProgressBar.setVisible(False)
+        parametersFormLayout.addRow(self.exportProgressBar)
+        self.exportFutures = None
+        self.exportTimer = qt.QTimer()
+        self.exportTimer.setInterval(100)
+        self.exportTimer.connect('timeout()', self.onExportTimer)
+
         #
         # Add vertical spacing
         # 
@@ -545,6 +707,25 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.loadSegmentationButton.toolTip = "Load the segmenation from this file."
         parametersFormLayout.addRow(self.loadSegmentationButton)   
         #end region
+
+        #
+        #region Instrumentation
+        #
+        instrumentationCollapsibleButton = ctk.ctkCollapsibleButton()
+        instrumentationCollapsibleButton.text = "Instrumentation"
+        instrumentationCollapsibleButton.collapsed = True
+        self.layout.addWidget(instrumentationCollapsibleButton)
+        instrumentationFormLayout = qt.QFormLayout(instrumentationCollapsibleButton)
+
+        # Stages times and engine counters of the last segmentation
+        self.instrumentationTable = qt.QTableWidget()
+        self.instrumentationTable.setColumnCount(2)
+        self.instrumentationTable.setHorizontalHeaderLabels(["Stage / counter", "Value"])
+        self.instrumentationTable.horizontalHeader().setStretchLastSection(True)
+        self.instrumentationTable.verticalHeader().setVisible(False)
+        self.instrumentationTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        instrumentationFormLayout.addRow(self.instrumentationTable)
+        #endregion
         
 
         #
@@ -556,6 +737,8 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.clearButton.connect('clicked(bool)', self.onClearButton)
         self.clearOrganButton.connect('clicked(bool)', self.onClearOrganButton)
         self.segmentButton.connect('clicked(bool)', self.onSegmentButton)
+        self.sweepButton.connect('clicked(bool)', self.onSweepButton)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
         self.saveSegmentationButton.connect('clicked(bool)', self.onSaveSegmentationButton)
         self.loadSegmentationButton.connect('clicked(bool)', self.onLoadSegmentationButton)
         self.saveMarkersButton.connect('clicked(bool)', self.onSaveMarkersButton)
@@ -585,21 +768,58 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
 
     def onSelect(self):
         self.segmentButton.enabled = self.inputSelector.currentNode()
+        self.sweepButton.enabled = self.segmentButton.enabled
+        # The prefetch of the previous volume is dropped if it did not start, so a segmentation does not wait behind it
+        if self.prefetchJob is not None:
+            self.prefetchJob["future"].cancel()
+            self.prefetchTimer.stop()
+            self.prefetchJob = None
         if self.segmentButton.enabled:
-            self.setMaxThresholdMaximumByVolume(self.inputSelector.currentNode())
-            self.setMinThresholdMaximumByVolume(self.inputSelector.currentNode())
-    
-    def setMaxThresholdMaximumByVolume(self, volume):
-        voxels = slicer.util.arrayFromVolume(volume)
-        maxIntensity = np.amax(voxels)
-        self.maxThresholdSlider.maximum = maxIntensity
-        self.minThresholdSlider.maximum = maxIntensity
-
-    def setMinThresholdMaximumByVolume(self, volume):
-        voxels = slicer.util.arrayFromVolume(volume)
-        minIntensity = np.amin(voxels)
-        self.maxThresholdSlider.minimum = minIntensity
-        self.minThresholdSlider.minimum = minIntensity
+            self.logic.setGlobalPath(self.globalPath)
+            self.prefetchJob = self.logic.startPrefetch(self.inputSelector.currentNode(), int(self.regularizationDiameter.value))
+            if self.prefetchJob is not None:
+                self.onPrefetchTimer()
+                if self.prefetchJob is not None:
+                    self.prefetchTimer.start()
+
+    def onPrefetchTimer(self):
+        """
+        Set the thresholds range once the statistics of the selected volume are computed, report the prefetch errors
+        """
+        job = self.prefetchJob
+        if "statistics" in job and not job.get("statisticsShown"):
+            job["statisticsShown"] = True
+            self.setThresholdsByStatistics(job["statistics"])
+        if not job["future"].done():
+            return
+
+        self.prefetchTimer.stop()
+        self.prefetchJob = None
+        try:
+            job["future"].result()
+        except Exception:
+            logging.exception("Volume prefetch failed")
+
+    def setThresholdsByStatistics(self, statistics):
+        """
+        Set the thresholds sliders range to the volume intensities, their tooltips giving the voxels fraction excluded by the thresholds
+        Inputs:
+          * statistics: the volume statistics, see getVolumeStatistics()
+        """
+        self.volumeStatistics = statistics
+        self.maxThresholdSlider.maximum = statistics["max"]
+        self.minThresholdSlider.maximum = statistics["max"]
+        self.maxThresholdSlider.minimum = statistics["min"]
+        self.minThresholdSlider.minimum = statistics["min"]
+        self.updateThresholdsToolTips()
+
+    def updateThresholdsToolTips(self):
+        if self.volumeStatistics is None:
+            return
+        below = getHistogramFraction(self.volumeStatistics, self.minThresholdSlider.value)
+        above = getHistogramFraction(self.volumeStatistics, self.maxThresholdSlider.value, above=True)
+        self.minThresholdSlider.setToolTip("Seeds cannot spread below this value ({:.1%} of the voxels)".format(below))
+        self.maxThresholdSlider.setToolTip("Seeds cannot spread over this value ({:.1%} of the voxels)".format(above))
 
     # def onLoadBrainVolumeButton(self): 
     #     """
@@ -698,7 +918,7 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
     
 
     def onSaveSegmentationFileChange(self):
-        self.saveSegmentationButton.enabled = self.saveSegmentationName.text != ""
+        self.saveSegmentationButton.enabled = self.saveSegmentationName.text != "" and self.exportFutures is None
                 
 
     def onSaveSegmentationButton(self):
@@ -720,55 +940,75 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
             return
             
         start_time = time.time()
+        segmentationsPath = self.globalPath + "Segmentations/"
+        compression = self.compressionSpinBox.value
+        ijkToRas = vtk.vtkMatrix4x4()
+        inputVolume.GetIJKToRASMatrix(ijkToRas)
+        ijkToLps = slicer.util.arrayFromVTKMatrix(ijkToRas)
+        ijkToLps[0:2, :] *= -1
+        outputVoxels = slicer.util.arrayFromVolume(self.outputVolume)
+
+        # The images are built on the main thread, their files are written by the workers
+        jobs = []
         if self.saveByLabelsCheckBox.isChecked():
-            self.saveSegmentation(inputVolume, segmentationFileName)
+            jobs.append((writeNrrd, segmentationsPath + segmentationFileName, self.getVisibleLabels(outputVoxels), ijkToLps, compression))
         
         if self.saveByIntensitiesCheckBox.isChecked():
             # Create volume keeping only intensities where labels are not equal to 0 or are background
             backgroundLabel = len(self.seedsData)
-            inputVoxels = slicer.util.arrayFromVolume(inputVolume)
-            outputVoxels = slicer.util.arrayFromVolume(self.outputVolume)
-            inputVoxelsFlatten = inputVoxels.ravel()
-            outputVoxelsFlatten = outputVoxels.ravel()
-                     
-            shape = inputVoxels.shape
-            voxelsToSave = np.array( [0 if y == 0 or y == backgroundLabel else x for x, y in zip(inputVoxelsFlatten, outputVoxelsFlatten)], dtype=np.int16 )
+            voxelsToSave = getMaskedIntensities(slicer.util.arrayFromVolume(inputVolume), outputVoxels, [backgroundLabel])
             
             volumesLogic = slicer.modules.volumes.logic()
-            toSaveNode = volumesLogic.CloneVolume(slicer.mrmlScene, inputVolume, self.outputVolume.GetName() + "_intensities")
-            # slicer.util.updateVolumeFromArray(toSaveNode, voxelsToSave)
-            slicer.util.updateVolumeFromArray(toSaveNode, voxelsToSave.reshape(shape))
-            slicer.util.saveNode(toSaveNode, self.globalPath + "Segmentations/intensities_" + segmentationFileName)
+            toSaveNode = volumesLogic.CloneVolumeWithoutImageData(slicer.mrmlScene, inputVolume, self.outputVolume.GetName() + "_intensities")
+            slicer.util.updateVolumeFromArray(toSaveNode, voxelsToSave)
             self.outputVolumeWithIntensities = toSaveNode
+            jobs.append((writeNrrd, segmentationsPath + "intensities_" + segmentationFileName, voxelsToSave, ijkToLps, compression))
 
         if self.generateDataCsvCheckBox.isChecked():
-            segmentationNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLSegmentationNode')
-            masterVolumeNode = inputVolume
-            resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
-
-            import SegmentStatistics
-            segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-            segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationNode.GetID())
-            segStatLogic.getParameterNode().SetParameter("ScalarVolume", masterVolumeNode.GetID())
-            segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled","False")
-            segStatLogic.getParameterNode().SetParameter("ClosedSurfaceSegmentStatisticsPlugin.enabled","False")
-            segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.volume_mm3.enabled","False")
-            segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.volume_cm3.enabled","False")
-            segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.median.enabled","False")
-            segStatLogic.computeStatistics()
-            segStatLogic.exportToTable(resultsTableNode)
-            segStatLogic.showTable(resultsTableNode)
-
-            slicer.util.saveNode(resultsTableNode, csvFile)
-
-        save_time = time.time() - start_time 
-        print("- Save time: %s seconds -" % save_time)
+            percentiles = [float(p) for p in self.percentilesLineEdit.text.replace(" ", "").split(",") if p != ""]
+            header, rows = getLabelStatistics(slicer.util.arrayFromVolume(inputVolume), outputVoxels,
+                [labelColor[0] for labelColor in self.labelColorsList], inputVolume.GetSpacing(), percentiles)
+            self.showStatisticsTable(header, rows)
+            jobs.append((writeCsv, csvFile, header, rows))
+
+        self.exportStartTime = start_time
+        self.exportFutures = startExport(jobs)
+        # The labels file is the first job, it is added to the segmentations combobox once written
+        self.exportLabelsFileName = segmentationFileName if self.saveByLabelsCheckBox.isChecked() else None
+        self.exportProgressBar.setRange(0, len(jobs))
+        self.exportProgressBar.setValue(0)
+        self.exportProgressBar.setVisible(True)
+        self.onSaveSegmentationFileChange()
+        self.exportTimer.start()
 
+    def onExportTimer(self):
+        """
+        Show the export progress, report the written files once they are all written
+        """
+        written = sum(future.done() for future in self.exportFutures)
+        self.exportProgressBar.setValue(written)
+        if written < len(self.exportFutures):
+            return
 
-        # Add new segmentation file to the segmentation's combobox
-        if self.segmentationFilesComboBox.findText(segmentationFileName) == -1:
-            self.segmentationFilesComboBox.addItem(segmentationFileName)
+        self.exportTimer.stop()
+        for f, future in enumerate(self.exportFutures):
+            try:
+                logging.info("Segmentation saved: " + future.result())
+            except Exception as e:
+                logging.exception("Segmentation export failed")
+                slicer.util.errorDisplay("Segmentation export failed: " + str(e))
+                continue
+            # Add new segmentation file to the segmentation's combobox
+            if f == 0 and self.exportLabelsFileName is not None:
+                if self.segmentationFilesComboBox.findText(self.exportLabelsFileName) == -1:
+                    self.segmentationFilesComboBox.addItem(self.exportLabelsFileName)
+        self.exportFutures = None
+        self.exportProgressBar.setVisible(False)
+        self.onSaveSegmentationFileChange()
 
+        self.logic.instrumentation.stages["save"] = time.time() - self.exportStartTime
+        self.logic.instrumentation.log()
+        self.updateInstrumentationTable()
 
     def onLoadSegmentationButton(self):
         """
@@ -801,8 +1041,6 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
 
         If no markups fiducial are on the scene, try to load them from the current seeds path 
         """
-        markupsNode = slicer.mrmlScene.GetFirstNodeByName("MarkupsFiducial")
-
         seedsFileName = self.fileNameSeedsLineEdit.text
         marginMask = int(self.marginMask.value)
         distance = int(self.distance.value)
@@ -810,36 +1048,139 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
         regularizationDiameter = int(self.regularizationDiameter.value)
         minThreshold = int(self.minThresholdSlider.value)
         maxThreshold = int(self.maxThresholdSlider.value)
+        engine = self.engineComboBox.currentText
+        
+        self.markupsList = self.getMarkupsList()
+        if len(self.markupsList) == 0:
+            print("There is no fiducial markups !")
+            return
         
-        self.markupsList = []
+        self.logic.setGlobalPath(self.globalPath)
+        self.logic.setSeedsFileName(seedsFileName)
+        self.logic.setRemoveLastSegmentation(self.removeLastSegmentationCheckBox.isChecked())
+        self.logic.setShowBackGround(self.showBackGroundCheckBox.isChecked())
+        self.logic.setIncremental(self.incrementalCheckBox.isChecked())
+        self.logic.setMemoryLean(self.memoryLeanCheckBox.isChecked())
+        self.logic.setCacheEdgeCosts(self.cacheEdgeCostsCheckBox.isChecked())
+        self.logic.setPyramidFactor(self.pyramidComboBox.currentData)
+        self.logic.setPyramidBandWidth(self.pyramidBandWidthSpinBox.value)
+        # A running segmentation is cancelled by the new one
+        self.runJob = self.logic.startRun(self.inputSelector.currentNode(), self.labelColorsList, self.markupsList,
+            marginMask, distance, gamma, regularizationDiameter, [minThreshold, maxThreshold], engine)
+        if self.runJob is None:
+            return
+        self.runJob["segmentationFileName"] = getSegmentationFileName(seedsFileName, distance, gamma, marginMask, regularizationDiameter)
+        self.runProgressBar.setValue(0)
+        self.runWidget.setVisible(True)
+        self.runTimer.start()
+
+    def getMarkupsList(self):
+        """
+        Return the markups of the scene as [name, point_ras, label] lists, loaded from the current seeds file when there is none
+        """
+        markupsNode = slicer.mrmlScene.GetFirstNodeByName("MarkupsFiducial")
+        markupsList = []
         if markupsNode != None:
             for i in range(markupsNode.GetNumberOfFiducials()):
                 point_ras = [0, 0, 0]
                 markupsNode.GetNthFiducialPosition(i, point_ras)
                 name = markupsNode.GetNthFiducialLabel(i)
                 label = int(markupsNode.GetNthControlPointDescription(i))
-                self.markupsList.append([name, point_ras, label])
+                markupsList.append([name, point_ras, label])
         
-        if len(self.markupsList) == 0:
+        if len(markupsList) == 0:
             fileName = self.seedsPath + self.fileNameSeedsLineEdit.text
-            self.markupsList  = self.loadMarkupsFromSeedFile(fileName)
-        
-        if len(self.markupsList) == 0:
+            markupsList  = self.loadMarkupsFromSeedFile(fileName)
+        return markupsList
+
+    def onSweepButton(self):
+        """
+        Start the segmentation of each combination of the sweep parameters values, the empty values being the Parameters area ones
+        """
+        def getValues(lineEdit, valueType, default):
+            values = [valueType(v) for v in lineEdit.text.replace(" ", "").split(",") if v != ""]
+            return values if values else [default]
+
+        distances = getValues(self.sweepDistancesLineEdit, int, int(self.distance.value))
+        marginMasks = getValues(self.sweepMarginsLineEdit, int, int(self.marginMask.value))
+        gammas = getValues(self.sweepGammasLineEdit, float, float(self.gammaSpinBox.value))
+        thresholds = getValues(self.sweepThresholdsLineEdit, lambda v: [int(t) for t in v.rsplit("-", 1)],
+            [int(self.minThresholdSlider.value), int(self.maxThresholdSlider.value)])
+
+        markupsList = self.getMarkupsList()
+        if len(markupsList) == 0:
             print("There is no fiducial markups !")
             return
-        
+
         self.logic.setGlobalPath(self.globalPath)
-        self.logic.setSeedsFileName(seedsFileName)
-        self.logic.setRemoveLastSegmentation(self.removeLastSegmentationCheckBox.isChecked())
-        self.logic.setShowBackGround(self.showBackGroundCheckBox.isChecked())
-        result = self.logic.run(self.inputSelector.currentNode(), self.labelColorsList, self.markupsList,
-            marginMask, distance, gamma, regularizationDiameter, [minThreshold, maxThreshold])
-
-        if result: # Run succeed
-            # Set the segmentation file UI name with this seeds file name and the used paramaters
-            segmentationFileName = getSegmentationFileName(seedsFileName, distance, gamma, marginMask, regularizationDiameter)
-            self.saveSegmentationName.text = segmentationFileName 
-            self.outputVolume = result
+        self.logic.setMemoryLean(self.memoryLeanCheckBox.isChecked())
+        self.runJob = self.logic.startSweep(self.inputSelector.currentNode(), self.labelColorsList, markupsList,
+            marginMasks, distances, gammas, int(self.regularizationDiameter.value), thresholds, self.engineComboBox.currentText)
+        if self.runJob is None:
+            return
+        self.runProgressBar.setValue(0)
+        self.runWidget.setVisible(True)
+        self.runTimer.start()
+
+    def onRunTimer(self):
+        """
+        Show the progress of the running segmentation, display it once computed
+        """
+        job = self.runJob
+        if job.get("stale"):
+            # Cancelled: the worker may still be ending the job, its result is ignored
+            self.runTimer.stop()
+            self.runWidget.setVisible(False)
+            self.runJob = None
+            self.logic.removePreview()
+            logging.info("Segmentation cancelled")
+            return
+        value, maximum = job["progress"]
+        self.runProgressBar.setFormat(job["stage"] + ": %p%")
+        self.runProgressBar.setValue(int(100 * value / max(maximum, 1)))
+        if "preview" in job and not job.get("previewShown"):
+            self.logic.showPreview(job)
+        if not job["future"].done():
+            return
+
+        self.runTimer.stop()
+        self.runWidget.setVisible(False)
+        self.runJob = None
+        try:
+            if "sweep" in job:
+                header, rows = self.logic.finishSweep(job)
+            else:
+                result = self.logic.finishRun(job)
+        except SegmentationCancelled:
+            logging.info("Segmentation cancelled")
+            return
+        except Exception as e:
+            logging.exception("Segmentation failed")
+            slicer.util.errorDisplay("Segmentation failed: " + str(e))
+            return
+
+        self.updateInstrumentationTable()
+        if "sweep" in job:
+            self.showStatisticsTable(header, rows, "Parameters sweep")
+            return
+
+        # Set the segmentation file UI name with this seeds file name and the used paramaters
+        self.saveSegmentationName.text = job["segmentationFileName"]
+        self.outputVolume = result
+
+    def onCancelButton(self):
+        self.logic.cancelRun()
+
+    def updateInstrumentationTable(self):
+        """
+        Show the stages times and the engine counters of the last segmentation in the instrumentation table
+        """
+        rows = self.logic.instrumentation.getRows()
+        self.instrumentationTable.setRowCount(len(rows))
+        for r in range(len(rows)):
+            for c in range(2):
+                self.instrumentationTable.setItem(r, c, qt.QTableWidgetItem(rows[r][c]))
+        self.instrumentationTable.resizeColumnToContents(0)
             
     def addMarkupcallback(self):
         """
@@ -877,9 +1218,11 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
     
     def setMinThresholdValue(self):
         self.minThresholdSlider.value = min(self.minThresholdSlider.value ,self.maxThresholdSlider.value )
+        self.updateThresholdsToolTips()
 
     def setMaxThresholdValue(self):
         self.maxThresholdSlider.value = max(self.minThresholdSlider.value ,self.maxThresholdSlider.value )
+        self.updateThresholdsToolTips()
 
 
     def setSelectedSeedsFile(self, seedFile):    
@@ -908,63 +1251,64 @@ class RegularizedFastMarchingWidget(ScriptedLoadableModuleWidget, VTKObservation
 
     def loadCSVSeeds(self, csvFilePath):
         """
-        Load and return the labels file from the given path in a list
-        Inputs:
-          * csvFilePath: the labels file
-        Ouputs:
-          * labels: the labels list containing the index, name and color of each label
-        """
-        labels = []
-        with open(csvFilePath) as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='|')
-            for row in reader:
-                labels.append([row[0], row[1], [float(row[2]), float(row[3]), float(row[4]) ]])
-        print(csvFilePath + ": labels loaded")
-        return labels
+        Load and return the labels file from the given path in a list, see Segmentation.loadCSVSeeds()
+        """
+        return loadCSVSeeds(csvFilePath)
     
 
     def loadMarkupsFromSeedFile(self, seedFile):
         """
-        Load and return the markups file from the given path in a list
-        Inputs:
-          * seedFile: the seedFile to load
-        Ouputs:
-          * markups: the markups list containing the name, label and coordinate in RAS (Right, Anterior, Superior) coordinates of each label
+        Load and return the markups file from the given path in a list, see Segmentation.loadMarkupsFromSeedFile()
         """
-        markups = []
-        with open(seedFile, "r") as fp:
-            lines = fp.readlines()
-          
-            for line in lines: 
-                if "#" in line: # comment line
-                    continue
-                tokens = line.replace(" ", "").split(";")
-                name = tokens[0]
-                point_ras = [float(tokens[1]), float(tokens[2]), float(tokens[3])]
-                label= int(tokens[4])
-                markups.append([name, point_ras, label])
-        return markups
+        return loadMarkupsFromSeedFile(seedFile)
 
 
-    def saveSegmentation(self, inputVolume, segmentationFileName):
+    def showStatisticsTable(self, header, rows, name="Segments statistics"):
         """
-        Save this segmentation / labels image in a file named with the given parameters 
+        Show the segments statistics in a new table node
         Inputs:
-          * inputVolume: labels image to save 
+          * header, rows: the columns names and the rows of the statistics, see getLabelStatistics(). The first column holds strings
+          * name: the table node name
+        """
+        resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', name)
+        table = resultsTableNode.GetTable()
+        for c in range(len(header)):
+            column = vtk.vtkStringArray() if c == 0 else vtk.vtkDoubleArray()
+            column.SetName(header[c])
+            column.SetNumberOfTuples(len(rows))
+            for r in range(len(rows)):
+                column.SetValue(r, rows[r][c])
+            table.AddColumn(column)
+        resultsTableNode.Modified()
+
+        layoutManager = slicer.app.layoutManager()
+        layoutManager.setLayout(slicer.modules.tables.logic().GetLayoutWithTable(layoutManager.layout))
+        slicer.app.applicationLogic().GetSelectionNode().SetActiveTableID(resultsTableNode.GetID())
+        slicer.app.applicationLogic().PropagateTableSelection()
+        return resultsTableNode
+
+    def getVisibleLabels(self, labels):
+        """
+        Return a copy of the labels image where the labels of the hidden segments are set to 0
+        Inputs:
+          * labels: the labels image
         """
-        segmentationFileName = self.globalPath + "Segmentations/" + segmentationFileName
         segmentationNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLSegmentationNode')
-        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, labelmapVolumeNode, inputVolume)
-
-        slicer.util.saveNode(labelmapVolumeNode, segmentationFileName)
-        print("Segmentation saved: " + segmentationFileName)
+        hiddenLabels = []
+        for i in range(len(self.labelColorsList)):
+            segmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(self.labelColorsList[i][0])
+            if segmentID and not segmentationNode.GetDisplayNode().GetSegmentVisibility(segmentID):
+                hiddenLabels.append(i + 1)
+        labels = labels.astype(getLabelType(len(self.labelColorsList)))
+        labels[np.isin(labels, hiddenLabels)] = 0
+        return labels
     #endregion
 
     def cleanup(self):
         """
         Called when the application closes and the module widget is destroyed.
         """
+        self.logic.cancelRun()
         self.removeObservers()
 
 
@@ -987,6 +1331,25 @@ class RegularizedFastMarchingLogic(ScriptedLoadableModuleLogic):
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self.incremental = True
+        self.previousRun = None
+        self.imgPred = None
+        self.memoryLean = False
+        self.peakMemory = None
+        self.regularizationCache = None
+        # Edges costs of the last volume, regularization diameter and gamma, kept in memory for the session
+        self.edgeCostsCache = ArrayCache(maxMemoryEntries=1)
+        self.cacheEdgeCosts = False
+        self.volumeKeys = {}
+        self.instrumentation = Instrumentation()
+        # The runs are computed one at a time on a worker thread
+        self.runExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.runningJob = None
+        # Intensities statistics of the volumes, by volume state, see getVolumeModification()
+        self.volumeStatistics = {}
+        self.pyramidFactor = 1
+        self.pyramidBandWidth = 1
+        self.previewNode = None
 
     def isValidInputOutputData(self, inputVolumeNode):
         """Validates if the output is not the same as input
@@ -998,9 +1361,28 @@ class RegularizedFastMarchingLogic(ScriptedLoadableModuleLogic):
 
     def setGlobalPath(self, path):
         """
-        Setter globalPath
+        Setter globalPath, the regularization maps are cached in its Regularizations folder
         """
         self.globalPath = path
+        if self.regularizationCache is None or self.regularizationCache.path != path + "Regularizations/":
+            self.regularizationCache = ArrayCache(path + "Regularizations/")
+
+    def getVolumeModification(self, inputVolume):
+        """
+        Return the volume ID, modification time and spacing, identifying a state of this volume
+        """
+        return (inputVolume.GetID(), inputVolume.GetImageData().GetMTime(), tuple(inputVolume.GetSpacing()))
+
+    def getVolumeKey(self, modification, voxels):
+        """
+        Return the key identifying the content of this volume, hashed again only when the volume was modified
+        Inputs:
+          * modification: the volume state, see getVolumeModification()
+          * voxels: the volume voxels
+        """
+        if modification not in self.volumeKeys:
+            self.volumeKeys[modification] = getVolumeKey(voxels, modification[2])
+        return self.volumeKeys[modification]
 
     def setSeedsFileName(self, fileName):
         """
@@ -1020,27 +1402,43 @@ class RegularizedFastMarchingLogic(ScriptedLoadableModuleLogic):
         """
         self.showBackGround = state
 
+    def setIncremental(self, state):
+        """
+        Setter incremental bool: update the previous segmentation when only the seeds or only the thresholds changed
+        """
+        self.incremental = state
+
+    def setMemoryLean(self, state):
+        """
+        Setter memoryLean bool: use compact labels and distances types and report the peak memory in the instrumentation counters (peakMemoryMB)
+        """
+        self.memoryLean = state
+
+    def setCacheEdgeCosts(self, state):
+        """
+        Setter cacheEdgeCosts bool: keep the edges costs of the volume in memory for the next runs, see usesEdgeCosts()
+        """
+        self.cacheEdgeCosts = state
+        if not state:
+            self.edgeCostsCache = ArrayCache(maxMemoryEntries=1)
+
+    def setPyramidFactor(self, factor):
+        """
+        Setter pyramidFactor int: segment the volume downsampled by this factor first when greater than 1, see segmentPyramid()
+        """
+        self.pyramidFactor = factor
+
+    def setPyramidBandWidth(self, bandWidth):
+        """
+        Setter pyramidBandWidth int: width in coarse voxels of the band segmented again at full resolution, see segmentPyramid()
+        """
+        self.pyramidBandWidth = bandWidth
+
     def getSeedsFromMarkups(self, markupsList, nbLabel):
         """
-        Return a formatted markups list from the given markups list.
-        The background seeds have unique label because there using a unique mask 
-        Inputs:
-          * markupsList: the raw markups list
-          * nbLabel: the number of label to know which seed is a background seed
-        Ouputs: 
-          * seeds: the formatted markups list
-        """
-        seeds = []
-        i = 1
-        backGroundCount = 0
-        for markup in markupsList:
-            label = markup[2]
-            if markup[2] == nbLabel:
-                label += backGroundCount
-                backGroundCount += 1
-            seeds.append({"id": i, "label": label, "pos": markup[1]})
-            i += 1
-        return seeds
+        Return a formatted markups list from the given markups list, see Segmentation.getSeedsFromMarkups()
+        """
+        return getSeedsFromMarkups(markupsList, nbLabel)
    
     def getIJKSeeds(self, inputVolume, seeds):
         """
@@ -1069,65 +1467,320 @@ class RegularizedFastMarchingLogic(ScriptedLoadableModuleLogic):
             seeds[i]["pos"] = point_Ijk
         return seeds   
     
-    def run(self, inputVolume, labelColorsList, markupsList, marginMask, distance, gamma, regularizationDiameter, threshold):
+    def run(self, inputVolume, labelColorsList, markupsList, marginMask, distance, gamma, regularizationDiameter, threshold, engine="heap"):
         """
         Run the segmentation algorithm with the given parameters and get the labels image
         Put the result in inputVolume's clone
         Create and display the segmentation based on this result   
+        The stages times and the engine counters are kept in self.instrumentation
         """        
+        job = self.prepareRun(inputVolume, labelColorsList, markupsList, marginMask, distance, gamma, regularizationDiameter, threshold, engine)
+        if job is None:
+            return False
+        self.computeRun(job)
+        return self.finishRun(job)
+
+    def startRun(self, inputVolume, labelColorsList, markupsList, marginMask, distance, gamma, regularizationDiameter, threshold, engine="heap"):
+        """
+        Same as run() but the segmentation is computed on a worker thread, the running segmentation being cancelled first
+        Outputs:
+          * job: the run, None if the input is not valid. job["future"] is done once the segmentation is computed,
+            finishRun(job) must then be called from the main thread to display it.
+            job["stage"] and job["progress"] ([value, maximum]) give its progress
+        """
+        self.cancelRun()
+        job = self.prepareRun(inputVolume, labelColorsList, markupsList, marginMask, distance, gamma, regularizationDiameter, threshold, engine)
+        if job is None:
+            return None
+
+        self.submitRun(job, self.computeRun)
+        return job
+
+    def startSweep(self, inputVolume, labelColorsList, markupsList, marginMasks, distances, gammas, regularizationDiameter, thresholds,
+        engine="heap"):
+        """
+        Same as startRun() for a parameters sweep, each combination of the given values being segmented, see computeSweep().
+        finishSweep(job) must be called from the main thread once job["future"] is done
+        """
+        self.cancelRun()
+        job = self.prepareRun(inputVolume, labelColorsList, markupsList, marginMasks[0], max(distances), gammas[0], regularizationDiameter,
+            thresholds[0], engine)
+        if job is None:
+            return None
+        job["sweep"] = {"marginMasks": marginMasks, "distances": distances, "gammas": gammas, "thresholds": thresholds}
+        self.submitRun(job, self.computeSweep)
+        return job
+
+    def startPrefetch(self, inputVolume, regularizationDiameter):
+        """
+        Compute in background the intensities statistics of the volume and load or compute its regularization map for the given
+        diameter, so they are ready when the volume is segmented. The prefetch runs on the segmentation worker,
+        a segmentation started meanwhile waits for it then finds the regularization map in the cache
+        Outputs:
+          * job: None if the volume is not valid. job["statistics"] is set once the statistics are computed, see getVolumeStatistics(),
+            job["future"] is done once the regularization map is cached
+        """
+        if not self.isValidInputOutputData(inputVolume) or inputVolume.GetImageData() is None:
+            return None
+        modification = self.getVolumeModification(inputVolume)
+        job = {"inputVolume": inputVolume, "voxels": slicer.util.arrayFromVolume(inputVolume), "volumeModification": modification,
+            "regularizationDiameter": regularizationDiameter, "instrumentation": Instrumentation()}
+        if modification in self.volumeStatistics:
+            job["statistics"] = self.volumeStatistics[modification]
+        job["future"] = self.runExecutor.submit(self.computePrefetch, job)
+        return job
+
+    def computePrefetch(self, job):
+        """
+        Compute the statistics and the regularization map of the prefetch job, see startPrefetch()
+        """
+        if "statistics" not in job:
+            with job["instrumentation"].stage("statistics"):
+                statistics = getVolumeStatistics(job["voxels"])
+            self.volumeStatistics[job["volumeModification"]] = statistics
+            job["statistics"] = statistics
+        self.loadRegularization(job)
+        job["instrumentation"].log()
+
+    def submitRun(self, job, compute):
+        """
+        Compute the job on the worker thread with compute(job, progress), the progress being cancelled by cancelRun()
+        """
+        cancelEvent = threading.Event()
+        def progress(value, maximum):
+            job["progress"] = [int(value), int(maximum)]
+            if cancelEvent.is_set():
+                raise SegmentationCancelled()
+
+        job["cancelEvent"] = cancelEvent
+        job["future"] = self.runExecutor.submit(compute, job, progress)
+        self.runningJob = job
+
+    def cancelRun(self):
+        """
+        Cancel the segmentation running on the worker thread without waiting for it: the job is marked stale so its result
+        is ignored, it stops at its next progress call or is dropped if it did not start. The stages without progress calls
+        (regularization, edges costs) end on the worker before the next job starts
+        """
+        if self.runningJob is None:
+            return
+        self.runningJob["cancelEvent"].set()
+        self.runningJob["stale"] = True
+        self.runningJob["future"].cancel()
+        self.runningJob = None
+
+    def prepareRun(self, inputVolume, labelColorsList, markupsList, marginMask, distance, gamma, regularizationDiameter, threshold, engine):
+        """
+        Read the volume and the seeds from the scene, return the job computed by computeRun() or None if the input is not valid
+        """
         if not self.isValidInputOutputData(inputVolume):
             slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
-            return False
-          
-        volumesLogic = slicer.modules.volumes.logic()
-        clonedVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, inputVolume, "clone")
-        voxels = slicer.util.arrayFromVolume(clonedVolumeNode)
-        tmpVoxels = np.copy(voxels)
-        
-        seeds = self.getSeedsFromMarkups(markupsList, len(labelColorsList))
-        seeds = self.getIJKSeeds(inputVolume, seeds)  
-        
-        start_time = time.time()
-        R = np.copy(tmpVoxels) # Regularization map
-
-        regularizationFile = self.globalPath + "Regularizations/" + inputVolume.GetName() + "_" + str(regularizationDiameter) + ".nii.gz"
-        if os.path.isfile(regularizationFile): # If regularization exists, load this one
-            print("--- Alredy existing regularization")
-            regularizationVolumeNode = slicer.util.loadVolume(regularizationFile)
-            voxels = slicer.util.arrayFromVolume(regularizationVolumeNode)
-            R = np.copy(voxels)
-            slicer.mrmlScene.RemoveNode(regularizationVolumeNode)
-        else: # Else, create a new one
-            print("- Creating new regularization start: ")
-            R = regularization(voxels, int(regularizationDiameter/2))
-            print("- Creating new regularization end")
-            regularizationVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, inputVolume, inputVolume.GetName() + "_regularization_" + str(regularizationDiameter))
-            slicer.util.updateVolumeFromArray(regularizationVolumeNode, R)
-            slicer.util.saveNode(regularizationVolumeNode, regularizationFile)
-
-        regularization_time = time.time() - start_time
-        print("- Regularization time: %s seconds -" % regularization_time)
-
-        # def segmentation(globalPath, volume, voxels, seeds, marginMask, distance, regDiameter):
-        self.imgLabel, self.imgDist = segmentation(inputVolume, tmpVoxels, R, seeds, 
-            len(labelColorsList), marginMask, distance, gamma, regularizationDiameter, threshold)    
-       
-        tmpVoxels[:] = self.imgLabel[:]
-        slicer.util.updateVolumeFromArray(clonedVolumeNode, tmpVoxels)
-        outputVolume = slicer.vtkSlicerVolumesLogic().CloneVolume(slicer.mrmlScene, clonedVolumeNode, inputVolume.GetName() + "_segmentation", True)
+            return None
+
+        # Stages times and engine counters of this run
+        self.instrumentation = Instrumentation()
+
+        # The input voxels are only read: no copy of the volume is needed
+        voxels = slicer.util.arrayFromVolume(inputVolume)
         
-        displaySegmentationMap(clonedVolumeNode, self.imgLabel, labelColorsList, self.removeLastSegmentation, self.showBackGround)
+        with self.instrumentation.stage("seedTransform"):
+            seeds = self.getSeedsFromMarkups(markupsList, len(labelColorsList))
+            seeds = self.getIJKSeeds(inputVolume, seeds)  
         
-        if slicer.mrmlScene:
-            slicer.mrmlScene.RemoveNode(clonedVolumeNode)        
+        # When only the seeds or only the thresholds changed since the previous run, its segmentation is updated instead of computed again
+        runParameters = [inputVolume.GetID(), inputVolume.GetImageData().GetMTime(), len(labelColorsList), marginMask, distance, gamma,
+            regularizationDiameter, engine, self.pyramidFactor, self.pyramidBandWidth]
+
+        return {"inputVolume": inputVolume, "labelColorsList": labelColorsList, "marginMask": marginMask, "distance": distance,
+            "gamma": gamma, "regularizationDiameter": regularizationDiameter, "threshold": threshold, "engine": engine,
+            "pyramidFactor": self.pyramidFactor, "pyramidBandWidth": self.pyramidBandWidth,
+            "voxels": voxels, "imageSpacing": tuple(inputVolume.GetSpacing()), "seeds": seeds, "runParameters": runParameters, "volumeModification": self.getVolumeModification(inputVolume),
+            "instrumentation": self.instrumentation, "stage": "Regularization", "progress": [0, 1]}
+
+    def computeRun(self, job, progress=None):
+        """
+        Compute the regularization map and the labels images of the job, without accessing the scene so it can run on a worker thread
+        Inputs:
+          * job: the run, see prepareRun()
+          * progress: optional progress callback, see propagate(). When it raises SegmentationCancelled,
+            the next run is computed from scratch because the labels images may be partially updated
+        """
+        voxels, seeds, nbLabel = job["voxels"], job["seeds"], len(job["labelColorsList"])
+        instrumentation = job["instrumentation"]
+        stats = instrumentation.counters
+        # The coarse to fine distances are approximate and the voxels out of its band are locked, so they are never updated
+        sameParameters = (self.incremental and job["pyramidFactor"] == 1 and self.previousRun is not None
+            and self.previousRun["parameters"] == job["runParameters"])
+        # The seeds update needs the predecessors to clear the paths relayed by the voxels taken by another label
+        updatePreviousRun = (sameParameters and self.previousRun["threshold"] == list(job["threshold"])
+            and self.previousRun["predecessors"] is not None)
+        # With the same seeds, the previous segmentation is updated from its predecessors when the thresholds changed
+        updateThreshold = (sameParameters and not updatePreviousRun and self.previousRun["predecessors"] is not None
+            and getSeedsByLabel(seeds) == getSeedsByLabel(self.previousRun["seeds"]))
+        if self.memoryLean:
+            tracemalloc.start()
+
+        try:
+            R, regularizationKey = self.loadRegularization(job, self.previousRun["R"] if updatePreviousRun or updateThreshold else None)
+
+            # Edges costs, cached by the volume content, the diameter and gamma so the runs with other seeds only add them.
+            # They take 6 floats by voxel for the whole volume, so they are only cached on demand for the engines computing
+            # the costs in Python, and not when saving memory
+            edgeCosts = None
+            if self.cacheEdgeCosts and not self.memoryLean and usesEdgeCosts(job["engine"]):
+                edgeCostsKey = regularizationKey + "_" + repr(float(job["gamma"]))
+                edgeCosts = self.edgeCostsCache.get(edgeCostsKey)
+                if edgeCosts is None:
+                    with instrumentation.stage("edgeCostsCompute"):
+                        edgeCosts = getEdgeCosts(voxels, R, job["gamma"], job["imageSpacing"])
+                        self.edgeCostsCache.put(edgeCostsKey, edgeCosts)
+            if progress is not None:
+                progress(0, voxels.size)
+
+            job["stage"] = "Propagation"
+            with instrumentation.stage("propagation"):
+                if updateThreshold:
+                    self.imgLabel, self.imgDist = updateSegmentationThreshold(voxels, job["imageSpacing"], R, seeds, nbLabel,
+                        job["marginMask"], job["distance"], job["gamma"], job["threshold"], self.previousRun["threshold"], self.imgLabelRaw,
+                        self.imgDist, self.imgPred, engine=job["engine"], stats=stats, progress=progress, edgeCosts=edgeCosts)
+                elif updatePreviousRun:
+                    self.imgLabel, self.imgDist = updateSegmentation(voxels, job["imageSpacing"], R, seeds, self.previousRun["seeds"],
+                        nbLabel, job["marginMask"], job["distance"], job["gamma"], job["threshold"], self.imgLabelRaw, self.imgDist,
+                        engine=job["engine"], stats=stats, progress=progress, edgeCosts=edgeCosts, imgPred=self.imgPred)
+                else:
+                    # Labels before merging the background seeds labels, needed by the next update
+                    labelType = getLabelType(max([seed.get("label") for seed in seeds] + [nbLabel])) if self.memoryLean else int
+                    self.imgLabelRaw = np.zeros(voxels.shape, dtype=labelType)
+                    # Predecessors of the voxels (one byte by voxel), needed by the next thresholds update
+                    self.imgPred = None
+                    if job["engine"] in predecessorEngines and job["pyramidFactor"] == 1 and not self.memoryLean:
+                        self.imgPred = np.full(voxels.shape, -1, dtype=np.int8)
+                    def preview(labels):
+                        job["stage"] = "Refinement"
+                        job["preview"] = labels
+                    self.imgLabel, self.imgDist = segmentVoxels(voxels, job["imageSpacing"], seeds,
+                        nbLabel, job["marginMask"], job["distance"], job["gamma"], job["regularizationDiameter"], job["threshold"],
+                        R=R, imgLabel=self.imgLabelRaw, engine=job["engine"], compact=self.memoryLean, stats=stats, progress=progress,
+                        pyramidFactor=job["pyramidFactor"], preview=preview, edgeCosts=edgeCosts, imgPred=self.imgPred,
+                        pyramidBandWidth=job["pyramidBandWidth"])    
+        except BaseException:
+            self.previousRun = None
+            raise
+        finally:
+            if self.memoryLean:
+                _, self.peakMemory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                stats["peakMemoryMB"] = self.peakMemory / 1e6
+        self.previousRun = {"parameters": job["runParameters"], "threshold": list(job["threshold"]), "seeds": seeds, "R": R,
+            "predecessors": self.imgPred}
+        stats["incremental"] = updatePreviousRun or updateThreshold
+
+    def loadRegularization(self, job, R=None):
+        """
+        Return the regularization map of the job volume and its cache key, R being loaded from the cache or computed and cached
+        when it is not given
+        """
+        voxels, instrumentation = job["voxels"], job["instrumentation"]
+        # Regularization map, cached by the volume content and the diameter
+        with instrumentation.stage("regularizationLoad"):
+            regularizationKey = self.getVolumeKey(job["volumeModification"], voxels) + "_" + str(job["regularizationDiameter"])
+            if R is None:
+                R = self.regularizationCache.get(regularizationKey)
+        if R is None:
+            with instrumentation.stage("regularizationCompute"):
+                R = regularization(voxels, int(job["regularizationDiameter"]/2), workers=os.cpu_count())
+                self.regularizationCache.put(regularizationKey, R)
+        return R, regularizationKey
+
+    def computeSweep(self, job, progress=None):
+        """
+        Compute the labels images of each variant of the sweep job, sharing its regularization map, see sweepSegmentation().
+        The previous run is kept for the next incremental update
+        """
+        sweep = job["sweep"]
+        instrumentation = job["instrumentation"]
+        R, _ = self.loadRegularization(job)
+        if progress is not None:
+            progress(0, job["voxels"].size)
+
+        job["stage"] = "Sweep"
+        with instrumentation.stage("sweep"):
+            job["labels"], job["parameters"] = sweepSegmentation(job["voxels"], job["imageSpacing"], job["seeds"],
+                len(job["labelColorsList"]), sweep["marginMasks"], sweep["distances"], sweep["gammas"], job["regularizationDiameter"],
+                sweep["thresholds"], R=R, engine=job["engine"], stats=instrumentation.counters, progress=progress,
+                shareEdgeCosts=not self.memoryLean and usesEdgeCosts(job["engine"]))
+
+    def finishSweep(self, job):
+        """
+        Display the labels of each variant of the sweep job as a labelmap node, raise the exception of its computation if it failed
+        Outputs:
+          * header, rows: the table comparing the variants, see getSweepSummary()
+        """
+        if self.runningJob is job:
+            self.runningJob = None
+        job["future"].result()
+
+        with job["instrumentation"].stage("display"):
+            displaySweep(job["inputVolume"], job["labels"], job["parameters"], job["labelColorsList"])
+            header, rows = getSweepSummary(job["labels"], job["parameters"], [labelColor[0] for labelColor in job["labelColorsList"]])
+        job["instrumentation"].log()
+        return header, rows
+
+    def finishRun(self, job):
+        """
+        Display the segmentation computed for the job, raise the exception of its computation if it failed or was cancelled
+        Outputs:
+          * outputVolume: the labels volume
+        """
+        if self.runningJob is job:
+            self.runningJob = None
+        self.removePreview()
+        if "future" in job:
+            job["future"].result()
+
+        inputVolume = job["inputVolume"]
+        with job["instrumentation"].stage("display"):
+            volumesLogic = slicer.modules.volumes.logic()
+            clonedVolumeNode = volumesLogic.CloneVolumeWithoutImageData(slicer.mrmlScene, inputVolume, "clone")
+            slicer.util.updateVolumeFromArray(clonedVolumeNode, self.imgLabel)
+            outputVolume = slicer.vtkSlicerVolumesLogic().CloneVolume(slicer.mrmlScene, clonedVolumeNode, inputVolume.GetName() + "_segmentation", True)
+            
+            displaySegmentationMap(clonedVolumeNode, self.imgLabel, job["labelColorsList"], self.removeLastSegmentation, self.showBackGround)
+            
+            if slicer.mrmlScene:
+                slicer.mrmlScene.RemoveNode(clonedVolumeNode)        
+        job["instrumentation"].log()
       
         slicer.util.setSliceViewerLayers(background=inputVolume)
         return outputVolume
 
+    def showPreview(self, job):
+        """
+        Display the coarse labels of a coarse to fine segmentation as a labelmap over the input volume, until the segmentation is finished
+        """
+        job["previewShown"] = True
+        if self.previewNode is None:
+            self.previewNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", job["inputVolume"].GetName() + "_preview")
+            self.previewNode.CopyOrientation(job["inputVolume"])
+            self.previewNode.CreateDefaultDisplayNodes()
+        labels = job["preview"]
+        slicer.util.updateVolumeFromArray(self.previewNode, labels.astype(getLabelType(len(job["labelColorsList"])), copy=False))
+        slicer.util.setSliceViewerLayers(background=job["inputVolume"], label=self.previewNode, labelOpacity=0.5)
+
+    def removePreview(self):
+        """
+        Remove the coarse labels preview from the scene
+        """
+        if self.previewNode is not None:
+            if slicer.mrmlScene:
+                slicer.mrmlScene.RemoveNode(self.previewNode)
+            self.previewNode = None
+
 
 def displaySegmentationMap(inputVolume, segmentationMap, labelColorsList, removeLastSegmentation, showBackGround):
     """
-    Create a segmentation like using the segment editor's tool, create a segment for each different label in the segmentation image
+    Create a segmentation with a segment for each different label in the segmentation image.
+    The labels image is imported in a single pass, whatever the number of labels
     """    
     # Remove last segmentation, including 3D representation
     if removeLastSegmentation:
@@ -1141,29 +1794,63 @@ def displaySegmentationMap(inputVolume, segmentationMap, labelColorsList, remove
     
     segmentationNode.RemoveClosedSurfaceRepresentation()
 
-    # Create segment editor to get access to effects
-    segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-    segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-    segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-    segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-    segmentEditorWidget.setSegmentationNode(segmentationNode)
-    segmentEditorWidget.setMasterVolumeNode(inputVolume)
-    
-    for i in range(len(labelColorsList)):
-        addedSegmentID = segmentationNode.GetSegmentation().AddEmptySegment(labelColorsList[i][0])
-        segmentationNode.GetSegmentation().GetSegment(addedSegmentID).SetColor(labelColorsList[i][1])
-        segmentEditorWidget.setCurrentSegmentID(addedSegmentID)
-    
-        # Thresholding
-        segmentEditorWidget.setActiveEffectByName("Threshold")
-        effect = segmentEditorWidget.activeEffect()
-        thresh = i+1
-        effect.setParameter("MinimumThreshold", str(clip(thresh, 0, 255)))
-        effect.setParameter("MaximumThreshold", str(clip(thresh, 0, 255)))
-        effect.self().onApply()
+    colorTableNode = createLabelsColorTable(labelColorsList)
+
+    # Import all the labels at once from a temporary labelmap node
+    labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    labelmapNode.CopyOrientation(inputVolume)
+    slicer.util.updateVolumeFromArray(labelmapNode, segmentationMap.astype(getLabelType(len(labelColorsList)), copy=False))
+    labelmapNode.CreateDefaultDisplayNodes()
+    labelmapNode.GetDisplayNode().SetAndObserveColorNodeID(colorTableNode.GetID())
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+    slicer.mrmlScene.RemoveNode(colorTableNode)
 
-        if (not showBackGround) and (i == len(labelColorsList) - 1):
-            segmentationNode.GetDisplayNode().SetSegmentVisibility (addedSegmentID, False)
+    if not showBackGround:
+        backgroundSegmentID = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(labelColorsList[-1][0])
+        if backgroundSegmentID:
+            segmentationNode.GetDisplayNode().SetSegmentVisibility(backgroundSegmentID, False)
 
     # print 3D representation
-    segmentationNode.CreateClosedSurfaceRepresentation()
\ No newline at end of file
+    segmentationNode.CreateClosedSurfaceRepresentation()
+
+
+def createLabelsColorTable(labelColorsList, name=""):
+    """
+    Return a new color table node naming and coloring each label, 0 being the unlabelled voxels
+    """
+    colorTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLColorTableNode", name)
+    colorTableNode.SetTypeToUser()
+    colorTableNode.SetNumberOfColors(len(labelColorsList) + 1)
+    colorTableNode.SetColor(0, "Background", 0, 0, 0, 0)
+    for i in range(len(labelColorsList)):
+        color = labelColorsList[i][1]
+        colorTableNode.SetColor(i + 1, labelColorsList[i][0], color[0], color[1], color[2], 1)
+    return colorTableNode
+
+
+def displaySweep(inputVolume, labels, parameters, labelColorsList):
+    """
+    Add a labelmap node for each variant of a sweep, grouped in a subject hierarchy folder, and show the first one over the input volume
+    Inputs:
+      * labels, parameters: the sweep results, see sweepSegmentation()
+    Outputs:
+      * labelmapNodes: the labelmap node of each variant
+    """
+    name = inputVolume.GetName() + "_sweep"
+    colorTableNode = createLabelsColorTable(labelColorsList, name + "_colors")
+    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+    folderItem = shNode.CreateFolderItem(shNode.GetSceneItemID(), name)
+
+    labelmapNodes = []
+    for variantLabels, variantParameters in zip(labels, parameters):
+        labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", name + "_" + getSweepVariantName(variantParameters))
+        labelmapNode.CopyOrientation(inputVolume)
+        slicer.util.updateVolumeFromArray(labelmapNode, variantLabels)
+        labelmapNode.CreateDefaultDisplayNodes()
+        labelmapNode.GetDisplayNode().SetAndObserveColorNodeID(colorTableNode.GetID())
+        shNode.SetItemParent(shNode.GetItemByDataNode(labelmapNode), folderItem)
+        labelmapNodes.append(labelmapNode)
+
+    slicer.util.setSliceViewerLayers(background=inputVolume, label=labelmapNodes[0], labelOpacity=0.5)
+    return labelmapNodes
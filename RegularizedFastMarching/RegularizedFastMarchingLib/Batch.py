@@ -0,0 +1,219 @@
+"""
+Segmentation of volumes files without Slicer.
+Usage, from the RegularizedFastMarching folder (with PythonSlicer or any Python having numpy, scipy and SimpleITK):
+    python -m RegularizedFastMarchingLib.Batch --labels Resources/SegmentationFastMarching/SeedsLabels/labels.csv volume.nrrd seeds.seed output.seg.nrrd
+    python -m RegularizedFastMarchingLib.Batch --labels Resources/SegmentationFastMarching/SeedsLabels/labels.csv --cases cases.csv --workers 8
+With --engine tiled, a raw encoded NRRD volume is segmented out of core, see segmentCaseTiled()
+"""
+import numpy as np
+import os.path
+import csv
+import json
+import logging
+import argparse
+import concurrent.futures
+
+from RegularizedFastMarchingLib.Segmentation import getSeedsFromMarkups, segmentVoxels, getLabelType, loadCSVSeeds, loadMarkupsFromSeedFile
+from RegularizedFastMarchingLib.Regularization import regularization
+from RegularizedFastMarchingLib.Instrumentation import Instrumentation
+from RegularizedFastMarchingLib.TiledPropagation import memmapNrrd, regularizationTiled, segmentTiled, getRangeTiled, getTiles
+from RegularizedFastMarchingLib.Export import writeNrrd
+
+
+def getIJKSeedsFromImage(image, seeds):
+    """
+    Return the given seeds list where each seed is transform from RAS coordinates to the [k, j, i] voxels array coordinates,
+    using the image header
+    Inputs:
+      * image: SimpleITK image giving the transform, its physical space is LPS (Left, Posterior, Superior)
+      * seeds: list containing all the seeds in RAS coordinates
+    Outputs:
+      * seeds: list containing all the seeds in IJK coordinates
+    """
+    size = image.GetSize()
+    for seed in seeds:
+        point_ras = seed.get("pos")
+        point_Ijk = image.TransformPhysicalPointToContinuousIndex([-point_ras[0], -point_ras[1], point_ras[2]])
+        point_Ijk = [int(round(c)) for c in point_Ijk]
+        if any(c < 0 or c >= s for c, s in zip(point_Ijk, size)):
+            raise ValueError("Seed " + str(seed.get("id")) + " is outside the volume: " + str(point_ras))
+        seed["pos"] = [point_Ijk[2], point_Ijk[1], point_Ijk[0]]
+    return seeds
+
+
+def getIJKToLPSMatrix(image):
+    """
+    Return the 4x4 matrix transforming the (i, j, k) indices of a SimpleITK image to its LPS (Left, Posterior, Superior) coordinates
+    """
+    ijkToLps = np.eye(4)
+    ijkToLps[:3, :3] = np.array(image.GetDirection()).reshape(3, 3) * np.array(image.GetSpacing())
+    ijkToLps[:3, 3] = image.GetOrigin()
+    return ijkToLps
+
+
+def getIJKSeedsFromMatrix(ijkToLps, shape, seeds):
+    """
+    Same as getIJKSeedsFromImage() with the image geometry given by its IJK to LPS matrix and its [k, j, i] shape
+    """
+    lpsToIjk = np.linalg.inv(ijkToLps)
+    for seed in seeds:
+        point_ras = seed.get("pos")
+        point_Ijk = lpsToIjk.dot([-point_ras[0], -point_ras[1], point_ras[2], 1])[:3]
+        point_Ijk = [int(round(c)) for c in point_Ijk]
+        if any(c < 0 or c >= s for c, s in zip(point_Ijk, shape[::-1])):
+            raise ValueError("Seed " + str(seed.get("id")) + " is outside the volume: " + str(point_ras))
+        seed["pos"] = [point_Ijk[2], point_Ijk[1], point_Ijk[0]]
+    return seeds
+
+
+def segmentCase(volumeFile, seedsFile, outputFile, labelsFile, marginMask, distance, gamma, regularizationDiameter,
+    threshold=None, engine="compiled", keepBackground=False):
+    """
+    Segment a volume file with the seeds of a .seed file and write the labels image
+    Inputs:
+      * volumeFile, seedsFile, outputFile: the volume (NRRD, NIfTI...), seeds and labels image files
+      * labelsFile: the labels csv file, its last label is the background
+      * threshold: [min, max] intensities the propagation is restricted to, the whole volume range by default
+      * keepBackground: write the background label, set to 0 otherwise like the segmentations saved by the module
+    Outputs:
+      * outputFile, the stages times and engine counters, see Instrumentation.asDict()
+    """
+    import SimpleITK as sitk
+
+    if engine == "tiled":
+        return segmentCaseTiled(volumeFile, seedsFile, outputFile, labelsFile, marginMask, distance, gamma, regularizationDiameter,
+            threshold, keepBackground)
+
+    instrumentation = Instrumentation()
+    with instrumentation.stage("read"):
+        nbLabel = len(loadCSVSeeds(labelsFile))
+        image = sitk.ReadImage(volumeFile)
+        voxels = sitk.GetArrayViewFromImage(image)
+    with instrumentation.stage("seedTransform"):
+        seeds = getIJKSeedsFromImage(image, getSeedsFromMarkups(loadMarkupsFromSeedFile(seedsFile), nbLabel))
+    if threshold is None:
+        threshold = [voxels.min(), voxels.max()]
+
+    with instrumentation.stage("regularizationCompute"):
+        R = regularization(voxels, int(regularizationDiameter/2))
+    with instrumentation.stage("propagation"):
+        imgLabel, _ = segmentVoxels(voxels, image.GetSpacing(), seeds, nbLabel, marginMask, distance, gamma,
+            regularizationDiameter, threshold, R=R, engine=engine, stats=instrumentation.counters, compact=True)
+    if not keepBackground:
+        imgLabel[imgLabel == nbLabel] = 0
+
+    with instrumentation.stage("save"):
+        segmentationImage = sitk.GetImageFromArray(imgLabel.astype(getLabelType(nbLabel), copy=False))
+        segmentationImage.CopyInformation(image)
+        sitk.WriteImage(segmentationImage, outputFile, True)
+    return outputFile, instrumentation.asDict()
+
+
+def segmentCaseTiled(volumeFile, seedsFile, outputFile, labelsFile, marginMask, distance, gamma, regularizationDiameter,
+    threshold=None, keepBackground=False):
+    """
+    Out of core segmentCase(): a raw encoded NRRD volume is read as a memory map (the other volumes are loaded with SimpleITK),
+    the regularization map, labels and distances images are memory mapped files of a temporary folder next to the output file,
+    and a NRRD output file is written by chunks, so the memory used does not depend on the volume size
+    """
+    import tempfile
+
+    instrumentation = Instrumentation()
+    with instrumentation.stage("read"):
+        nbLabel = len(loadCSVSeeds(labelsFile))
+        try:
+            voxels, ijkToLps = memmapNrrd(volumeFile)
+        except (ValueError, KeyError):
+            import SimpleITK as sitk
+            image = sitk.ReadImage(volumeFile)
+            voxels, ijkToLps = sitk.GetArrayViewFromImage(image), getIJKToLPSMatrix(image)
+    with instrumentation.stage("seedTransform"):
+        seeds = getIJKSeedsFromMatrix(ijkToLps, voxels.shape, getSeedsFromMarkups(loadMarkupsFromSeedFile(seedsFile), nbLabel))
+    if threshold is None:
+        threshold = getRangeTiled(voxels)
+    spacing = np.linalg.norm(ijkToLps[:3, :3], axis=0)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(outputFile))) as folder:
+        with instrumentation.stage("regularizationCompute"):
+            R = regularizationTiled(voxels, int(regularizationDiameter/2), folder)
+        with instrumentation.stage("propagation"):
+            imgLabel, imgDist = segmentTiled(voxels, spacing, seeds, nbLabel, marginMask, distance, gamma, regularizationDiameter,
+                threshold, folder, R=R, stats=instrumentation.counters)
+        if not keepBackground:
+            for tile in getTiles(imgLabel.shape):
+                labels = imgLabel[tile]
+                labels[labels == nbLabel] = 0
+
+        with instrumentation.stage("save"):
+            if outputFile.endswith(".nrrd"):
+                writeNrrd(outputFile, imgLabel, ijkToLps)
+            else:
+                import SimpleITK as sitk
+                segmentationImage = sitk.GetImageFromArray(np.asarray(imgLabel))
+                segmentationImage.SetSpacing(spacing.tolist())
+                segmentationImage.SetOrigin(ijkToLps[:3, 3].tolist())
+                segmentationImage.SetDirection((ijkToLps[:3, :3] / spacing).ravel().tolist())
+                sitk.WriteImage(segmentationImage, outputFile, True)
+        # The memory maps are closed before their folder is removed
+        del R, imgLabel, imgDist
+    return outputFile, instrumentation.asDict()
+
+
+def loadCases(casesFile):
+    """
+    Load the cases of a csv file, each line holding a volume file, a seeds file and an output file.
+    The relative paths are relative to the cases file folder
+    """
+    folder = os.path.dirname(os.path.abspath(casesFile))
+    cases = []
+    with open(casesFile) as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) == 0 or row[0].startswith("#"):
+                continue
+            cases.append([os.path.join(folder, f.strip()) for f in row[:3]])
+    return cases
+
+
+def main(argv=None):
+    """
+    Command line entry point, the cases are segmented in parallel on a process pool.
+    Return the number of failed cases
+    """
+    parser = argparse.ArgumentParser(description="Regularized fast marching segmentation of volumes files")
+    parser.add_argument("case", nargs="*", help="volume file, seeds file and output file of a single case")
+    parser.add_argument("--cases", help="csv file listing a volume file, a seeds file and an output file by line")
+    parser.add_argument("--labels", required=True, help="labels csv file, its last label is the background")
+    parser.add_argument("--distance", type=float, default=100)
+    parser.add_argument("--gamma", type=float, default=0.025)
+    parser.add_argument("--margin", type=int, default=15, help="mask margin in voxels")
+    parser.add_argument("--diameter", type=int, default=4, help="regularization diameter in voxels")
+    parser.add_argument("--threshold", type=float, nargs=2, metavar=("MIN", "MAX"), help="whole volume range by default")
+    parser.add_argument("--engine", default="compiled", choices=["heap", "compiled", "bucket", "vectorized", "parallel", "tiled", "sweeping", "wavefront"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of cases segmented in parallel")
+    parser.add_argument("--keep-background", action="store_true", help="write the background label")
+    args = parser.parse_args(argv)
+
+    if len(args.case) not in (0, 3) or (args.cases is None and len(args.case) == 0):
+        parser.error("give a single case (volume, seeds, output) or a --cases file")
+    cases = loadCases(args.cases) if args.cases else []
+    if len(args.case) == 3:
+        cases.append(args.case)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(cases)))) as executor:
+        futures = [executor.submit(segmentCase, volumeFile, seedsFile, outputFile, args.labels, args.margin, args.distance,
+            args.gamma, args.diameter, args.threshold, args.engine, args.keep_background) for volumeFile, seedsFile, outputFile in cases]
+        for (volumeFile, _, _), future in zip(cases, futures):
+            try:
+                outputFile, instrumentation = future.result()
+                logging.info("%s: segmentation saved in %s %s", volumeFile, outputFile, json.dumps(instrumentation))
+            except Exception:
+                logging.exception("%s: segmentation failed", volumeFile)
+                failures += 1
+    return failures
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(1 if main() else 0)
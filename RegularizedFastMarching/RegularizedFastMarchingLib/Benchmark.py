@@ -0,0 +1,177 @@
+"""
+Benchmark of the regularization and segmentation engines on synthetic phantoms.
+Usage, from the RegularizedFastMarching folder:
+    python -m RegularizedFastMarchingLib.Benchmark --sizes 32 64 --labels 3 5 --engines heap compiled vectorized
+"""
+import numpy as np
+import time
+import json
+import csv
+import argparse
+import tracemalloc
+
+from RegularizedFastMarchingLib.Segmentation import getMasks, getSeedsFromMarkups, segmentVoxels
+from RegularizedFastMarchingLib.Regularization import regularization
+
+phantomKinds = ["spheres", "tubes", "bridges", "noise"]
+
+
+def makePhantom(kind, size, nbLabel, noise=10, randomSeed=0):
+    """
+    Return a synthetic volume with nbLabel - 1 objects and its seeds, the last label being the background
+    Inputs:
+      * kind: "spheres" (separated spheres of different intensities), "tubes" (parallel cylinders crossing the volume),
+        "bridges" (spheres of the same intensity linked by thin bridges, only kept apart by the regularization)
+        or "noise" (no structure, the seeds compete on pure noise)
+      * size: number of voxels along each axis
+      * noise: standard deviation of the gaussian noise added to the volume
+    Outputs:
+      * voxels: int16 3D array
+      * seeds: the seeds in IJK coordinates, one at the center of each object and two background seeds in opposite corners
+    """
+    rng = np.random.default_rng(randomSeed)
+    shape = (size, size, size)
+    k, j, i = np.indices(shape, dtype=np.float32)
+    voxels = np.full(shape, 20, dtype=np.float32)
+
+    nbObjects = nbLabel - 1
+    step = size / nbObjects
+    radius = max(2, min(0.35 * step, 0.3 * size))
+    centers = [[size // 2, size // 2, int((o + 0.5) * step)] for o in range(nbObjects)]
+    for o, center in enumerate(centers):
+        intensity = 120 if kind == "bridges" else 100 + 100 * o / max(1, nbObjects - 1)
+        if kind in ("spheres", "bridges"):
+            voxels[(k - center[0]) ** 2 + (j - center[1]) ** 2 + (i - center[2]) ** 2 <= radius ** 2] = intensity
+        elif kind == "tubes":
+            voxels[(j - center[1]) ** 2 + (i - center[2]) ** 2 <= (radius / 2) ** 2] = intensity
+        elif kind != "noise":
+            raise ValueError("Unknown phantom kind: " + str(kind))
+    if kind == "bridges":
+        voxels[size // 2, size // 2, centers[0][2]:centers[-1][2] + 1] = 120
+    voxels += noise * rng.standard_normal(shape).astype(np.float32)
+
+    markups = [["object" + str(o + 1), center, o + 1] for o, center in enumerate(centers)]
+    markups += [["background", [1, 1, 1], nbLabel], ["background", [size - 2, size - 2, size - 2], nbLabel]]
+    return voxels.astype(np.int16), getSeedsFromMarkups(markups, nbLabel)
+
+
+def getPeakMemory(function, *args, **kwargs):
+    """
+    Return the peak memory in bytes allocated while running the function
+    """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def bestTime(repeats, function, *args, **kwargs):
+    """
+    Return the result of the function and its best running time in seconds over the given number of runs
+    """
+    best = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        duration = time.perf_counter() - start_time
+        best = duration if best is None else min(best, duration)
+    return result, best
+
+
+def benchmarkPhantom(kind, size, nbLabel, engines, repeats=3, noise=10, gamma=0.025, regularizationDiameter=4, spacing=(1.0, 1.0, 1.0),
+    pyramidFactors=(), pyramidBandWidth=1):
+    """
+    Time the regularization, the masks and the segmentation of a phantom with each engine
+    Inputs:
+      * pyramidFactors: factors of the coarse to fine segmentations run with the first engine, compared to its full resolution labels
+      * pyramidBandWidth: band width of the coarse to fine segmentations, see segmentPyramid()
+    Outputs:
+      * rows: one dict by engine holding the timings in seconds, the voxels per second, the peak memory in bytes
+        and the fraction of voxels labelled like the first engine
+    """
+    voxels, seeds = makePhantom(kind, size, nbLabel, noise)
+    marginMask = int(size / (nbLabel - 1)) + 2
+    distance = float(np.iinfo(np.int32).max)
+    threshold = [int(voxels.min()), int(voxels.max())]
+
+    R, regularizationTime = bestTime(repeats, regularization, voxels, int(regularizationDiameter / 2))
+    regularizationPeak = getPeakMemory(regularization, voxels, int(regularizationDiameter / 2))
+    _, masksTime = bestTime(repeats, getMasks, voxels, seeds, nbLabel, marginMask)
+
+    rows = []
+    reference = None
+    runs = [(engine, 1) for engine in engines] + [(engines[0], factor) for factor in pyramidFactors]
+    for engine, factor in runs:
+        def run():
+            return segmentVoxels(voxels, spacing, [dict(s) for s in seeds], nbLabel, marginMask, distance, gamma,
+                regularizationDiameter, threshold, R=R, engine=engine, pyramidFactor=factor, pyramidBandWidth=pyramidBandWidth)
+        (imgLabel, _), segmentationTime = bestTime(repeats, run)
+        if reference is None:
+            reference = imgLabel
+        rows.append({
+            "phantom": kind, "size": size, "labels": nbLabel, "engine": engine if factor == 1 else "%s %dx" % (engine, factor),
+            "regularizationTime": regularizationTime, "regularizationPeakMemory": regularizationPeak,
+            "masksTime": masksTime, "segmentationTime": segmentationTime,
+            "voxelsPerSecond": voxels.size / segmentationTime,
+            "segmentationPeakMemory": getPeakMemory(run),
+            "agreement": float(np.mean(imgLabel == reference)),
+        })
+    return rows
+
+
+def printTable(rows):
+    """
+    Print the benchmark rows as an aligned table
+    """
+    columns = [("phantom", "%s"), ("size", "%d"), ("labels", "%d"), ("engine", "%s"), ("regularizationTime", "%.3f"),
+        ("masksTime", "%.4f"), ("segmentationTime", "%.3f"), ("voxelsPerSecond", "%.3g"),
+        ("segmentationPeakMemory", "%.3g"), ("agreement", "%.4f")]
+    table = [[name for name, _ in columns]] + [[form % row[name] for name, form in columns] for row in rows]
+    widths = [max(len(line[c]) for line in table) for c in range(len(columns))]
+    for line in table:
+        print("  ".join(value.rjust(width) for value, width in zip(line, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the regularized fast marching on synthetic phantoms")
+    parser.add_argument("--kinds", nargs="+", default=phantomKinds, choices=phantomKinds)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[32, 64])
+    parser.add_argument("--labels", nargs="+", type=int, default=[3, 5], help="numbers of labels, background included")
+    parser.add_argument("--engines", nargs="+", default=["heap", "compiled", "vectorized", "parallel"],
+        help="the first engine is the reference of the labels agreement")
+    parser.add_argument("--repeats", type=int, default=3, help="the best time of the repeats is kept")
+    parser.add_argument("--noise", type=float, default=10)
+    parser.add_argument("--pyramid", nargs="+", type=int, default=[],
+        help="coarse to fine factors run with the first engine, their agreement being the one with full resolution")
+    parser.add_argument("--band-width", type=int, default=1, help="band width of the coarse to fine segmentations")
+    parser.add_argument("--output", help="csv or json file receiving the results")
+    args = parser.parse_args(argv)
+
+    # Compile the numba kernels before timing them
+    if "compiled" in args.engines or "parallel" in args.engines:
+        benchmarkPhantom("spheres", 8, 3, [e for e in args.engines if e in ("compiled", "parallel")], repeats=1)
+
+    rows = []
+    for kind in args.kinds:
+        for size in args.sizes:
+            for nbLabel in args.labels:
+                rows += benchmarkPhantom(kind, size, nbLabel, args.engines, args.repeats, args.noise,
+                    pyramidFactors=args.pyramid, pyramidBandWidth=args.band_width)
+    printTable(rows)
+
+    if args.output:
+        with open(args.output, "w", newline="") as fp:
+            if args.output.endswith(".json"):
+                json.dump(rows, fp, indent=2)
+            else:
+                writer = csv.DictWriter(fp, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import numpy as np
+
+from RegularizedFastMarchingLib.CompiledPropagation import njit, voisins, getMasksBounds
+from RegularizedFastMarchingLib.Instrumentation import setEngineCounters
+
+# Default width of the buckets, in distance units. The distances are at most
+# (edges of the shortest path + 1) * bucketResolution larger than with the exact engines, see propagateBucket()
+bucketResolution = 0.01
+
+
+@njit(cache=True, nogil=True)
+def propagateBucketKernel(voxels, regularization, labels, dist, keys, settled, maskLo, maskHi, shape, strides, deltas,
+    gamma, thresholdMin, thresholdMax, inverseResolution, bucketHead, entryNext, entryVoxel, state, frontierHistogram, maxPops,
+    edgeCosts=None, predecessors=None):
+    """
+    Dial's algorithm on flat arrays: pop at most maxPops entries of the circular bucket queue and settle their voxels.
+    The voxels are ordered by their integer keys, the sum of the edges costs rounded up to units of 1 / inverseResolution,
+    and the bucket of a key is key % len(bucketHead): the keys of the queued voxels are within len(bucketHead) of the
+    current key, as no edge costs more than len(bucketHead) - 1 units. A bucket is a linked list of entries (LIFO),
+    the popped entries being recycled through a free list. The distances are the float lengths of the paths found.
+    A voxel is only updated when both its key and its float distance decrease, the distance of the unlabelled voxels being the cutoff.
+    The optional predecessors array receives the index in voisins of the edge each updated voxel was reached by.
+    The current key, queued entries, push count, settled voxels count, relaxations count, popped entries count,
+    free list head and used entries count are kept in state so the propagation can be resumed.
+    Return 0 when the queue is empty, 1 when maxPops entries were popped and 2 when the entries arrays are full
+    """
+    nbBuckets = bucketHead.shape[0]
+    capacity = entryNext.shape[0]
+    current = state[0]
+    queued = state[1]
+    freeHead = state[6]
+    used = state[7]
+    pops = 0
+    status = 0
+    while queued > 0:
+        if pops >= maxPops:
+            status = 1
+            break
+        if freeHead < 0 and used + 6 > capacity:
+            status = 2
+            break
+
+        # Next non empty bucket, O(1) amortized as the current key only increases
+        bucket = current % nbBuckets
+        while bucketHead[bucket] < 0:
+            current += 1
+            bucket = current % nbBuckets
+        entry = bucketHead[bucket]
+        bucketHead[bucket] = entryNext[entry]
+        p = entryVoxel[entry]
+        entryNext[entry] = freeHead
+        freeHead = entry
+        queued -= 1
+        pops += 1
+
+        histogramBucket = 0
+        while queued >> histogramBucket:
+            histogramBucket += 1
+        frontierHistogram[histogramBucket] += 1
+
+        if settled[p] or keys[p] != current:
+            continue
+        settled[p] = 1
+        state[3] += 1
+
+        k = p // strides[0]
+        j = (p // strides[1]) % shape[1]
+        i = p % shape[2]
+        label = labels[p]
+        m = label - 1
+        voxelP = voxels[p]
+        distP = dist[p]
+
+        for n in range(6):
+            qk = k + voisins[n, 0]
+            qj = j + voisins[n, 1]
+            qi = i + voisins[n, 2]
+            if qk < maskLo[m, 0] or qk > maskHi[m, 0] or qj < maskLo[m, 1] or qj > maskHi[m, 1] or qi < maskLo[m, 2] or qi > maskHi[m, 2]:
+                continue
+            q = qk * strides[0] + qj * strides[1] + qi
+            if settled[q]:
+                continue
+            voxelQ = voxels[q]
+            if voxelQ < thresholdMin or voxelQ > thresholdMax:
+                continue
+
+            if edgeCosts is None:
+                r = regularization[q]
+                diff = np.float64(voxelP) - np.float64(voxelQ)
+                cost = np.sqrt(deltas[n] * (diff * diff + gamma * r * r))
+            else:
+                cost = np.float64(edgeCosts[p, n])
+            state[4] += 1
+            keyQ = current + np.int64(np.ceil(cost * inverseResolution))
+            # The keys are rounded, the float distance is also checked so no voxel is labelled beyond the distance cutoff
+            if keys[q] > keyQ and distP + cost < dist[q]:
+                keys[q] = keyQ
+                dist[q] = distP + cost
+                labels[q] = label
+                if predecessors is not None:
+                    predecessors[q] = n
+                if freeHead >= 0:
+                    entry = freeHead
+                    freeHead = entryNext[entry]
+                else:
+                    entry = used
+                    used += 1
+                entryVoxel[entry] = q
+                entryNext[entry] = bucketHead[keyQ % nbBuckets]
+                bucketHead[keyQ % nbBuckets] = entry
+                queued += 1
+                state[2] += 1
+
+    state[0] = current
+    state[1] = queued
+    state[5] += pops
+    state[6] = freeHead
+    state[7] = used
+    return status
+
+
+def getMaximumEdgeCost(voxels, R, gamma, threshold, imageSpacing, edgeCosts=None):
+    """
+    Return an upper bound of the edges costs between two voxels within the threshold
+    """
+    if edgeCosts is not None:
+        finiteCosts = edgeCosts[np.isfinite(edgeCosts)]
+        return float(finiteCosts.max()) if finiteCosts.size else 0.0
+    contrast = max(0.0, min(float(voxels.max()), threshold[1]) - max(float(voxels.min()), threshold[0]))
+    maximumRegularization = float(np.trunc(np.abs(R)).max()) if R.size else 0.0
+    return float(np.sqrt(max(imageSpacing) * (contrast * contrast + gamma * maximumRegularization * maximumRegularization)))
+
+
+def propagateBucket(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None, progress=None,
+    edgeCosts=None, resolution=None, maxPops=1 << 22, imgPred=None):
+    """
+    Fast marching propagation with a circular bucket queue (Dial's algorithm) on quantized costs: each push and pop
+    is O(1) instead of O(log n) with a heap, the number of buckets being the largest edge cost divided by the resolution.
+    Error bound: the edges costs are rounded up to a multiple of the resolution, so the voxels are settled in the exact
+    order of the rounded costs and the distance of a voxel is the float length of its shortest path for the rounded costs.
+    For one label, a voxel whose exact shortest path has h edges has a distance d with
+    dExact <= d < dExact + (h + 1) * resolution, the frontier distances also being rounded down to the resolution.
+    The labels can only differ from the exact engines where the distances of two labels are within this bound.
+    As with the other engines, only the voxels whose float distance is below their initial distance (the distance cutoff) are labelled
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the engine counters, see setEngineCounters()
+      * progress: optional callback progress(settledVoxels, voxels) called between the kernel calls, see propagate()
+      * edgeCosts: optional precomputed edges costs, see getEdgeCosts(). The regularization map is then not used
+      * resolution: width of the buckets in distance units, bucketResolution by default
+      * maxPops: number of entries popped by each kernel call
+      * imgPred: optional predecessors image, updated in place, see propagateHeap()
+    """
+    if resolution is None:
+        resolution = bucketResolution
+    if progress is not None:
+        from RegularizedFastMarchingLib.Segmentation import progressInterval
+        maxPops = min(maxPops, progressInterval)
+    shape = np.array(voxels.shape, dtype=np.int64)
+    strides = np.array([voxels.shape[1] * voxels.shape[2], voxels.shape[2], 1], dtype=np.int64)
+    deltas = np.array([imageSpacing[0], imageSpacing[0], imageSpacing[1], imageSpacing[2], imageSpacing[1], imageSpacing[2]], dtype=np.float64)
+    maskLo, maskHi = getMasksBounds(masks)
+
+    voxelsFlat = np.ascontiguousarray(voxels, dtype=np.float32).ravel()
+    if edgeCosts is None:
+        regularizationFlat = np.ascontiguousarray(np.trunc(R), dtype=np.float32).ravel()
+    else:
+        regularizationFlat = np.empty(0, dtype=np.float32)
+        edgeCosts = np.ascontiguousarray(edgeCosts, dtype=np.float32).reshape(-1, 6)
+    labelsFlat = np.ascontiguousarray(imgLabel, dtype=imgLabel.dtype if imgLabel.itemsize <= 4 else np.int32).ravel()
+    distFlat = np.ascontiguousarray(imgDist, dtype=np.float64).ravel()
+    predecessorsFlat = np.ascontiguousarray(imgPred).ravel() if imgPred is not None else None
+    settled = np.zeros(voxelsFlat.shape[0], dtype=np.uint8)
+
+    # The keys are the rounded down distances, so the voxels already labelled (incremental updates) are only reached
+    # by shorter paths. The buckets cover the largest edge cost and the frontier spread
+    keys = np.full(voxelsFlat.shape[0], np.iinfo(np.int64).max, dtype=np.int64)
+    finite = distFlat < np.iinfo(np.int64).max * resolution
+    keys[finite] = np.floor(distFlat[finite] / resolution)
+    frontier = np.array(frontier, dtype=np.int64).reshape(-1, 3)
+    frontierIndices = frontier[:, 0] * strides[0] + frontier[:, 1] * strides[1] + frontier[:, 2]
+    frontierKeys = keys[frontierIndices]
+    maximumEdgeCost = getMaximumEdgeCost(voxels, R, gamma, threshold, imageSpacing, edgeCosts)
+    nbBuckets = int(np.ceil(maximumEdgeCost / resolution)) + 1
+    if frontierKeys.size:
+        nbBuckets = max(nbBuckets, int(frontierKeys.max() - frontierKeys.min()) + 1)
+    bucketHead = np.full(nbBuckets, -1, dtype=np.int64)
+
+    # Entries arrays, grown when the kernel reports they are full
+    capacity = max(1024, 2 * len(frontier) + 6)
+    entryNext = np.empty(capacity, dtype=np.int64)
+    entryVoxel = np.empty(capacity, dtype=np.int64)
+    for entry, (p, key) in enumerate(zip(frontierIndices, frontierKeys)):
+        entryVoxel[entry] = p
+        entryNext[entry] = bucketHead[key % nbBuckets]
+        bucketHead[key % nbBuckets] = entry
+    current = int(frontierKeys.min()) if frontierKeys.size else 0
+    state = np.array([current, len(frontier), 0, 0, 0, 0, -1, len(frontier)], dtype=np.int64)
+    frontierHistogram = np.zeros(64, dtype=np.int64)
+
+    while True:
+        status = propagateBucketKernel(voxelsFlat, regularizationFlat, labelsFlat, distFlat, keys, settled, maskLo, maskHi,
+            shape, strides, deltas, float(gamma), float(threshold[0]), float(threshold[1]), 1.0 / resolution,
+            bucketHead, entryNext, entryVoxel, state, frontierHistogram, maxPops, edgeCosts, predecessorsFlat)
+        if status == 0:
+            break
+        if progress is not None:
+            progress(state[3], voxelsFlat.shape[0])
+        if status == 2:
+            entryNext = np.concatenate((entryNext, np.empty_like(entryNext)))
+            entryVoxel = np.concatenate((entryVoxel, np.empty_like(entryVoxel)))
+
+    imgLabel[...] = labelsFlat.reshape(voxels.shape)
+    imgDist[...] = distFlat.reshape(voxels.shape)
+    if imgPred is not None:
+        imgPred[...] = predecessorsFlat.reshape(voxels.shape)
+    setEngineCounters(stats, state[5], state[2], state[4], state[3], frontierHistogram)
+    return imgLabel, imgDist
@@ -0,0 +1,91 @@
+import numpy as np
+import os.path
+import hashlib
+import collections
+
+
+def getVolumeKey(voxels, spacing, *parameters):
+    """
+    Return a key identifying the content of a volume: a hash of its voxels, type, shape, spacing and of the given parameters
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((voxels.shape, voxels.dtype.str, tuple(float(s) for s in spacing), parameters)).encode())
+    h.update(np.ascontiguousarray(voxels).data)
+    return h.hexdigest()
+
+
+class ArrayCache:
+    """
+    Cache of numpy arrays by key.
+    The last used arrays are kept in memory, the least recently used ones being evicted first.
+    With a folder, the arrays are also stored uncompressed in .npy files loaded as memory maps,
+    the least recently used files being deleted when the folder exceeds its size budget.
+    """
+
+    def __init__(self, path=None, maxMemoryEntries=2, maxDiskBytes=2 * 1024 ** 3):
+        """
+        Inputs:
+          * path: folder storing the arrays files, None to only cache in memory
+          * maxMemoryEntries: number of arrays kept in memory
+          * maxDiskBytes: size budget of the arrays files
+        """
+        self.path = path
+        self.maxMemoryEntries = maxMemoryEntries
+        self.maxDiskBytes = maxDiskBytes
+        self.memory = collections.OrderedDict()
+
+    def getFileName(self, key):
+        return os.path.join(self.path, key + ".npy")
+
+    def get(self, key):
+        """
+        Return the array cached with this key, None if there is none
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if self.path is None or not os.path.isfile(self.getFileName(key)):
+            return None
+        array = np.load(self.getFileName(key), mmap_mode="r")
+        os.utime(self.getFileName(key)) # Mark the file as recently used
+        self.putInMemory(key, array)
+        return array
+
+    def put(self, key, array):
+        """
+        Cache this array with this key
+        """
+        self.putInMemory(key, array)
+        if self.path is None:
+            return
+
+        # Write then rename so an interrupted write never leaves a truncated entry
+        temporaryFileName = self.getFileName(key) + ".tmp"
+        with open(temporaryFileName, "wb") as fp:
+            np.save(fp, array)
+        os.replace(temporaryFileName, self.getFileName(key))
+        self.evictFiles()
+
+    def putInMemory(self, key, array):
+        self.memory[key] = array
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxMemoryEntries:
+            self.memory.popitem(last=False)
+
+    def evictFiles(self):
+        """
+        Delete the least recently used files until the folder fits in its size budget
+        """
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".npy")]
+        files.sort(key=os.path.getmtime)
+        totalBytes = sum(os.path.getsize(f) for f in files)
+        for f in files[:-1]: # The newest file is always kept
+            if totalBytes <= self.maxDiskBytes:
+                break
+            size = os.path.getsize(f)
+            try:
+                os.remove(f)
+                totalBytes -= size
+            except OSError: # Still memory mapped on Windows
+                pass
@@ -0,0 +1,245 @@
+import numpy as np
+
+from RegularizedFastMarchingLib.Instrumentation import setEngineCounters
+
+# The kernels are compiled with numba when it is installed (slicer.util.pip_install("numba")),
+# otherwise the segmentation falls back to the pure Python engines
+try:
+    from numba import njit
+    isCompiled = True
+except ImportError:
+    isCompiled = False
+
+    def njit(*args, **kwargs):
+        """
+        Replacement of numba.njit leaving the decorated function as plain Python
+        """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+# Neighbours offsets, in the same order as the pure Python engines
+voisins = np.array([[-1, 0, 0], [1, 0, 0], [0, -1, 0], [0, 0, -1], [0, 1, 0], [0, 0, 1]], dtype=np.int64)
+
+
+@njit(cache=True, nogil=True)
+def heapLess(heapDist, heapOrder, a, b):
+    """
+    Heap order: smallest distance first, then first pushed first
+    """
+    return heapDist[a] < heapDist[b] or (heapDist[a] == heapDist[b] and heapOrder[a] < heapOrder[b])
+
+
+@njit(cache=True, nogil=True)
+def heapSwap(heapDist, heapOrder, heapIndex, a, b):
+    heapDist[a], heapDist[b] = heapDist[b], heapDist[a]
+    heapOrder[a], heapOrder[b] = heapOrder[b], heapOrder[a]
+    heapIndex[a], heapIndex[b] = heapIndex[b], heapIndex[a]
+
+
+@njit(cache=True, nogil=True)
+def heapPush(heapDist, heapOrder, heapIndex, size, dist, order, index):
+    """
+    Push an entry in the binary heap stored in the three arrays, return the new heap size
+    """
+    pos = size
+    heapDist[pos] = dist
+    heapOrder[pos] = order
+    heapIndex[pos] = index
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if not heapLess(heapDist, heapOrder, pos, parent):
+            break
+        heapSwap(heapDist, heapOrder, heapIndex, pos, parent)
+        pos = parent
+    return size + 1
+
+
+@njit(cache=True, nogil=True)
+def heapPop(heapDist, heapOrder, heapIndex, size):
+    """
+    Remove the root of the binary heap, return the new heap size
+    """
+    size -= 1
+    heapDist[0] = heapDist[size]
+    heapOrder[0] = heapOrder[size]
+    heapIndex[0] = heapIndex[size]
+    pos = 0
+    while True:
+        child = 2 * pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and heapLess(heapDist, heapOrder, child + 1, child):
+            child += 1
+        if not heapLess(heapDist, heapOrder, child, pos):
+            break
+        heapSwap(heapDist, heapOrder, heapIndex, pos, child)
+        pos = child
+    return size
+
+
+@njit(cache=True, nogil=True)
+def propagateHeapKernel(voxels, regularization, labels, dist, settled, maskLo, maskHi, shape, strides, deltas,
+    gamma, thresholdMin, thresholdMax, heapDist, heapOrder, heapIndex, state, frontierHistogram, maxPops, maxDistance=np.inf,
+    reopen=False, edgeCosts=None, predecessors=None):
+    """
+    Fast marching on flat arrays: pop at most maxPops heap entries and settle their voxels, up to the distance maxDistance.
+    With reopen, a settled voxel reached with a smaller distance is updated and settled again (label correcting).
+    The voxels whose settled value is 2 are only updated, never pushed in the heap (halo of the tiled engine).
+    The edges costs are read from the optional (voxels, 6) edgeCosts array instead of being computed, see getEdgeCosts().
+    The optional predecessors array receives the index in voisins of the edge each updated voxel was reached by.
+    The heap size, push count, settled voxels count, relaxations count and popped entries count are kept in state
+    so the propagation can be resumed, the heap sizes are counted in frontierHistogram.
+    Return 0 when the heap is empty, 1 when maxPops entries were popped, 2 when the heap arrays are full
+    and 3 when the next entry is farther than maxDistance
+    """
+    size = state[0]
+    pushCount = state[1]
+    capacity = heapDist.shape[0]
+    pops = 0
+    status = 0
+    while size > 0:
+        if pops >= maxPops:
+            status = 1
+            break
+        if size + 6 > capacity:
+            status = 2
+            break
+        if heapDist[0] > maxDistance:
+            status = 3
+            break
+
+        bucket = 0
+        while size >> bucket:
+            bucket += 1
+        frontierHistogram[bucket] += 1
+
+        distP = heapDist[0]
+        p = heapIndex[0]
+        size = heapPop(heapDist, heapOrder, heapIndex, size)
+        pops += 1
+        if settled[p] or distP > dist[p]:
+            continue
+        settled[p] = 1
+        state[2] += 1
+
+        k = p // strides[0]
+        j = (p // strides[1]) % shape[1]
+        i = p % shape[2]
+        label = labels[p]
+        m = label - 1
+        voxelP = voxels[p]
+
+        for n in range(6):
+            qk = k + voisins[n, 0]
+            qj = j + voisins[n, 1]
+            qi = i + voisins[n, 2]
+            if qk < maskLo[m, 0] or qk > maskHi[m, 0] or qj < maskLo[m, 1] or qj > maskHi[m, 1] or qi < maskLo[m, 2] or qi > maskHi[m, 2]:
+                continue
+            q = qk * strides[0] + qj * strides[1] + qi
+            if settled[q] == 1 and not reopen:
+                continue
+            voxelQ = voxels[q]
+            if voxelQ < thresholdMin or voxelQ > thresholdMax:
+                continue
+
+            if edgeCosts is None:
+                r = regularization[q]
+                diff = np.float64(voxelP) - np.float64(voxelQ)
+                DistToSeed = distP + np.sqrt(deltas[n] * (diff * diff + gamma * r * r))
+            else:
+                DistToSeed = distP + np.float64(edgeCosts[p, n])
+            state[3] += 1
+            if dist[q] > DistToSeed:
+                dist[q] = DistToSeed
+                labels[q] = label
+                if predecessors is not None:
+                    predecessors[q] = n
+                if settled[q] == 2:
+                    continue
+                settled[q] = 0
+                # Push the stored distance, it may be rounded by a float32 distances image
+                size = heapPush(heapDist, heapOrder, heapIndex, size, dist[q], pushCount, q)
+                pushCount += 1
+
+    state[0] = size
+    state[1] = pushCount
+    state[4] += pops
+    return status
+
+
+def getMasksBounds(masks):
+    """
+    Return the masks as two (nbMasks, 3) arrays holding the lower and upper bounds of each mask
+    """
+    maskLo = np.array([np.asarray(m[0]) for m in masks], dtype=np.int64).reshape(-1, 3)
+    maskHi = np.array([np.asarray(m[1]) for m in masks], dtype=np.int64).reshape(-1, 3)
+    return maskLo, maskHi
+
+
+def propagateCompiled(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, maxPops=1 << 22, stats=None,
+    progress=None, edgeCosts=None, imgPred=None):
+    """
+    Fast marching propagation running the compiled kernel on flat linear indices
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * maxPops: number of heap entries popped by each kernel call
+      * stats: optional dict filled with the engine counters, see setEngineCounters()
+      * progress: optional callback progress(settledVoxels, voxels) called between the kernel calls, see propagate().
+        The kernel then pops at most progressInterval entries by call
+      * edgeCosts: optional precomputed edges costs, see getEdgeCosts(). The regularization map is then not used
+      * imgPred: optional predecessors image, updated in place, see propagateHeap()
+    """
+    if progress is not None:
+        from RegularizedFastMarchingLib.Segmentation import progressInterval
+        maxPops = min(maxPops, progressInterval)
+    shape = np.array(voxels.shape, dtype=np.int64)
+    strides = np.array([voxels.shape[1] * voxels.shape[2], voxels.shape[2], 1], dtype=np.int64)
+    deltas = np.array([imageSpacing[0], imageSpacing[0], imageSpacing[1], imageSpacing[2], imageSpacing[1], imageSpacing[2]], dtype=np.float64)
+    maskLo, maskHi = getMasksBounds(masks)
+
+    # Contiguous flat buffers, R is truncated like in getDistanceBetweenVoxel.
+    # Compact labels images (uint8, uint16) are used as they are, the other ones as int32
+    voxelsFlat = np.ascontiguousarray(voxels, dtype=np.float32).ravel()
+    if edgeCosts is None:
+        regularizationFlat = np.ascontiguousarray(np.trunc(R), dtype=np.float32).ravel()
+    else:
+        regularizationFlat = np.empty(0, dtype=np.float32)
+        edgeCosts = np.ascontiguousarray(edgeCosts, dtype=np.float32).reshape(-1, 6)
+    labelsFlat = np.ascontiguousarray(imgLabel, dtype=imgLabel.dtype if imgLabel.itemsize <= 4 else np.int32).ravel()
+    distFlat = np.ascontiguousarray(imgDist).ravel()
+    predecessorsFlat = np.ascontiguousarray(imgPred).ravel() if imgPred is not None else None
+    settled = np.zeros(voxelsFlat.shape[0], dtype=np.uint8)
+
+    # Heap arrays, grown when the kernel reports they are full
+    capacity = max(1024, 2 * len(frontier) + 6)
+    heapDist = np.empty(capacity, dtype=np.float64)
+    heapOrder = np.empty(capacity, dtype=np.int64)
+    heapIndex = np.empty(capacity, dtype=np.int64)
+    size = 0
+    for p in frontier:
+        q = int(p[0]) * strides[0] + int(p[1]) * strides[1] + int(p[2])
+        size = heapPush(heapDist, heapOrder, heapIndex, size, distFlat[q], size, q)
+    state = np.array([size, size, 0, 0, 0], dtype=np.int64)
+    frontierHistogram = np.zeros(64, dtype=np.int64)
+
+    while True:
+        status = propagateHeapKernel(voxelsFlat, regularizationFlat, labelsFlat, distFlat, settled, maskLo, maskHi,
+            shape, strides, deltas, float(gamma), float(threshold[0]), float(threshold[1]),
+            heapDist, heapOrder, heapIndex, state, frontierHistogram, maxPops, np.inf, False, edgeCosts, predecessorsFlat)
+        if status == 0:
+            break
+        if progress is not None:
+            progress(state[2], voxelsFlat.shape[0])
+        if status == 2:
+            heapDist = np.concatenate((heapDist, np.empty_like(heapDist)))
+            heapOrder = np.concatenate((heapOrder, np.empty_like(heapOrder)))
+            heapIndex = np.concatenate((heapIndex, np.empty_like(heapIndex)))
+
+    imgLabel[...] = labelsFlat.reshape(voxels.shape)
+    imgDist[...] = distFlat.reshape(voxels.shape)
+    if imgPred is not None:
+        imgPred[...] = predecessorsFlat.reshape(voxels.shape)
+    setEngineCounters(stats, state[4], state[1] - len(frontier), state[3], state[2], frontierHistogram)
+    return imgLabel, imgDist
@@ -0,0 +1,91 @@
+import numpy as np
+import os
+import csv
+import zlib
+import concurrent.futures
+
+nrrdTypes = {"i1": "int8", "u1": "uint8", "i2": "int16", "u2": "uint16", "i4": "int32", "u4": "uint32",
+    "i8": "int64", "u8": "uint64", "f4": "float", "f8": "double"}
+
+
+def getMaskedIntensities(voxels, imgLabel, excludedLabels):
+    """
+    Return the voxels intensities where they are labelled, 0 elsewhere, in the type of the voxels
+    Inputs:
+      * voxels: the segmented image
+      * imgLabel: the labels image
+      * excludedLabels: the labels whose voxels are set to 0, like the background
+    """
+    mask = imgLabel != 0
+    for label in excludedLabels:
+        mask &= imgLabel != label
+    maskedVoxels = np.zeros_like(voxels)
+    np.copyto(maskedVoxels, voxels, where=mask)
+    return maskedVoxels
+
+
+def writeNrrd(fileName, array, ijkToLps, compression=1, chunkBytes=1 << 24):
+    """
+    Write a 3D image in a NRRD file, the file is only replaced once completely written
+    Inputs:
+      * array: 3D numpy array indexed [k, j, i]
+      * ijkToLps: 4x4 matrix transforming the (i, j, k) indices to the LPS (Left, Posterior, Superior) coordinates
+      * compression: gzip compression level from 1 (fastest) to 9 (smallest), 0 to write raw data
+      * chunkBytes: size of the data chunks compressed at once
+    Outputs:
+      * fileName
+    """
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+    directions = " ".join("(%r,%r,%r)" % tuple(float(ijkToLps[r][c]) for r in range(3)) for c in range(3))
+    header = ("NRRD0004\n"
+        "type: %s\n"
+        "dimension: 3\n"
+        "space: left-posterior-superior\n"
+        "sizes: %d %d %d\n"
+        "space directions: %s\n"
+        "kinds: domain domain domain\n"
+        "endian: little\n"
+        "encoding: %s\n"
+        "space origin: (%r,%r,%r)\n\n") % (nrrdTypes[array.dtype.str[1:]], array.shape[2], array.shape[1], array.shape[0],
+        directions, "gzip" if compression > 0 else "raw", float(ijkToLps[0][3]), float(ijkToLps[1][3]), float(ijkToLps[2][3]))
+
+    data = memoryview(array.reshape(-1)).cast("B")
+    temporaryFileName = fileName + ".tmp"
+    with open(temporaryFileName, "wb") as fp:
+        fp.write(header.encode("ascii"))
+        compressor = zlib.compressobj(compression, zlib.DEFLATED, 31) if compression > 0 else None # 31: gzip stream
+        for start in range(0, len(data), chunkBytes):
+            chunk = data[start:start + chunkBytes]
+            fp.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            fp.write(compressor.flush())
+    os.replace(temporaryFileName, fileName)
+    return fileName
+
+
+def writeCsv(fileName, header, rows):
+    """
+    Write the header and the rows in a csv file
+    Outputs:
+      * fileName
+    """
+    with open(fileName, "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return fileName
+
+
+def startExport(jobs, maxWorkers=None):
+    """
+    Start writing the files on a thread pool, compressing and writing the files release the GIL
+    Inputs:
+      * jobs: list of (function, arguments...) tuples, each function writing a file and returning its name
+      * maxWorkers: number of threads, one by job by default
+    Outputs:
+      * futures: the futures of the jobs, in the jobs order
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers or max(1, len(jobs)))
+    futures = [executor.submit(*job) for job in jobs]
+    executor.shutdown(wait=False)
+    return futures
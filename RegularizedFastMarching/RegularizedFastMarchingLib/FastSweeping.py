@@ -0,0 +1,120 @@
+import numpy as np
+import logging
+
+from RegularizedFastMarchingLib.CompiledPropagation import getMasksBounds
+from RegularizedFastMarchingLib.Instrumentation import setEngineCounters
+
+# Sweeps of a round: the axis of the planes, the direction they are visited in and the index in voisins of the neighbour
+# going from a plane to the next one
+sweeps = [(0, 1, 1), (0, -1, 0), (1, 1, 4), (1, -1, 2), (2, 1, 5), (2, -1, 3)]
+
+
+def propagateFastSweeping(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None, progress=None,
+    edgeCosts=None, maxRounds=1000):
+    """
+    Fast sweeping propagation: rounds of Gauss-Seidel sweeps over the sub-volume, without a queue.
+    A sweep visits the planes orthogonal to one axis in increasing or decreasing order, each plane being relaxed
+    from the previous one with array operations, so the distances travel along the whole axis in a single sweep.
+    A round is made of the 6 sweeps of the 3 axes in both directions, the rounds stop when no voxel changed.
+    Like with the other engines, only the frontier voxels and the voxels already reached propagate their label.
+    The propagation is label correcting, the number of rounds growing with the number of turns of the shortest paths.
+    Like with the vectorized engine, a voxel first reached by a label relays it even after another label takes the voxel,
+    so the labels can differ from the fast marching engines near the masks borders (see propagateVectorized()).
+    With the benchmark masks margins, 99.7% to 100% of the voxels of the 32 voxels phantoms get the heap labels,
+    and 89% to 97% get the wavefront ones
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the engine counters, see setEngineCounters(). The iterations are the sweeps and,
+        as there is no frontier, the frontierHistogram is empty: sweepUpdatesHistogram counts the sweeps by number of voxels updated
+        (same buckets). converged is False when maxRounds rounds ran without reaching a round with no update
+      * progress: optional callback progress(reachedVoxels, voxels) called after each sweep, see propagate()
+      * edgeCosts: optional precomputed edges costs, see getEdgeCosts()
+      * maxRounds: maximum number of rounds, a warning is logged when the distances did not converge
+    """
+    maskLo, maskHi = getMasksBounds(masks)
+    inThreshold = (voxels >= threshold[0]) & (voxels <= threshold[1])
+    if edgeCosts is None:
+        regularizationTerm = np.square(np.trunc(R), dtype=np.float64)
+        regularizationTerm *= gamma
+
+    # Voxels propagating their label: the frontier, then the voxels reached
+    active = np.zeros(voxels.shape, dtype=bool)
+    frontier = np.array(frontier, dtype=int).reshape(-1, 3)
+    active[frontier[:, 0], frontier[:, 1], frontier[:, 2]] = True
+    reached = np.zeros(voxels.shape, dtype=bool) if stats is not None or progress is not None else None
+    reachedCount = 0
+
+    iterations = updates = relaxations = 0
+    sweepUpdatesHistogram = [0] * 64
+    converged = False
+    for _ in range(maxRounds):
+        roundUpdates = 0
+        for axis, step, n in sweeps:
+            # Views where the planes are along the first axis, the two other axes keeping their order
+            planeAxes = [a for a in range(3) if a != axis]
+            voxelsPlanes, activePlanes = np.moveaxis(voxels, axis, 0), np.moveaxis(active, axis, 0)
+            distPlanes, labelPlanes = np.moveaxis(imgDist, axis, 0), np.moveaxis(imgLabel, axis, 0)
+            inThresholdPlanes = np.moveaxis(inThreshold, axis, 0)
+            if edgeCosts is None:
+                regularizationPlanes = np.moveaxis(regularizationTerm, axis, 0)
+            else:
+                costPlanes = np.moveaxis(edgeCosts[..., n], axis, 0)
+
+            sweepUpdates = 0
+            planes = range(1, voxels.shape[axis]) if step == 1 else range(voxels.shape[axis] - 2, -1, -1)
+            for c in planes:
+                rows, cols = np.nonzero(activePlanes[c - step])
+                if rows.size == 0:
+                    continue
+                inPlane = inThresholdPlanes[c][rows, cols]
+                rows, cols = rows[inPlane], cols[inPlane]
+                if edgeCosts is None:
+                    diff = voxelsPlanes[c - step][rows, cols].astype(np.float64) - voxelsPlanes[c][rows, cols]
+                    cost = np.sqrt(imageSpacing[axis] * (diff * diff + regularizationPlanes[c][rows, cols]))
+                else:
+                    cost = costPlanes[c - step][rows, cols]
+                dist = (distPlanes[c - step][rows, cols] + cost).astype(imgDist.dtype)
+                relaxations += rows.size
+
+                # The improved voxels must be in the mask of the label reaching them
+                improved = dist < distPlanes[c][rows, cols]
+                rows, cols, dist = rows[improved], cols[improved], dist[improved]
+                labels = labelPlanes[c - step][rows, cols]
+                coordinates = np.empty((rows.size, 3), dtype=np.int64)
+                coordinates[:, axis] = c
+                coordinates[:, planeAxes[0]] = rows
+                coordinates[:, planeAxes[1]] = cols
+                inMask = np.all((coordinates >= maskLo[labels - 1]) & (coordinates <= maskHi[labels - 1]), axis=1)
+                rows, cols = rows[inMask], cols[inMask]
+                if rows.size == 0:
+                    continue
+
+                distPlanes[c][rows, cols] = dist[inMask]
+                labelPlanes[c][rows, cols] = labels[inMask]
+                activePlanes[c][rows, cols] = True
+                sweepUpdates += rows.size
+                if reached is not None:
+                    reachedPlane = np.moveaxis(reached, axis, 0)[c]
+                    reachedCount += rows.size - np.count_nonzero(reachedPlane[rows, cols])
+                    reachedPlane[rows, cols] = True
+
+            iterations += 1
+            sweepUpdatesHistogram[int(sweepUpdates).bit_length()] += 1
+            roundUpdates += sweepUpdates
+            if progress is not None:
+                progress(reachedCount, voxels.size)
+        updates += roundUpdates
+        if roundUpdates == 0:
+            converged = True
+            break
+
+    if not converged:
+        logging.warning("Fast sweeping stopped after {} rounds before converging, the distances are not final".format(maxRounds))
+    setEngineCounters(stats, iterations, updates, relaxations, reachedCount, [])
+    if stats is not None:
+        while sweepUpdatesHistogram and sweepUpdatesHistogram[-1] == 0:
+            sweepUpdatesHistogram.pop()
+        stats["sweepUpdatesHistogram"] = sweepUpdatesHistogram
+        stats["converged"] = converged
+    return imgLabel, imgDist
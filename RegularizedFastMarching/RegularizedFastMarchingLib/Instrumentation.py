@@ -0,0 +1,85 @@
+import numpy as np
+import time
+import json
+import logging
+import collections
+import contextlib
+
+
+def setEngineCounters(stats, iterations, pushes, relaxations, reached, frontierHistogram):
+    """
+    Fill the stats dict with the counters shared by the propagation engines
+    Inputs:
+      * iterations: number of wavefront iterations, or of heap entries popped by the heap engines
+      * pushes: number of distance updates, each one adding the voxel to the frontier
+      * relaxations: number of neighbours distances computed
+      * reached: number of distinct voxels whose distance was updated or settled
+      * frontierHistogram: number of iterations by frontier size, bucket b counting the sizes in [2^(b-1), 2^b)
+    """
+    if stats is None:
+        return
+    frontierHistogram = [int(count) for count in frontierHistogram]
+    while frontierHistogram and frontierHistogram[-1] == 0:
+        frontierHistogram.pop()
+    pushes, reached = int(pushes), int(reached)
+    stats["iterations"] = int(iterations)
+    stats["pushes"] = pushes
+    stats["relaxations"] = int(relaxations)
+    stats["reached"] = reached
+    stats["revisitsPerVoxel"] = pushes / reached if reached > 0 else 0.0
+    stats["frontierHistogram"] = frontierHistogram
+
+
+def mergeEngineCounters(stats, other):
+    """
+    Add the engine counters of other to stats, used when several propagations fill the same stats
+    """
+    if stats is None:
+        return
+    histogram = list(stats.get("frontierHistogram", []))
+    for b, count in enumerate(other.get("frontierHistogram", [])):
+        if b < len(histogram):
+            histogram[b] += count
+        else:
+            histogram.append(count)
+    setEngineCounters(stats, *[stats.get(name, 0) + other.get(name, 0) for name in ("iterations", "pushes", "relaxations", "reached")],
+        histogram)
+
+
+class Instrumentation:
+    """
+    Stage timers and engine counters of a segmentation run
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as the given stage, the times of a stage run several times are added
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start_time
+
+    def asDict(self):
+        return {"stages": dict(self.stages), "counters": dict(self.counters)}
+
+    def log(self):
+        """
+        Log the stages times and the counters as a JSON line
+        """
+        logging.info("RegularizedFastMarching " + json.dumps(self.asDict(), default=lambda value: np.asarray(value).tolist()))
+
+    def getRows(self):
+        """
+        Return the [name, value] rows displayed in the module table, the stages times in seconds first
+        """
+        rows = [[name + " (s)", "%.3f" % duration] for name, duration in self.stages.items()]
+        for name, value in self.counters.items():
+            rows.append([name, "%.3g" % value if isinstance(value, float) else str(value)])
+        return rows
@@ -0,0 +1,124 @@
+import numpy as np
+import concurrent.futures
+
+from RegularizedFastMarchingLib.Instrumentation import mergeEngineCounters
+
+
+def getLabelGroups(masks, labels):
+    """
+    Group the labels whose masks overlap, directly or through other labels.
+    The labels only compete where their masks overlap, so each group can be propagated independently.
+    Inputs:
+      * masks: the masks of all the labels, see getMasks()
+      * labels: the labels to group
+    Outputs:
+      * groups: list of sorted labels lists, sorted by their first label
+    """
+    labels = sorted(labels)
+    parents = {label: label for label in labels}
+
+    def find(label):
+        while parents[label] != label:
+            parents[label] = parents[parents[label]]
+            label = parents[label]
+        return label
+
+    for a in range(len(labels)):
+        loA, hiA = masks[labels[a] - 1]
+        for b in range(a + 1, len(labels)):
+            loB, hiB = masks[labels[b] - 1]
+            if np.all(np.maximum(loA, loB) <= np.minimum(hiA, hiB)):
+                parents[find(labels[b])] = find(labels[a])
+
+    groups = {}
+    for label in labels:
+        groups.setdefault(find(label), []).append(label)
+    return sorted(groups.values())
+
+
+def propagateGroup(engine, voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, progress=None, edgeCosts=None):
+    """
+    Propagate one group of labels on its own copy of the sub-volume, run by the pool workers.
+    Return the labels and distances images and the engine counters
+    """
+    from RegularizedFastMarchingLib.Segmentation import propagate
+    stats = {}
+    propagate(engine, voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts)
+    return imgLabel, imgDist, stats
+
+
+def propagateParallel(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None,
+    engine=None, maxWorkers=None, useProcesses=None, progress=None, edgeCosts=None):
+    """
+    Propagate the groups of labels whose masks overlap in parallel, each group on the sub-volume holding its masks.
+    The groups results are merged in the groups order by keeping the smallest distance of each voxel.
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the number of groups and the engine counters added over the groups
+      * engine: engine propagating each group, "compiled" when numba is installed, "heap" otherwise
+      * maxWorkers: number of workers, the number of CPU cores by default
+      * useProcesses: run the groups on a process pool instead of a thread pool. By default, threads are used with the
+        compiled engine which releases the GIL, processes otherwise
+      * progress: optional callback progress(value, voxels), see propagate(). With threads, value adds the progress of all the groups,
+        with processes it is the number of voxels of the merged groups. When it raises SegmentationCancelled,
+        the groups not started yet are cancelled
+      * edgeCosts: optional precomputed edges costs, see getEdgeCosts()
+    """
+    from RegularizedFastMarchingLib.CompiledPropagation import isCompiled
+    if engine is None:
+        engine = "compiled" if isCompiled else "heap"
+    if useProcesses is None:
+        useProcesses = engine != "compiled"
+
+    frontierArray = np.array(frontier, dtype=int).reshape(-1, 3)
+    frontierLabels = imgLabel[frontierArray[:, 0], frontierArray[:, 1], frontierArray[:, 2]]
+    groups = getLabelGroups(masks, set(frontierLabels.tolist()))
+    if stats is not None:
+        stats["labelGroups"] = len(groups)
+
+    # The threads report the progress of their group, called from several threads
+    groupsProgress = [0] * len(groups)
+
+    def getGroupProgress(g):
+        def groupProgress(value, maximum):
+            groupsProgress[g] = value
+            progress(sum(groupsProgress), voxels.size)
+        return groupProgress if progress is not None and not useProcesses else None
+
+    executorClass = concurrent.futures.ProcessPoolExecutor if useProcesses else concurrent.futures.ThreadPoolExecutor
+    with executorClass(max_workers=maxWorkers) as executor:
+        futures = []
+        boxes = []
+        for g, group in enumerate(groups):
+            # Sub-volume holding the group masks and frontier
+            groupFrontier = frontierArray[np.isin(frontierLabels, group)]
+            lo = np.min([masks[label - 1][0] for label in group] + [groupFrontier.min(axis=0)], axis=0)
+            hi = np.max([masks[label - 1][1] for label in group] + [groupFrontier.max(axis=0)], axis=0)
+            box = (slice(lo[0], hi[0] + 1), slice(lo[1], hi[1] + 1), slice(lo[2], hi[2] + 1))
+            boxes.append(box)
+
+            # Each group works on its own copies, the masks of the other labels are not used
+            groupMasks = [[np.asarray(m[0]) - lo, np.asarray(m[1]) - lo] for m in masks]
+            futures.append(executor.submit(propagateGroup, engine, np.ascontiguousarray(voxels[box]), np.ascontiguousarray(R[box]),
+                groupMasks, (groupFrontier - lo).tolist(), imgLabel[box].copy(), imgDist[box].copy(), gamma, threshold, imageSpacing,
+                getGroupProgress(g), None if edgeCosts is None else np.ascontiguousarray(edgeCosts[box])))
+
+        # Deterministic min distance reduction, in the groups order
+        mergedVoxels = 0
+        for box, future in zip(boxes, futures):
+            try:
+                if progress is not None and useProcesses:
+                    progress(mergedVoxels, voxels.size)
+                groupLabel, groupDist, groupStats = future.result()
+            except BaseException:
+                for pending in futures:
+                    pending.cancel()
+                raise
+            mergedVoxels += groupDist.size
+            mergeEngineCounters(stats, groupStats)
+            improved = groupDist < imgDist[box]
+            imgDist[box][improved] = groupDist[improved]
+            imgLabel[box][improved] = groupLabel[improved]
+
+    return imgLabel, imgDist
@@ -0,0 +1,128 @@
+import numpy as np
+
+
+def downsample(image, factor, reduction):
+    """
+    Return the image reduced by blocks of factor x factor x factor voxels, the last blocks being padded with the edge voxels
+    Inputs:
+      * reduction: "mean" or "max"
+    """
+    padding = [(0, -size % factor) for size in image.shape]
+    if any(p[1] for p in padding):
+        image = np.pad(image, padding, mode="edge")
+    shape = image.shape
+    blocks = image.reshape(shape[0] // factor, factor, shape[1] // factor, factor, shape[2] // factor, factor)
+    if reduction == "mean":
+        return blocks.mean(axis=(1, 3, 5), dtype=np.float64).astype(np.float32)
+    return blocks.max(axis=(1, 3, 5))
+
+
+def upsample(image, factor, shape):
+    """
+    Return the image repeated by blocks of factor x factor x factor voxels, cropped to the given shape
+    """
+    for axis in range(3):
+        image = np.repeat(image, factor, axis=axis)
+    return image[:shape[0], :shape[1], :shape[2]]
+
+
+def getCoarseSeeds(seeds, factor, shape):
+    """
+    Return the seeds at the coarse resolution, a single seed being kept by coarse voxel.
+    The seeds are moved inside the volume border excluded by getMasks()
+    """
+    coarseSeeds = []
+    positions = set()
+    for seed in seeds:
+        pos = tuple(min(max(int(c) // factor, 1), size - 1) for c, size in zip(seed.get("pos"), shape))
+        if pos not in positions:
+            positions.add(pos)
+            coarseSeeds.append(dict(seed, pos=list(pos)))
+    return coarseSeeds
+
+
+def getBoundaryBand(labels, bandWidth):
+    """
+    Return the voxels whose label differs from one of their 6 neighbours, dilated by bandWidth voxels
+    """
+    from scipy import ndimage
+    boundary = np.zeros(labels.shape, dtype=bool)
+    for axis in range(3):
+        first = [slice(None)] * 3
+        second = [slice(None)] * 3
+        first[axis], second[axis] = slice(None, -1), slice(1, None)
+        different = labels[tuple(first)] != labels[tuple(second)]
+        boundary[tuple(first)] |= different
+        boundary[tuple(second)] |= different
+    if bandWidth > 0:
+        boundary = ndimage.binary_dilation(boundary, iterations=bandWidth)
+    return boundary
+
+
+def segmentPyramid(voxels, imageSpacing, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, R, factor=2, bandWidth=1,
+    imgLabel=np.array([]), imgDist=np.array([]), engine="heap", stats=None, compact=False, preview=None, progress=None, edgeCosts=None):
+    """
+    Coarse to fine segmentation: segment the volume downsampled by factor, then only propagate again at full resolution
+    in a band around the coarse labels boundaries, the other voxels keeping their coarse label and distance.
+    The coarse voxels are the blocks means divided by factor and their spacing is multiplied by factor^2,
+    so a coarse step costs about as much as the factor fine steps it replaces. The coarse regularization map is the blocks maximum.
+    The coarse masks are shrunk to fit inside the full resolution masks.
+    The distances outside the band are the coarse ones, the labels are the ones that matter.
+    The labels are approximate: the coarse distances the band starts from are not the full resolution ones, so the boundaries
+    move when they are further than bandWidth coarse voxels from the coarse ones. The benchmark reports the fraction of voxels
+    labelled like the full resolution segmentation, see Benchmark.benchmarkPhantom()
+    Inputs:
+      * factor: downsampling factor, 2 or 4
+      * bandWidth: width in coarse voxels of the band computed again around the coarse boundaries and the coarse voxels not reached
+      * preview: optional callback preview(labels) receiving the coarse labels upsampled to the full resolution, before the refinement
+      * edgeCosts: optional full resolution edges costs, only used by the refinement
+      * the other inputs are the ones of segmentVoxels()
+    Outputs:
+      * imgLabel, imgDist: same outputs as segmentVoxels()
+    """
+    from RegularizedFastMarchingLib.Segmentation import segmentVoxels, getLabelType
+    from scipy import ndimage
+
+    # Coarse segmentation, the labels are kept before the background labels are merged
+    coarseVoxels = downsample(voxels, factor, "mean")
+    coarseVoxels /= factor
+    coarseR = downsample(R, factor, "max")
+    coarseSpacing = [s * factor * factor for s in imageSpacing]
+    coarseThreshold = [threshold[0] / factor, threshold[1] / factor]
+    coarseMargin = max(0, (marginMask - factor + 1) // factor)
+    labelType = getLabelType(max([seed.get("label") for seed in seeds] + [nbLabel])) if compact else int
+    coarseLabel = np.zeros(coarseVoxels.shape, dtype=labelType)
+    coarseStats = {} if stats is not None else None
+    _, coarseDist = segmentVoxels(coarseVoxels, coarseSpacing, getCoarseSeeds(seeds, factor, coarseVoxels.shape), nbLabel, coarseMargin, distance, gamma,
+        regDiameter, coarseThreshold, R=coarseR, imgLabel=coarseLabel, engine=engine, stats=coarseStats, compact=compact, progress=progress)
+    if preview is not None:
+        preview(upsample(np.clip(coarseLabel, 0, nbLabel), factor, voxels.shape))
+
+    # Full resolution labels: the coarse ones out of the band around the coarse boundaries and the coarse voxels not reached
+    band = upsample(getBoundaryBand(coarseLabel, bandWidth) | (coarseLabel == 0), factor, voxels.shape)
+    band |= (voxels < threshold[0]) | (voxels > threshold[1])
+    if len(imgLabel) == 0:
+        imgLabel = np.zeros(voxels.shape, dtype=labelType)
+    imgLabel[...] = upsample(coarseLabel, factor, voxels.shape)
+    imgLabel[band] = 0
+
+    # The labelled voxels bordering the band propagate into it with the seeds, from their coarse distance.
+    # The other voxels out of the band are locked with a null distance while propagating, their coarse distance is restored afterwards
+    coarseDist = upsample(coarseDist, factor, voxels.shape)
+    border = ndimage.binary_dilation(band) & ~band & (imgLabel > 0)
+    if len(imgDist) == 0:
+        imgDist = np.zeros(voxels.shape, dtype=np.float32 if compact else float)
+    imgDist.fill(0)
+    imgDist[band] = distance
+    imgDist[border] = coarseDist[border]
+    fineStats = {} if stats is not None else None
+    imgLabel, imgDist = segmentVoxels(voxels, imageSpacing, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, R=R,
+        imgLabel=imgLabel, imgDist=imgDist, engine=engine, stats=fineStats, compact=compact, progress=progress,
+        initialFrontier=np.argwhere(border).tolist(), edgeCosts=edgeCosts)
+    locked = ~(band | border)
+    imgDist[locked] = coarseDist[locked]
+    if stats is not None:
+        stats.update(fineStats)
+        stats["coarse"] = coarseStats
+        stats["bandVoxels"] = int(np.count_nonzero(band))
+    return imgLabel, imgDist
@@ -3,6 +3,21 @@ import os.path
 import time
 import csv
 import math
+import logging
+
+from RegularizedFastMarchingLib.Instrumentation import setEngineCounters, mergeEngineCounters
+
+class SegmentationCancelled(Exception):
+    """
+    Raised by a progress callback to stop the propagation, the labels and distances images are then left partially updated
+    """
+    pass
+
+# Number of heap entries popped between two progress callbacks
+progressInterval = 1 << 16
+
+# Engines able to record the predecessors image, see propagateHeap()
+predecessorEngines = ("heap", "compiled", "bucket")
 
 def getMasks(img, seeds, nbLabel, marginMask):
     """
@@ -35,11 +50,20 @@ def getMasks(img, seeds, nbLabel, marginMask):
     
     return masksByLabel
 
+def usesEdgeCosts(engine):
+    """
+    Return whether the engine computes the edges costs in Python, so it gains from the precomputed costs of getEdgeCosts().
+    The compiled and bucket engines fall back to the heap engine when numba is not installed
+    """
+    from RegularizedFastMarchingLib.CompiledPropagation import isCompiled
+    return engine in ("heap", "wavefront") or (engine in ("compiled", "bucket") and not isCompiled)
+
 def getDistanceBetweenVoxel(Ip, Iq, gamma, R, p, q, imageSpacing):
     """
     Return the distance between two voxels depending on their intensities and the regularization cost
     """
     R = int(R)
+    Ip, Iq = float(Ip), float(Iq)
     if p[0] != q[0]:
         delta = imageSpacing[0]
     elif p[1] != q[1]:
@@ -48,6 +72,40 @@ def getDistanceBetweenVoxel(Ip, Iq, gamma, R, p, q, imageSpacing):
         delta = imageSpacing[2]
     return math.sqrt(delta * (math.pow(Ip - Iq, 2) + gamma * math.pow(R, 2)))
 
+def getEdgeCosts(voxels, R, gamma, imageSpacing):
+    """
+    Return the costs of the edges from each voxel to its 6 neighbours, computed like getDistanceBetweenVoxel() once for all the runs
+    sharing the volume, the regularization map and gamma. The cost from p to q uses the regularization of q,
+    so the two directions of an edge have their own cost. The edges leaving the volume have an infinite cost
+    Inputs:
+      * voxels, R: the 3D image and its regularization map
+      * imageSpacing: the voxels spacing, the cost along the axis n of the voxels being scaled by imageSpacing[n]
+    Outputs:
+      * edgeCosts: float32 array of shape voxels.shape + (6,), edgeCosts[k, j, i, n] being the cost from [k, j, i]
+        to its neighbour in the direction voisins[n] of the engines. The 6 costs of a voxel are contiguous in memory
+    """
+    edgeCosts = np.full(voxels.shape + (6,), np.inf, dtype=np.float32)
+    regularizationTerm = np.square(np.trunc(R), dtype=np.float64)
+    regularizationTerm *= gamma
+    # Directions going backward and forward along each axis, in the voisins order
+    directions = [(0, 1), (2, 4), (3, 5)]
+    for axis, (backward, forward) in enumerate(directions):
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+        lower, upper = tuple(lower), tuple(upper)
+        differenceTerm = np.square(np.subtract(voxels[upper], voxels[lower], dtype=np.float64))
+        # From the lower voxel to the upper one, then from the upper voxel to the lower one
+        cost = np.add(differenceTerm, regularizationTerm[upper])
+        cost *= imageSpacing[axis]
+        np.sqrt(cost, out=cost)
+        edgeCosts[lower + (forward,)] = cost
+        np.add(differenceTerm, regularizationTerm[lower], out=cost)
+        cost *= imageSpacing[axis]
+        np.sqrt(cost, out=cost)
+        edgeCosts[upper + (backward,)] = cost
+    return edgeCosts
+
 
 def isVoxelInMaskArea(mask, voxel):
     """
@@ -64,50 +122,39 @@ def clip(x, xMin, xMax):
     """
     return max(xMin, min(x, xMax))
 
-def segmentation(volume, voxels, R, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, 
-    imgLabel=np.array([]), imgDist=np.array([])):
+def propagateWavefront(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None, progress=None,
+    edgeCosts=None):
     """
-    Return the label s image containing the voxels linked to each seed
+    Reference propagation: grow the wavefront iteration by iteration, a voxel whose distance improves is visited again
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the engine counters (see setEngineCounters()) and the bytes written in the working images
+      * progress: optional callback progress(reachedVoxels, voxels) called before each iteration, see propagate()
+      * edgeCosts: optional precomputed edges costs, see getEdgeCosts()
     """
-
-    # cp = cProfile.Profile()
-    # cp.enable()
-    start_time = time.time()
-    
-    masks = getMasks(voxels, seeds, nbLabel, marginMask)
-    
-    # Labels image
-    if len(imgLabel) == 0:
-        imgLabel = np.ndarray(shape=voxels.shape, dtype=int)
-        imgLabel.fill(0)
-
-    # Distances image
-    if len(imgDist) == 0:
-        imgDist = np.ndarray(shape=voxels.shape, dtype=float)
-        imgDist.fill(distance)
-    
-    # Visited voxels image
-    imgVisitedVoxels = np.zeros(voxels.shape, dtype=int)
+    # Visited voxels image: a voxel is visited during the current iteration when it holds the iteration number,
+    # so starting a new iteration does not need to reset the whole image
+    imgVisitedVoxels = np.zeros(voxels.shape, dtype=np.int32)
+    iteration = 0
+    updates = 0
+    relaxations = 0
+    reached = 0
+    frontierHistogram = [0] * 64
 
     # Lists voxels to visit now and the next iteration 
     listCurrentVoxels = []
-    listNextVoxels = []
-    
-    # Initialize the images with the given seeds 
-    for l in range(len(seeds)):
-        pos = seeds[l].get("pos")
-        listNextVoxels.append([pos[0], pos[1], pos[2]])
-        imgDist[pos[0], pos[1], pos[2]] = 0
-        imgLabel[pos[0], pos[1], pos[2]] = seeds[l].get("label")
-        
-    imageSpacing = volume.GetSpacing()
+    listNextVoxels = list(frontier)
 
     voisins = [np.array([-1, 0, 0]), np.array([1, 0, 0]), np.array([0, -1, 0]), np.array([0, 0, -1]), np.array([0, 1, 0]), np.array([0, 0, 1])]
 
     while listNextVoxels != []:
+        if progress is not None:
+            progress(reached, voxels.size)
         listCurrentVoxels = list(listNextVoxels)
         listNextVoxels = []
-        imgVisitedVoxels[1:-1,1:-1,1:-1] = 0
+        iteration += 1
+        frontierHistogram[len(listCurrentVoxels).bit_length()] += 1
         
         for p in listCurrentVoxels:
             voxelP = voxels[p[0], p[1], p[2]]
@@ -115,23 +162,572 @@ def segmentation(volume, voxels, R, seeds, nbLabel, marginMask, distance, gamma,
             m = masks[label_p - 1]                
 
             # Compute distance between neighbors voxels
-            for v in voisins:
+            for n, v in enumerate(voisins):
                 q = np.add(p, v)
-                voxelQ = voxels[q[0], q[1], q[2]]
+                if not isVoxelInMaskArea(m, [q[0], q[1], q[2]]) or imgVisitedVoxels[q[0], q[1], q[2]] == iteration:
+                    continue
 
-                if not isVoxelInMaskArea(m, [q[0], q[1], q[2]]) or imgVisitedVoxels[q[0], q[1], q[2]] == 1 or voxelQ < threshold[0] or voxelQ > threshold[1]:
+                voxelQ = voxels[q[0], q[1], q[2]]
+                if voxelQ < threshold[0] or voxelQ > threshold[1]:
                     continue
 
-                DistBetweenVoxels = getDistanceBetweenVoxel(voxelP, voxelQ, gamma, R[q[0], q[1], q[2]], p, q, imageSpacing)
+                if edgeCosts is None:
+                    DistBetweenVoxels = getDistanceBetweenVoxel(voxelP, voxelQ, gamma, R[q[0], q[1], q[2]], p, q, imageSpacing)
+                else:
+                    DistBetweenVoxels = float(edgeCosts[p[0], p[1], p[2], n])
                 DistToSeed = imgDist[p[0], p[1], p[2]]+DistBetweenVoxels
+                relaxations += 1
 
                 if imgDist[q[0], q[1], q[2]] > DistToSeed:    #remark : imgDist is initialized to distance everywhere, except at the seed locations
                     imgDist[q[0], q[1], q[2]] = DistToSeed
                     imgLabel[q[0], q[1], q[2]] = label_p
                     listNextVoxels.append(q)
-                    imgVisitedVoxels[q[0], q[1], q[2]] = 1
+                    reached += imgVisitedVoxels[q[0], q[1], q[2]] == 0
+                    imgVisitedVoxels[q[0], q[1], q[2]] = iteration
+                    updates += 1
+
+    if stats is not None:
+        setEngineCounters(stats, iteration, updates, relaxations, reached, frontierHistogram)
+        stats["visitedBytesWritten"] = updates * imgVisitedVoxels.itemsize
+        stats["bytesWritten"] = updates * (imgVisitedVoxels.itemsize + imgDist.itemsize + imgLabel.itemsize)
+    return imgLabel, imgDist
+
+def propagateHeap(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None, progress=None,
+    edgeCosts=None, imgPred=None):
+    """
+    Fast marching propagation: the voxels are popped from a heap in increasing distance order and settled once.
+    Outdated heap entries are not removed but skipped when popped (lazy deletion).
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the engine counters, see setEngineCounters(). The frontier is the heap
+      * progress: optional callback progress(settledVoxels, voxels) called every progressInterval heap entries, see propagate()
+      * edgeCosts: optional precomputed edges costs, see getEdgeCosts()
+      * imgPred: optional int8 predecessors image, updated in place: the index in voisins of the edge each voxel was last
+        reached by, its predecessor being the voxel minus this offset. The seeds and the voxels not reached are -1
+    """
+    import heapq
+
+    # Settled voxels image: their distance is final
+    imgSettledVoxels = np.zeros(voxels.shape, dtype=bool)
+
+    # Heap entries: (distance, push order, k, j, i), the push order keeps the ties first in first out
+    heap = []
+    for p in frontier:
+        heap.append((imgDist[p[0], p[1], p[2]], len(heap), p[0], p[1], p[2]))
+    heapq.heapify(heap)
+    pushCount = len(heap)
+    pops = 0
+    settledCount = 0
+    relaxations = 0
+    frontierHistogram = [0] * 64
+
+    voisins = [(-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 0, -1), (0, 1, 0), (0, 0, 1)]
+
+    while heap:
+        frontierHistogram[len(heap).bit_length()] += 1
+        distP, _, k, j, i = heapq.heappop(heap)
+        pops += 1
+        if progress is not None and pops % progressInterval == 0:
+            progress(settledCount, voxels.size)
+        if imgSettledVoxels[k, j, i] or distP > imgDist[k, j, i]:
+            continue
+        imgSettledVoxels[k, j, i] = True
+        settledCount += 1
+
+        p = (k, j, i)
+        voxelP = voxels[k, j, i]
+        label_p = imgLabel[k, j, i]
+        m = masks[label_p - 1]
+
+        for n, v in enumerate(voisins):
+            q = (k + v[0], j + v[1], i + v[2])
+            if not isVoxelInMaskArea(m, q) or imgSettledVoxels[q]:
+                continue
+
+            voxelQ = voxels[q]
+            if voxelQ < threshold[0] or voxelQ > threshold[1]:
+                continue
+
+            if edgeCosts is None:
+                DistToSeed = distP + getDistanceBetweenVoxel(voxelP, voxelQ, gamma, R[q], p, q, imageSpacing)
+            else:
+                DistToSeed = distP + float(edgeCosts[k, j, i, n])
+            relaxations += 1
+            if imgDist[q] > DistToSeed:
+                imgDist[q] = DistToSeed
+                imgLabel[q] = label_p
+                if imgPred is not None:
+                    imgPred[q] = n
+                # Push the stored distance, it may be rounded by a float32 distances image
+                heapq.heappush(heap, (imgDist[q], pushCount, q[0], q[1], q[2]))
+                pushCount += 1
+
+    setEngineCounters(stats, pops, pushCount - len(frontier), relaxations, settledCount, frontierHistogram)
+    return imgLabel, imgDist
+
+def getMasksBoundingBox(masks, labels):
+    """
+    Return the lower and upper corners (included) of the box containing the masks of the given labels
+    """
+    lo = np.min([masks[label - 1][0] for label in labels], axis=0)
+    hi = np.max([masks[label - 1][1] for label in labels], axis=0)
+    return lo, hi
+
+def getPropagationBox(masks, frontier, imgLabel):
+    """
+    Return the box holding the masks of the frontier labels and the frontier, with the masks and the frontier relative to this box
+    """
+    frontierArray = np.array(frontier, dtype=int).reshape(-1, 3)
+    labels = set(np.asarray(imgLabel[frontierArray[:, 0], frontierArray[:, 1], frontierArray[:, 2]]).tolist())
+    lo, hi = getMasksBoundingBox(masks, labels)
+    lo = np.maximum(np.minimum(lo, frontierArray.min(axis=0)), 0)
+    hi = np.minimum(np.maximum(hi, frontierArray.max(axis=0)), np.array(imgLabel.shape) - 1)
+    box = (slice(lo[0], hi[0] + 1), slice(lo[1], hi[1] + 1), slice(lo[2], hi[2] + 1))
+    masks = [[np.asarray(m[0]) - lo, np.asarray(m[1]) - lo] for m in masks]
+    return box, masks, (frontierArray - lo).tolist()
+
+def propagate(engine, voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None, progress=None,
+    edgeCosts=None, imgPred=None):
+    """
+    Propagate the labels from the frontier voxels with the given engine.
+    A label only spreads inside its mask, so the engine works on the sub-volume holding the masks of the frontier labels.
+    Inputs:
+      * engine: the propagation algorithm, "heap" (fast marching, each voxel settled once), "compiled" (heap engine compiled with numba,
+        the pure Python heap engine is used when numba is not installed), "bucket" (compiled fast marching with a bucket queue on costs
+        rounded to BucketPropagation.bucketResolution, the heap engine is used when numba is not installed), "vectorized" (frontier relaxed with NumPy array operations),
+        "parallel" (groups of labels with overlapping masks propagated on several CPU cores), "tiled" (propagation tile by tile,
+        the images can be memory maps), "sweeping" (fast sweeping, Gauss-Seidel sweeps over the planes of each axis)
+        or "wavefront" (reference iterative propagation)
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the engine counters
+      * progress: optional callback progress(value, maximum) called regularly by the engine with the number of voxels
+        settled or reached and the number of voxels of the propagated sub-volume. It can raise SegmentationCancelled to stop
+      * edgeCosts: optional edges costs of the images computed by getEdgeCosts() with the same gamma, the engines then only add them
+        instead of computing the costs. The tiled engine computes its costs
+      * imgPred: optional predecessors image updated in place, see propagateHeap(). Only recorded by the predecessorEngines
+    """
+    if imgPred is not None and engine not in predecessorEngines:
+        raise ValueError("The " + str(engine) + " engine does not record the predecessors")
+    if len(frontier) == 0:
+        return imgLabel, imgDist
+
+    # Crop the images to the frontier labels masks, the engine updates the cropped labels and distances in place
+    box, masks, frontier = getPropagationBox(masks, frontier, imgLabel)
+    voxels, R = voxels[box], R[box]
+    croppedLabel, croppedDist = imgLabel[box], imgDist[box]
+    if edgeCosts is not None:
+        edgeCosts = edgeCosts[box]
+    croppedPred = imgPred[box] if imgPred is not None else None
+    if stats is not None:
+        stats["croppedShape"] = voxels.shape
+
+    if engine == "heap":
+        propagateHeap(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts,
+            croppedPred)
+    elif engine == "compiled":
+        from RegularizedFastMarchingLib.CompiledPropagation import isCompiled, propagateCompiled
+        if isCompiled:
+            propagateCompiled(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats=stats, progress=progress,
+                edgeCosts=edgeCosts, imgPred=croppedPred)
+        else:
+            logging.info("numba is not installed, the heap engine is used instead of the compiled one")
+            propagateHeap(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts,
+                croppedPred)
+    elif engine == "bucket":
+        from RegularizedFastMarchingLib.CompiledPropagation import isCompiled
+        if isCompiled:
+            from RegularizedFastMarchingLib.BucketPropagation import propagateBucket
+            propagateBucket(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts,
+                imgPred=croppedPred)
+        else:
+            logging.info("numba is not installed, the heap engine is used instead of the bucket one")
+            propagateHeap(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts,
+                croppedPred)
+    elif engine == "vectorized":
+        from RegularizedFastMarchingLib.VectorizedPropagation import propagateVectorized
+        propagateVectorized(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts)
+    elif engine == "parallel":
+        from RegularizedFastMarchingLib.ParallelPropagation import propagateParallel
+        propagateParallel(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress=progress,
+            edgeCosts=edgeCosts)
+    elif engine == "tiled":
+        from RegularizedFastMarchingLib.TiledPropagation import propagateTiled
+        propagateTiled(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress)
+    elif engine == "sweeping":
+        from RegularizedFastMarchingLib.FastSweeping import propagateFastSweeping
+        propagateFastSweeping(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress,
+            edgeCosts)
+    elif engine == "wavefront":
+        propagateWavefront(voxels, R, masks, frontier, croppedLabel, croppedDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts)
+    else:
+        raise ValueError("Unknown segmentation engine: " + str(engine))
+    return imgLabel, imgDist
+
+def getLabelType(maxLabel):
+    """
+    Return the smallest unsigned integer type able to hold the labels up to maxLabel
+    """
+    for labelType in (np.uint8, np.uint16, np.uint32):
+        if maxLabel <= np.iinfo(labelType).max:
+            return labelType
+    return np.uint64
+
+def segmentation(volume, voxels, R, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, 
+    imgLabel=np.array([]), imgDist=np.array([]), engine="heap", stats=None, compact=False, progress=None, pyramidFactor=1, preview=None,
+    edgeCosts=None, imgPred=None, pyramidBandWidth=1):
+    """
+    Return the label s image containing the voxels linked to each seed
+    Inputs:
+      * volume: the segmented volume node, only its spacing is used, see segmentVoxels()
+    """
+    return segmentVoxels(voxels, volume.GetSpacing(), seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold,
+        R=R, imgLabel=imgLabel, imgDist=imgDist, engine=engine, stats=stats, compact=compact, progress=progress,
+        pyramidFactor=pyramidFactor, preview=preview, edgeCosts=edgeCosts, imgPred=imgPred, pyramidBandWidth=pyramidBandWidth)
+
+def segmentVoxels(voxels, imageSpacing, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, R=None,
+    imgLabel=np.array([]), imgDist=np.array([]), engine="heap", stats=None, compact=False, progress=None, initialFrontier=(),
+    pyramidFactor=1, preview=None, edgeCosts=None, imgPred=None, pyramidBandWidth=1):
+    """
+    Return the label s image containing the voxels linked to each seed.
+    Only works on numpy arrays so it can be used without Slicer
+    Inputs:
+      * voxels: the 3D image to segment, indexed [k, j, i]
+      * imageSpacing: the voxels spacing along i, j and k
+      * seeds: the seeds in IJK coordinates, see getSeedsFromMarkups()
+      * R: the regularization map, computed from regDiameter when not given
+      * imgLabel, imgDist: optional initial labels and distances images, updated in place.
+        The returned labels image is a copy where the background seeds labels are merged into a single label
+      * engine: the propagation algorithm, see propagate()
+      * stats: optional dict filled with the engine counters
+      * compact: allocate the labels image with the smallest unsigned type holding the seeds labels and the distances image in float32
+      * progress: optional progress callback, see propagate()
+      * initialFrontier: voxels [k, j, i] of imgLabel and imgDist already labelled, propagated with the seeds
+      * pyramidFactor: when greater than 1, the volume downsampled by this factor is segmented first, see segmentPyramid().
+        The labels are then approximate
+      * pyramidBandWidth: width in coarse voxels of the band segmented again at full resolution, see segmentPyramid()
+      * preview: optional callback receiving the coarse labels of the pyramid segmentation
+      * edgeCosts: optional edges costs computed by getEdgeCosts() from voxels, R and gamma, reused by the runs sharing them
+      * imgPred: optional int8 image filled with -1, receiving the predecessors recorded by the engine, see propagateHeap().
+        Not filled by the pyramid segmentation
+    Outputs:
+      * imgLabel, imgDist: the labels and distances images
+    """
+    if R is None:
+        from RegularizedFastMarchingLib.Regularization import regularization
+        R = regularization(voxels, int(regDiameter/2))
+
+    if pyramidFactor > 1:
+        from RegularizedFastMarchingLib.Pyramid import segmentPyramid
+        return segmentPyramid(voxels, imageSpacing, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, R,
+            factor=pyramidFactor, bandWidth=pyramidBandWidth, imgLabel=imgLabel, imgDist=imgDist, engine=engine, stats=stats,
+            compact=compact, preview=preview, progress=progress, edgeCosts=edgeCosts)
+
+    masks = getMasks(voxels, seeds, nbLabel, marginMask)
+    
+    # Labels image
+    if len(imgLabel) == 0:
+        labelType = getLabelType(max([seed.get("label") for seed in seeds] + [nbLabel])) if compact else int
+        imgLabel = np.ndarray(shape=voxels.shape, dtype=labelType)
+        imgLabel.fill(0)
+
+    # Distances image
+    if len(imgDist) == 0:
+        imgDist = np.ndarray(shape=voxels.shape, dtype=np.float32 if compact else float)
+        imgDist.fill(distance)
+    
+    # Initialize the images with the given seeds 
+    frontier = [list(p) for p in initialFrontier]
+    for l in range(len(seeds)):
+        pos = seeds[l].get("pos")
+        frontier.append([pos[0], pos[1], pos[2]])
+        imgDist[pos[0], pos[1], pos[2]] = 0
+        imgLabel[pos[0], pos[1], pos[2]] = seeds[l].get("label")
+        if imgPred is not None:
+            imgPred[pos[0], pos[1], pos[2]] = -1
+
+    propagate(engine, voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts, imgPred)
 
     imgLabel = np.clip(imgLabel, 0, nbLabel)
+    return imgLabel, imgDist
+
+def loadCSVSeeds(csvFilePath):
+    """
+    Load and return the labels file from the given path in a list
+    Inputs:
+      * csvFilePath: the labels file
+    Ouputs:
+      * labels: the labels list containing the index, name and color of each label
+    """
+    labels = []
+    with open(csvFilePath) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='|')
+        for row in reader:
+            labels.append([row[0], row[1], [float(row[2]), float(row[3]), float(row[4]) ]])
+    logging.info(csvFilePath + ": labels loaded")
+    return labels
+
+def loadMarkupsFromSeedFile(seedFile):
+    """
+    Load and return the markups file from the given path in a list
+    Inputs:
+      * seedFile: the seedFile to load
+    Ouputs:
+      * markups: the markups list containing the name, label and coordinate in RAS (Right, Anterior, Superior) coordinates of each label
+    """
+    markups = []
+    with open(seedFile, "r") as fp:
+        lines = fp.readlines()
+
+        for line in lines:
+            if "#" in line: # comment line
+                continue
+            tokens = line.replace(" ", "").split(";")
+            name = tokens[0]
+            point_ras = [float(tokens[1]), float(tokens[2]), float(tokens[3])]
+            label= int(tokens[4])
+            markups.append([name, point_ras, label])
+    return markups
+
+def getSeedsFromMarkups(markupsList, nbLabel):
+    """
+    Return a formatted markups list from the given markups list.
+    The background seeds have unique label because there using a unique mask 
+    Inputs:
+      * markupsList: the raw markups list
+      * nbLabel: the number of label to know which seed is a background seed
+    Ouputs: 
+      * seeds: the formatted markups list
+    """
+    seeds = []
+    i = 1
+    backGroundCount = 0
+    for markup in markupsList:
+        label = markup[2]
+        if markup[2] == nbLabel:
+            label += backGroundCount
+            backGroundCount += 1
+        seeds.append({"id": i, "label": label, "pos": markup[1]})
+        i += 1
+    return seeds
+
+def getSeedsByLabel(seeds):
+    """
+    Return a dict giving for each label the set of its seeds positions
+    """
+    seedsByLabel = {}
+    for seed in seeds:
+        pos = seed.get("pos")
+        seedsByLabel.setdefault(seed.get("label"), set()).add((int(pos[0]), int(pos[1]), int(pos[2])))
+    return seedsByLabel
+
+def getLabelledNeighbours(imgLabel, voxels):
+    """
+    Return the labelled voxels bordering the given voxels
+    Inputs:
+      * voxels: (n, 3) array of voxels [k, j, i]
+    Outputs:
+      * neighbours: list of the labelled voxels [k, j, i] among the neighbours of the given voxels
+    """
+    neighbours = []
+    for v in [(-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 0, -1), (0, 1, 0), (0, 0, 1)]:
+        q = voxels + np.array(v)
+        q = q[np.all((q >= 0) & (q < imgLabel.shape), axis=1)]
+        q = q[imgLabel[q[:, 0], q[:, 1], q[:, 2]] > 0]
+        neighbours += q.tolist()
+    return neighbours
+
+def getPredecessorSubtrees(imgPred, roots):
+    """
+    Return the voxels of the predecessors subtrees rooted at the given voxels, walked breadth first from the roots.
+    A voxel is a child of the neighbour it was reached from, see propagateHeap(). The roots predecessors are set to -1
+    so a root which is also in the subtree of another root is only walked once
+    Inputs:
+      * imgPred: the predecessors image
+      * roots: (n, 3) array of voxels [k, j, i]
+    Outputs:
+      * subtrees: (m, 3) array of the voxels of the subtrees, the roots included
+    """
+    voisins = [(-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 0, -1), (0, 1, 0), (0, 0, 1)]
+    level = np.asarray(roots, dtype=np.int64).reshape(-1, 3)
+    imgPred[level[:, 0], level[:, 1], level[:, 2]] = -1
+    levels = [level]
+    while len(level):
+        children = []
+        for n, v in enumerate(voisins):
+            q = level + np.array(v)
+            q = q[np.all((q >= 0) & (q < imgPred.shape), axis=1)]
+            children.append(q[imgPred[q[:, 0], q[:, 1], q[:, 2]] == n])
+        level = np.concatenate(children)
+        levels.append(level)
+    return np.concatenate(levels)
+
+def getRelabelledChildren(imgLabel, imgPred, voxels):
+    """
+    Return the children of the given voxels whose label is not the one of their predecessor anymore, see propagateHeap()
+    Inputs:
+      * voxels: (n, 3) array of voxels [k, j, i]
+    Outputs:
+      * children: (m, 3) array of voxels [k, j, i]
+    """
+    voisins = [(-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 0, -1), (0, 1, 0), (0, 0, 1)]
+    children = []
+    for n, v in enumerate(voisins):
+        q = voxels + np.array(v)
+        inVolume = np.all((q >= 0) & (q < imgLabel.shape), axis=1)
+        p, q = voxels[inVolume], q[inVolume]
+        isChild = (imgPred[q[:, 0], q[:, 1], q[:, 2]] == n) & (imgLabel[q[:, 0], q[:, 1], q[:, 2]] != imgLabel[p[:, 0], p[:, 1], p[:, 2]])
+        children.append(q[isChild])
+    return np.concatenate(children)
+
+def propagateRelabelling(engine, voxels, R, masks, frontier, roots, imgLabel, imgDist, imgPred, distance, gamma, threshold, imageSpacing,
+    stats=None, progress=None, edgeCosts=None):
+    """
+    Propagate the labels again from the frontier voxels after clearing the predecessors subtrees of the roots.
+    A voxel taken by another label does not relay the paths of its previous label anymore: its children keeping the previous label
+    are cleared with their subtrees and propagated again, until the labels of all the voxels are the ones of their predecessors
+    Inputs:
+      * frontier: list of the labelled voxels [k, j, i] to propagate from
+      * roots: (n, 3) array of the voxels [k, j, i] whose subtrees are cleared first
+      * imgLabel, imgDist, imgPred: the labels, distances and predecessors images, updated in place
+      * stats: optional dict filled with the engine counters added over the propagations
+    Outputs:
+      * invalidatedVoxels: number of voxels cleared
+    """
+    invalidatedVoxels = 0
+    while len(roots) or frontier:
+        cleared = getPredecessorSubtrees(imgPred, roots)
+        imgLabel[cleared[:, 0], cleared[:, 1], cleared[:, 2]] = 0
+        imgDist[cleared[:, 0], cleared[:, 1], cleared[:, 2]] = distance
+        imgPred[cleared[:, 0], cleared[:, 1], cleared[:, 2]] = -1
+        invalidatedVoxels += len(cleared)
+
+        # The intact voxels bordering the cleared voxels (and the given frontier) propagate again from their distance
+        frontier += getLabelledNeighbours(imgLabel, cleared)
+        if not frontier:
+            break
+        frontier = np.unique(np.array(frontier), axis=0).tolist()
+        previousLabel = imgLabel.copy()
+        roundStats = {} if stats is not None else None
+        propagate(engine, voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, roundStats, progress,
+            edgeCosts, imgPred)
+        mergeEngineCounters(stats, roundStats)
+
+        roots = getRelabelledChildren(imgLabel, imgPred, np.argwhere(imgLabel != previousLabel))
+        frontier = []
+    return invalidatedVoxels
+
+def updateSegmentation(voxels, imageSpacing, R, seeds, previousSeeds, nbLabel, marginMask, distance, gamma, threshold,
+    imgLabel, imgDist, engine="heap", stats=None, progress=None, edgeCosts=None, imgPred=None):
+    """
+    Update the segmentation of previousSeeds after seeds were added, moved or removed instead of computing it from scratch.
+    A label that only gained seeds inside its mask is propagated from its new seeds, the previous distances being the upper bound.
+    A label that lost seeds or whose mask changed is cleared, then propagated again from its seeds and from the voxels
+    of the other labels bordering the cleared region.
+    A voxel taken by another label may have relayed the paths of its previous label to voxels out of the mask of the new one:
+    these voxels are cleared and propagated again, see propagateRelabelling(). Without imgPred they cannot be found,
+    so the seeds are segmented from scratch in imgLabel and imgDist (engines out of the predecessorEngines).
+    The result equals the segmentation of the seeds from scratch only when marginMask, distance, gamma, threshold, the engine,
+    the voxels and R are the ones of the previous segmentation: the kept distances are used as upper bounds, so they must be
+    distances of the same edges costs, masks and thresholds. This is not checked, the caller keeps the previous parameters
+    with imgDist and segments from scratch when they differ (see RegularizedFastMarchingLogic.computeRun())
+    Inputs:
+      * imageSpacing: the voxels spacing, see segmentVoxels()
+      * previousSeeds: the seeds used to compute imgLabel and imgDist
+      * imgLabel, imgDist: the labels (background seeds labels not merged) and distances images of the previous segmentation, updated in place
+      * imgPred: optional predecessors image of the previous segmentation, updated in place, see propagateHeap()
+    Outputs:
+      * imgLabel, imgDist: same outputs as segmentation()
+    """
+    masks = getMasks(voxels, seeds, nbLabel, marginMask)
+    previousMasks = getMasks(voxels, previousSeeds, nbLabel, marginMask)
+    seedsByLabel = getSeedsByLabel(seeds)
+    previousSeedsByLabel = getSeedsByLabel(previousSeeds)
+
+    if imgPred is None:
+        imgLabel.fill(0)
+        imgDist.fill(distance)
+        frontier = []
+        for seed in seeds:
+            pos = tuple(seed.get("pos"))
+            frontier.append(list(pos))
+            imgDist[pos] = 0
+            imgLabel[pos] = seed.get("label")
+        propagate(engine, voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats, progress, edgeCosts)
+        return np.clip(imgLabel, 0, nbLabel), imgDist
+
+    # Find the labels to clear and the seeds to propagate from
+    clearedVoxels = []
+    newSeeds = []
+    for label in set(seedsByLabel) | set(previousSeedsByLabel):
+        currentPositions = seedsByLabel.get(label, set())
+        previousPositions = previousSeedsByLabel.get(label, set())
+        maskChanged = label > len(masks) or label > len(previousMasks) or not np.array_equal(masks[label - 1], previousMasks[label - 1])
+
+        if previousPositions - currentPositions or maskChanged:
+            # This label's region only lies in its previous mask
+            if label <= len(previousMasks):
+                lo, hi = previousMasks[label - 1]
+                box = (slice(lo[0], hi[0] + 1), slice(lo[1], hi[1] + 1), slice(lo[2], hi[2] + 1))
+                clearedVoxels.append(np.argwhere(imgLabel[box] == label) + np.asarray(lo))
+            newSeeds += [(pos, label) for pos in currentPositions]
+        else:
+            newSeeds += [(pos, label) for pos in currentPositions - previousPositions]
+
+    # Clear the regions, the labelled voxels bordering them propagate again from their current distance
+    frontier = []
+    if clearedVoxels:
+        cleared = np.concatenate(clearedVoxels)
+        imgLabel[cleared[:, 0], cleared[:, 1], cleared[:, 2]] = 0
+        imgDist[cleared[:, 0], cleared[:, 1], cleared[:, 2]] = distance
+        imgPred[cleared[:, 0], cleared[:, 1], cleared[:, 2]] = -1
+        frontier += getLabelledNeighbours(imgLabel, cleared)
+
+    for pos, label in newSeeds:
+        frontier.append(list(pos))
+        imgDist[pos] = 0
+        imgLabel[pos] = label
+        imgPred[pos] = -1
+
+    propagateRelabelling(engine, voxels, R, masks, frontier, np.empty((0, 3), dtype=np.int64), imgLabel, imgDist, imgPred, distance,
+        gamma, threshold, imageSpacing, stats, progress, edgeCosts)
+    return np.clip(imgLabel, 0, nbLabel), imgDist
+
+def updateSegmentationThreshold(voxels, imageSpacing, R, seeds, nbLabel, marginMask, distance, gamma, threshold, previousThreshold,
+    imgLabel, imgDist, imgPred, engine="heap", stats=None, progress=None, edgeCosts=None):
+    """
+    Update the segmentation after the thresholds changed instead of computing it from scratch, using the predecessors recorded
+    by the previous segmentation. The seeds and the other parameters must be the ones of the previous segmentation.
+    The labelled voxels excluded by the new thresholds are cleared with their predecessors subtrees: the shortest paths of the other
+    voxels do not cross an excluded voxel, so their distances stay exact. The labels are then propagated again from the labelled
+    voxels bordering the cleared voxels and the voxels included by the new thresholds, so the propagation work is proportional
+    to the changed region instead of the volume. A voxel taken by another label does not relay the paths of its previous label
+    anymore: its children keeping the previous label are cleared with their subtrees and propagated again, until the labels
+    of all the voxels are the ones of their predecessors.
+    A gamma change modifies all the edges costs and needs a segmentation from scratch
+    Inputs:
+      * imageSpacing: the voxels spacing, see segmentVoxels()
+      * threshold, previousThreshold: the new thresholds and the ones of the previous segmentation
+      * imgLabel, imgDist, imgPred: the labels (background seeds labels not merged), distances and predecessors images
+        of the previous segmentation, recorded by one of the predecessorEngines, updated in place
+      * stats: optional dict filled with the engine counters and the number of invalidatedVoxels
+    Outputs:
+      * imgLabel, imgDist: same outputs as segmentation()
+    """
+    masks = getMasks(voxels, seeds, nbLabel, marginMask)
+    inThreshold = (voxels >= threshold[0]) & (voxels <= threshold[1])
+    included = np.argwhere(inThreshold & ((voxels < previousThreshold[0]) | (voxels > previousThreshold[1])))
+
+    # Labelled voxels excluded by the new thresholds, the seeds keep their label whatever their value
+    excluded = np.argwhere((imgLabel > 0) & ~inThreshold)
+    seedsPositions = np.array([seed.get("pos") for seed in seeds], dtype=np.int64).reshape(-1, 1, 3)
+    excluded = excluded[~np.any(np.all(excluded == seedsPositions, axis=2), axis=0)]
 
-    print("- Segmentation time :   %s seconds -" % (time.time() - start_time))
-    return imgLabel, imgDist
\ No newline at end of file
+    # The labelled voxels bordering the included voxels propagate into them
+    frontier = getLabelledNeighbours(imgLabel, included)
+    invalidatedVoxels = propagateRelabelling(engine, voxels, R, masks, frontier, excluded, imgLabel, imgDist, imgPred, distance, gamma,
+        threshold, imageSpacing, stats, progress, edgeCosts)
+    if stats is not None:
+        stats["invalidatedVoxels"] = invalidatedVoxels
+    return np.clip(imgLabel, 0, nbLabel), imgDist
\ No newline at end of file
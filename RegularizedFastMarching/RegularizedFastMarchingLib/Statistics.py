@@ -0,0 +1,113 @@
+import numpy as np
+
+from RegularizedFastMarchingLib.Segmentation import getLabelType
+
+
+def getLabelStatistics(voxels, imgLabel, labelNames, spacing, percentiles=()):
+    """
+    Compute the intensity statistics of each label with array reductions over the whole image, whatever the number of labels
+    Inputs:
+      * voxels: the segmented image
+      * imgLabel: the labels image, 0 being the unlabelled voxels
+      * labelNames: the name of each label, labelNames[0] being the name of the label 1
+      * spacing: the voxels spacing in mm
+      * percentiles: percentiles of the intensities to compute, between 0 and 100
+    Outputs:
+      * header: the columns names
+      * rows: for each label holding voxels, its name, label, number of voxels, volume in mm3, minimum, maximum, mean,
+        sample standard deviation and percentiles
+    """
+    nbLabel = len(labelNames)
+    labels = imgLabel.ravel()
+    values = voxels.ravel()
+    counts = np.bincount(labels, minlength=nbLabel + 1)[:nbLabel + 1]
+    present = np.flatnonzero(counts[1:]) + 1
+
+    # Sums are shifted by the global mean so the sum of squares does not lose precision
+    shift = float(values.mean()) if values.size else 0.0
+    shifted = values.astype(np.float64) - shift
+    sums = np.bincount(labels, weights=shifted, minlength=nbLabel + 1)[:nbLabel + 1]
+    squares = np.bincount(labels, weights=shifted * shifted, minlength=nbLabel + 1)[:nbLabel + 1]
+    del shifted
+
+    # Extremums in the type of the voxels, the fast path of ufunc.at
+    if np.issubdtype(values.dtype, np.integer):
+        highest, lowest = np.iinfo(values.dtype).max, np.iinfo(values.dtype).min
+    else:
+        highest, lowest = np.inf, -np.inf
+    minimums = np.full(nbLabel + 1, highest, dtype=values.dtype)
+    maximums = np.full(nbLabel + 1, lowest, dtype=values.dtype)
+    np.minimum.at(minimums, labels, values)
+    np.maximum.at(maximums, labels, values)
+
+    safeCounts = np.maximum(counts, 1)
+    means = sums / safeCounts
+    variances = (squares - sums * means) / np.maximum(counts - 1, 1)
+    deviations = np.sqrt(np.maximum(variances, 0))
+
+    # Percentiles: the voxels are grouped by label with a stable sort (a radix sort for 8 and 16 bits labels),
+    # then each label's intensities are partitioned by np.percentile
+    percentileValues = {}
+    if len(percentiles) > 0:
+        order = np.argsort(labels.astype(getLabelType(nbLabel), copy=False), kind="stable")
+        ends = np.cumsum(np.bincount(labels, minlength=nbLabel + 1))
+        for label in present:
+            percentileValues[label] = np.percentile(values[order[ends[label - 1]:ends[label]]], percentiles)
+
+    header = ["Segment", "Label", "Number of voxels", "Volume [mm3]", "Minimum", "Maximum", "Mean", "Standard deviation"]
+    header += ["Percentile " + str(p) for p in percentiles]
+    voxelVolume = float(np.prod(spacing))
+    rows = []
+    for label in present:
+        row = [labelNames[label - 1], int(label), int(counts[label]), float(counts[label] * voxelVolume), float(minimums[label]),
+            float(maximums[label]), float(means[label] + shift), float(deviations[label])]
+        rows.append(row + [float(v) for v in percentileValues.get(label, [])])
+    return header, rows
+
+
+def getVolumeStatistics(voxels, bins=256, chunkSize=1 << 17):
+    """
+    Return the minimum, maximum and histogram of the intensities of a volume.
+    The integer volumes of 16 bits or less are counted in a single np.bincount pass, with a bin by intensity.
+    The other volumes are read by chunks small enough to stay in the CPU cache while their minimum and maximum are computed,
+    then their histogram is counted
+    Inputs:
+      * bins: number of bins of the histogram of the other volumes
+    Outputs:
+      * statistics: dict with the "min" and "max" intensities, the "histogram" counts and the "binEdges" of its bins
+    """
+    values = voxels.ravel()
+    if values.dtype.kind in "iu" and values.dtype.itemsize <= 2:
+        # The signed intensities are counted as unsigned ones, the negative ones then come after the positive ones
+        bits = 8 * values.dtype.itemsize
+        counts = np.bincount(values.view(np.dtype("u" + str(values.dtype.itemsize))), minlength=1 << bits)
+        offset = 0
+        if values.dtype.kind == "i":
+            counts = np.roll(counts, 1 << (bits - 1))
+            offset = -(1 << (bits - 1))
+        present = np.flatnonzero(counts)
+        lo, hi = (int(present[0]), int(present[-1])) if present.size else (-offset, -offset)
+        return {"min": lo + offset, "max": hi + offset, "histogram": counts[lo:hi + 1], "binEdges": np.arange(lo + offset, hi + offset + 2)}
+
+    minimum, maximum = values[:1].min(), values[:1].max()
+    for start in range(0, values.size, chunkSize):
+        chunk = values[start:start + chunkSize]
+        minimum = min(minimum, chunk.min())
+        maximum = max(maximum, chunk.max())
+    binEdges = np.linspace(float(minimum), float(maximum), bins + 1)
+    counts = np.zeros(bins, dtype=np.int64)
+    for start in range(0, values.size, chunkSize):
+        counts += np.histogram(values[start:start + chunkSize], binEdges)[0]
+    return {"min": minimum.item(), "max": maximum.item(), "histogram": counts, "binEdges": binEdges}
+
+
+def getHistogramFraction(statistics, value, above=False):
+    """
+    Return the fraction of the voxels whose intensity is below value, or above value, counted from the bins of the volume histogram
+    that are entirely below or above it (exact for the histograms with a bin by intensity)
+    Inputs:
+      * statistics: the volume statistics, see getVolumeStatistics()
+    """
+    counts, binEdges = statistics["histogram"], statistics["binEdges"]
+    selected = binEdges[:-1] > value if above else binEdges[1:] <= value
+    return float(counts[selected].sum()) / max(int(counts.sum()), 1)
@@ -0,0 +1,135 @@
+import numpy as np
+import itertools
+import concurrent.futures
+
+from RegularizedFastMarchingLib.Instrumentation import mergeEngineCounters
+
+
+def getSweepVariants(marginMasks, distances, gammas, thresholds):
+    """
+    Return the parameters of each variant of a sweep, the grid of all the given values
+    Outputs:
+      * parameters: list of dicts with the marginMask, distance, gamma and threshold of each variant,
+        the distances varying the fastest
+    """
+    return [{"marginMask": marginMask, "distance": distance, "gamma": gamma, "threshold": list(threshold)}
+        for marginMask, gamma, threshold, distance in itertools.product(marginMasks, gammas, thresholds, distances)]
+
+
+def getSweepVariantName(parameters):
+    """
+    Return a short name of a sweep variant, see getSweepVariants()
+    """
+    return "m{}_d{}_g{}_t{}-{}".format(parameters["marginMask"], parameters["distance"], parameters["gamma"],
+        parameters["threshold"][0], parameters["threshold"][1])
+
+
+def segmentSweepRun(voxels, imageSpacing, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, R, engine,
+    edgeCosts=None, progress=None):
+    """
+    Segment one run of a sweep, run by the pool workers.
+    Return the labels, the distances (float64, so the distances cutoffs are exact) and the engine counters
+    """
+    from RegularizedFastMarchingLib.Segmentation import segmentVoxels, getLabelType
+    stats = {}
+    imgLabel = np.zeros(voxels.shape, dtype=getLabelType(max([seed.get("label") for seed in seeds] + [nbLabel])))
+    imgLabel, imgDist = segmentVoxels(voxels, imageSpacing, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, R=R,
+        imgLabel=imgLabel, engine=engine, stats=stats, progress=progress, edgeCosts=edgeCosts)
+    return imgLabel, imgDist, stats
+
+
+def sweepSegmentation(voxels, imageSpacing, seeds, nbLabel, marginMasks, distances, gammas, regDiameter, thresholds, R=None,
+    engine=None, stats=None, progress=None, maxWorkers=None, useProcesses=None, shareEdgeCosts=True):
+    """
+    Segment the volume for each combination of the given parameters values, sharing the regularization map between all the runs.
+    A voxel is labelled by a run stopped at the distance d when its distance is smaller than d, so a single run with the largest
+    distance gives the labels of all the distances by thresholding its distances image.
+    The runs of the other parameters (masks margins, gammas and thresholds) are computed in parallel.
+    Inputs:
+      * marginMasks, distances, gammas, thresholds: the values of each parameter, thresholds being [min, max] pairs
+      * R: the regularization map, computed from regDiameter when not given
+      * engine: engine of each run, "compiled" when numba is installed, "heap" otherwise
+      * stats: optional dict filled with the number of runs and the engine counters added over the runs
+      * progress: optional callback progress(value, maximum), value adding the progress of all the runs with threads
+        or counting the voxels of the finished runs with processes. When it raises SegmentationCancelled,
+        the runs not started yet are cancelled
+      * maxWorkers, useProcesses: the runs pool, see propagateParallel()
+      * shareEdgeCosts: compute once the edges costs of each gamma shared by several runs, see getEdgeCosts(). Not used with processes
+    Outputs:
+      * labels: array of shape (variants,) + voxels.shape of the smallest unsigned type holding the labels,
+        labels[v] being the labels image of the variant v, the background seeds labels being merged
+      * parameters: the parameters of each variant, see getSweepVariants()
+    """
+    from RegularizedFastMarchingLib.CompiledPropagation import isCompiled
+    from RegularizedFastMarchingLib.Segmentation import getLabelType, getEdgeCosts
+    if engine is None:
+        engine = "compiled" if isCompiled else "heap"
+    if useProcesses is None:
+        useProcesses = engine not in ("compiled", "parallel", "tiled")
+    if R is None:
+        from RegularizedFastMarchingLib.Regularization import regularization
+        R = regularization(voxels, int(regDiameter/2))
+
+    parameters = getSweepVariants(marginMasks, distances, gammas, thresholds)
+    runs = list(itertools.product(marginMasks, gammas, thresholds))
+    labels = np.zeros((len(parameters),) + voxels.shape, dtype=getLabelType(nbLabel))
+    sortedDistances = sorted(distances)
+    if stats is not None:
+        stats["sweepRuns"] = len(runs)
+        stats["sweepVariants"] = len(parameters)
+
+    # Edges costs of the gammas used by several runs, shared by the threads
+    edgeCosts = {}
+    if shareEdgeCosts and not useProcesses and len(runs) > len(gammas):
+        for gamma in gammas:
+            edgeCosts[gamma] = getEdgeCosts(voxels, R, gamma, imageSpacing)
+
+    # The threads report the progress of their run, called from several threads
+    runsProgress = [0] * len(runs)
+
+    def getRunProgress(r):
+        def runProgress(value, maximum):
+            runsProgress[r] = value
+            progress(sum(runsProgress), voxels.size * len(runs))
+        return runProgress if progress is not None and not useProcesses else None
+
+    executorClass = concurrent.futures.ProcessPoolExecutor if useProcesses else concurrent.futures.ThreadPoolExecutor
+    with executorClass(max_workers=maxWorkers) as executor:
+        futures = [executor.submit(segmentSweepRun, voxels, imageSpacing, [dict(seed) for seed in seeds], nbLabel, marginMask,
+            sortedDistances[-1], gamma, regDiameter, threshold, R, engine, edgeCosts.get(gamma), getRunProgress(r))
+            for r, (marginMask, gamma, threshold) in enumerate(runs)]
+
+        for r, future in enumerate(futures):
+            try:
+                if progress is not None and useProcesses:
+                    progress(r * voxels.size, voxels.size * len(runs))
+                runLabel, runDist, runStats = future.result()
+            except BaseException:
+                for pending in futures:
+                    pending.cancel()
+                raise
+            mergeEngineCounters(stats, runStats)
+            # The variants of a run are consecutive, in the distances order
+            for d, distance in enumerate(distances):
+                np.multiply(runLabel, runDist < distance, out=labels[r * len(distances) + d], casting="unsafe")
+
+    return labels, parameters
+
+
+def getSweepSummary(labels, parameters, labelNames):
+    """
+    Return a table comparing the variants of a sweep: their parameters and their number of voxels by label
+    Inputs:
+      * labels, parameters: the sweep results, see sweepSegmentation()
+      * labelNames: the name of each label, labelNames[0] being the name of the label 1
+    Outputs:
+      * header: the columns names
+      * rows: for each variant, its name, mask margin, distance, gamma, thresholds and voxels count of each label
+    """
+    header = ["Variant", "Mask margin", "Distance", "Gamma", "Min threshold", "Max threshold"] + list(labelNames)
+    rows = []
+    for variantLabels, variantParameters in zip(labels, parameters):
+        counts = np.bincount(variantLabels.ravel(), minlength=len(labelNames) + 1)[1:len(labelNames) + 1]
+        rows.append([getSweepVariantName(variantParameters), variantParameters["marginMask"], variantParameters["distance"],
+            variantParameters["gamma"], variantParameters["threshold"][0], variantParameters["threshold"][1]] + counts.tolist())
+    return header, rows
@@ -0,0 +1,357 @@
+import numpy as np
+import os.path
+import heapq
+
+from RegularizedFastMarchingLib.Instrumentation import setEngineCounters
+
+# Shape of the tiles loaded in memory at once
+tileShape = (64, 64, 64)
+
+# Types of the NRRD files read as memory maps
+nrrdTypes = {"int8": "i1", "signed char": "i1", "uint8": "u1", "unsigned char": "u1", "uchar": "u1",
+    "int16": "i2", "short": "i2", "signed short": "i2", "uint16": "u2", "unsigned short": "u2", "ushort": "u2",
+    "int32": "i4", "int": "i4", "signed int": "i4", "uint32": "u4", "unsigned int": "u4", "uint": "u4",
+    "int64": "i8", "longlong": "i8", "uint64": "u8", "ulonglong": "u8", "float": "f4", "double": "f8"}
+
+
+def getTiles(shape, tileShape=tileShape):
+    """
+    Return the boxes (tuples of slices) of the tiles splitting an image of the given shape, in the storage order
+    """
+    tiles = []
+    for k in range(0, shape[0], tileShape[0]):
+        for j in range(0, shape[1], tileShape[1]):
+            for i in range(0, shape[2], tileShape[2]):
+                tiles.append((slice(k, min(k + tileShape[0], shape[0])), slice(j, min(j + tileShape[1], shape[1])),
+                    slice(i, min(i + tileShape[2], shape[2]))))
+    return tiles
+
+
+def getHaloBox(box, shape, halo):
+    """
+    Return the box grown by halo voxels along each axis, clipped to the image, and its lower corner
+    """
+    lo = np.array([max(s.start - halo, 0) for s in box])
+    hi = np.array([min(s.stop + halo, size) for s, size in zip(box, shape)])
+    return tuple(slice(l, h) for l, h in zip(lo, hi)), lo
+
+
+def memmapNrrd(fileName):
+    """
+    Open the voxels of a raw encoded NRRD file as a read only memory map, without loading them
+    Outputs:
+      * voxels: memory map indexed [k, j, i]
+      * ijkToLps: 4x4 matrix transforming the (i, j, k) indices to the LPS (Left, Posterior, Superior) coordinates
+    """
+    fields = {}
+    with open(fileName, "rb") as fp:
+        if not fp.readline().startswith(b"NRRD"):
+            raise ValueError(fileName + " is not a NRRD file")
+        for line in iter(fp.readline, b""):
+            line = line.decode("ascii").strip()
+            if line == "":
+                break
+            if line.startswith("#") or ":" not in line:
+                continue
+            name, value = line.split(":", 1)
+            fields[name.strip()] = value.lstrip("=").strip()
+        offset = fp.tell()
+
+    if fields.get("encoding") != "raw" or int(fields.get("dimension", 0)) != 3:
+        raise ValueError(fileName + ": only the raw encoded 3D NRRD files can be read as memory maps")
+    dtype = np.dtype(("<" if fields.get("endian", "little") == "little" else ">") + nrrdTypes[fields["type"]])
+    sizes = [int(s) for s in fields["sizes"].split()]
+    dataFile = fields.get("data file", fields.get("datafile"))
+    if dataFile is not None:
+        fileName, offset = os.path.join(os.path.dirname(fileName), dataFile), 0
+    voxels = np.memmap(fileName, dtype=dtype, mode="r", offset=offset, shape=(sizes[2], sizes[1], sizes[0]))
+
+    ijkToLps = np.eye(4)
+    directions = fields.get("space directions", "(1,0,0) (0,1,0) (0,0,1)").replace(")", "").split("(")[1:]
+    for c, direction in enumerate(directions):
+        ijkToLps[:3, c] = [float(v) for v in direction.split(",")]
+    ijkToLps[:3, 3] = [float(v) for v in fields.get("space origin", "(0,0,0)").strip("()").split(",")]
+    if fields.get("space") in ("right-anterior-superior", "RAS"):
+        ijkToLps[:2] *= -1
+    return voxels, ijkToLps
+
+
+def createTiledArrays(folder, shape, labelType, distance, distanceType=np.float32):
+    """
+    Create the labels, distances and settled voxels images as memory mapped .npy files, filled tile by tile
+    Outputs:
+      * imgLabel: labels memory map filled with 0
+      * imgDist: distances memory map filled with distance
+      * settled: uint8 memory map filled with 0, see propagateTiled()
+    """
+    os.makedirs(folder, exist_ok=True)
+    imgLabel = np.lib.format.open_memmap(os.path.join(folder, "labels.npy"), mode="w+", dtype=labelType, shape=tuple(shape))
+    imgDist = np.lib.format.open_memmap(os.path.join(folder, "distances.npy"), mode="w+", dtype=distanceType, shape=tuple(shape))
+    settled = np.lib.format.open_memmap(os.path.join(folder, "settled.npy"), mode="w+", dtype=np.uint8, shape=tuple(shape))
+    for box in getTiles(shape):
+        imgDist[box] = distance
+    return imgLabel, imgDist, settled
+
+
+def regularizationTiled(voxels, StructuringElementRadius, folder, outputType=None):
+    """
+    Compute the regularization map tile by tile in a memory mapped .npy file, each tile with a halo covering the structuring element
+    Outputs:
+      * R: memory map equal to regularization(voxels, StructuringElementRadius)
+    """
+    from RegularizedFastMarchingLib.Regularization import morphologicalGradient
+    os.makedirs(folder, exist_ok=True)
+    R = np.lib.format.open_memmap(os.path.join(folder, "regularization.npy"), mode="w+", dtype=outputType or voxels.dtype,
+        shape=voxels.shape)
+    for box in getTiles(voxels.shape):
+        haloBox, lo = getHaloBox(box, voxels.shape, StructuringElementRadius)
+        gradient = morphologicalGradient(np.array(voxels[haloBox]), StructuringElementRadius, outputType)
+        R[box] = gradient[tuple(slice(s.start - l, s.stop - l) for s, l in zip(box, lo))]
+    return R
+
+
+def getRangeTiled(voxels):
+    """
+    Return the minimum and maximum of the voxels, read tile by tile
+    """
+    ranges = [(voxels[box].min(), voxels[box].max()) for box in getTiles(voxels.shape)]
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+
+class Tile:
+    """
+    Tile of the images loaded in memory with a halo of one voxel, in the flat buffers of the compiled heap kernel.
+    Its heap is kept while the tile is loaded, so the propagation of the tile can be resumed
+    """
+
+    def __init__(self, key, shape, tileShape, maskLo, maskHi):
+        """
+        Inputs:
+          * key: the tile index along each axis
+          * shape: the images shape
+          * maskLo, maskHi: the masks bounds in the images, see CompiledPropagation.getMasksBounds()
+        """
+        self.key = key
+        self.box = tuple(slice(t * s, min((t + 1) * s, size)) for t, s, size in zip(key, tileShape, shape))
+        self.haloBox, self.lo = getHaloBox(self.box, shape, 1)
+        self.shape = np.array([s.stop - s.start for s in self.haloBox], dtype=np.int64)
+        self.strides = np.array([self.shape[1] * self.shape[2], self.shape[2], 1], dtype=np.int64)
+        self.interior = tuple(slice(s.start - l, s.stop - l) for s, l in zip(self.box, self.lo))
+        # The masks are clipped to the tile, the kernel expects them inside the image
+        self.maskLo = np.maximum(maskLo - self.lo, 0)
+        self.maskHi = np.minimum(maskHi - self.lo, self.shape - 1)
+        halo = np.ones(self.shape, dtype=bool)
+        halo[self.interior] = False
+        self.haloIndex = np.flatnonzero(halo)
+
+    def load(self, voxels, R, imgLabel, imgDist, settled, labelType):
+        self.voxels = np.ascontiguousarray(voxels[self.haloBox], dtype=np.float32).ravel()
+        self.R = np.ascontiguousarray(np.trunc(R[self.haloBox]), dtype=np.float32).ravel()
+        self.labels = np.array(imgLabel[self.haloBox], dtype=labelType).ravel()
+        self.dist = np.array(imgDist[self.haloBox]).ravel()
+        self.settled = np.array(settled[self.haloBox], dtype=np.uint8).ravel()
+        # The halo voxels belong to the neighbour tiles, they are only updated to send their distance decreases to their tile
+        self.settled[self.haloIndex] = 2
+        self.haloDist = self.dist[self.haloIndex]
+        self.heapDist = np.empty(1024)
+        self.heapOrder = np.empty(1024, dtype=np.int64)
+        self.heapIndex = np.empty(1024, dtype=np.int64)
+        # Heap size, push count, settled voxels, relaxations and popped entries
+        self.state = np.zeros(5, dtype=np.int64)
+
+    def store(self, imgLabel, imgDist, settled):
+        """
+        Write the tile back, return the voxels left in its heap in image coordinates
+        """
+        imgLabel[self.box] = self.labels.reshape(self.shape)[self.interior]
+        imgDist[self.box] = self.dist.reshape(self.shape)[self.interior]
+        settled[self.box] = self.settled.reshape(self.shape)[self.interior]
+        left = np.unique(self.heapIndex[:self.state[0]])
+        left = left[self.settled[left] == 0]
+        return np.stack(np.unravel_index(left, self.shape), axis=1) + self.lo
+
+    def push(self, points, distances, labels):
+        """
+        Push the given voxels (image coordinates) in the heap when their distance is not greater than the tile one
+        """
+        from RegularizedFastMarchingLib.CompiledPropagation import heapPush
+        local = points - self.lo
+        indices = local[:, 0] * self.strides[0] + local[:, 1] * self.strides[1] + local[:, 2]
+        for q, d, label in zip(indices.tolist(), distances.tolist(), labels.tolist()):
+            if d > self.dist[q] or (self.settled[q] and d == self.dist[q]):
+                continue
+            # A settled voxel reached with a smaller distance is settled again
+            self.settled[q] = 0
+            self.dist[q] = d
+            self.labels[q] = label
+            if self.state[0] + 1 > self.heapDist.shape[0]:
+                self.growHeap()
+            self.state[0] = heapPush(self.heapDist, self.heapOrder, self.heapIndex, self.state[0], self.dist[q], self.state[1], q)
+            self.state[1] += 1
+
+    def growHeap(self):
+        self.heapDist = np.concatenate((self.heapDist, np.empty_like(self.heapDist)))
+        self.heapOrder = np.concatenate((self.heapOrder, np.empty_like(self.heapOrder)))
+        self.heapIndex = np.concatenate((self.heapIndex, np.empty_like(self.heapIndex)))
+
+    def getNextDistance(self):
+        return self.heapDist[0] if self.state[0] > 0 else np.inf
+
+    def run(self, gamma, threshold, deltas, frontierHistogram, maxDistance):
+        """
+        Settle the voxels of the tile up to maxDistance.
+        Return the halo voxels whose distance decreased, in image coordinates, with their distances and labels
+        """
+        from RegularizedFastMarchingLib.CompiledPropagation import propagateHeapKernel
+        while propagateHeapKernel(self.voxels, self.R, self.labels, self.dist, self.settled, self.maskLo, self.maskHi,
+                self.shape, self.strides, deltas, float(gamma), float(threshold[0]), float(threshold[1]),
+                self.heapDist, self.heapOrder, self.heapIndex, self.state, frontierHistogram, 1 << 62, maxDistance, True) == 2:
+            self.growHeap()
+        haloDist = self.dist[self.haloIndex]
+        decreased = haloDist < self.haloDist
+        self.haloDist = haloDist
+        index = self.haloIndex[decreased]
+        points = np.stack(np.unravel_index(index, self.shape), axis=1) + self.lo
+        return points, self.dist[index], self.labels[index]
+
+
+def propagateTiled(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None, progress=None,
+    settled=None, tileShape=tileShape, maxLoadedTiles=64, slack=0.05):
+    """
+    Fast marching tile by tile, only the tiles reached by the frontier being loaded in memory, so the images can be memory maps.
+    Each loaded tile has its own heap and settles its voxels up to the smallest distance of the other tiles heaps increased by slack,
+    the tile holding the smallest distance running next. The settled voxels later reached with a smaller distance from a neighbour tile
+    are settled again, with a null slack the voxels are settled in the same order as the heap engine.
+    The halo voxels whose distance decreased are pushed in the heap of their tile, or kept pending when their tile is not loaded.
+    The least recently run tiles are written back when more than maxLoadedTiles tiles are loaded, their heap entries becoming pending
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the engine counters added over the tiles, the number of tiles runs and loads
+      * progress: optional callback progress(settledVoxels, voxels) called after each tile run, see propagate()
+      * settled: uint8 image of the settled voxels, updated in place, allocated in memory when not given
+      * tileShape: shape of the tiles, without the halo
+      * maxLoadedTiles: number of tiles kept in memory, bounding the memory used whatever the images size
+      * slack: relative distance a tile runs ahead of the other tiles, a larger slack means less tiles runs but more voxels settled again
+    """
+    import collections
+    from RegularizedFastMarchingLib.CompiledPropagation import getMasksBounds
+    shape = np.array(voxels.shape)
+    tileShape = np.array(tileShape)
+    if settled is None:
+        settled = np.zeros(voxels.shape, dtype=np.uint8)
+    deltas = np.array([imageSpacing[0], imageSpacing[0], imageSpacing[1], imageSpacing[2], imageSpacing[1], imageSpacing[2]], dtype=np.float64)
+    maskLo, maskHi = getMasksBounds(masks)
+    labelType = imgLabel.dtype if imgLabel.itemsize <= 4 else np.int32
+
+    # Loaded tiles, least recently run first, voxels pending for the tiles not loaded,
+    # and queue of the tiles by smallest distance, the entries differing from queuedDistance being outdated
+    loaded = collections.OrderedDict()
+    pending = {}
+    queue = []
+    queuedDistance = {}
+    def schedule(key, distance):
+        if distance < queuedDistance.get(key, np.inf):
+            queuedDistance[key] = distance
+            heapq.heappush(queue, (distance, key))
+
+    counters = np.zeros(5, dtype=np.int64)
+    frontierHistogram = np.zeros(64, dtype=np.int64)
+    def send(points, distances, labels):
+        tiles = points // tileShape
+        for tile in np.unique(tiles, axis=0):
+            inTile = np.all(tiles == tile, axis=1)
+            key = tuple(int(t) for t in tile)
+            if key in loaded:
+                loaded[key].push(points[inTile], distances[inTile], labels[inTile])
+                schedule(key, float(loaded[key].getNextDistance()))
+            else:
+                pending.setdefault(key, []).append((points[inTile], distances[inTile], labels[inTile]))
+                schedule(key, float(distances[inTile].min()))
+
+    def isOutdated(entry):
+        return queuedDistance.get(entry[1]) != entry[0]
+
+    frontier = np.array(frontier, dtype=int).reshape(-1, 3)
+    index = tuple(frontier.T)
+    send(frontier, np.asarray(imgDist[index]), np.asarray(imgLabel[index]))
+
+    runs = loads = 0
+    while queue:
+        entry = heapq.heappop(queue)
+        if isOutdated(entry):
+            continue
+        key = entry[1]
+        del queuedDistance[key]
+        while queue and isOutdated(queue[0]):
+            heapq.heappop(queue)
+        horizon = queue[0][0] * (1 + slack) if queue else np.inf
+
+        if key not in loaded:
+            tile = Tile(key, shape, tileShape, maskLo, maskHi)
+            tile.load(voxels, R, imgLabel, imgDist, settled, labelType)
+            loads += 1
+            loaded[key] = tile
+            if len(loaded) > maxLoadedTiles:
+                evictedKey, evicted = loaded.popitem(last=False)
+                counters += evicted.state
+                left = evicted.store(imgLabel, imgDist, settled)
+                if len(left) > 0:
+                    send(left, np.asarray(imgDist[tuple(left.T)]), np.asarray(imgLabel[tuple(left.T)]))
+        tile = loaded[key]
+        loaded.move_to_end(key)
+        for points, distances, labels in pending.pop(key, []):
+            tile.push(points, distances, labels)
+
+        runs += 1
+        send(*tile.run(gamma, threshold, deltas, frontierHistogram, horizon))
+        if progress is not None:
+            progress(counters[2] + sum(t.state[2] for t in loaded.values()), voxels.size)
+        if tile.state[0] > 0:
+            schedule(key, float(tile.getNextDistance()))
+
+    for tile in loaded.values():
+        counters += tile.state
+        tile.store(imgLabel, imgDist, settled)
+    setEngineCounters(stats, counters[4], counters[1] - len(frontier), counters[3], counters[2], frontierHistogram)
+    if stats is not None:
+        stats["tileRuns"] = runs
+        stats["tileLoads"] = loads
+    return imgLabel, imgDist
+
+
+def segmentTiled(voxels, imageSpacing, seeds, nbLabel, marginMask, distance, gamma, regDiameter, threshold, folder, R=None,
+    stats=None, progress=None):
+    """
+    Out of core segmentation: same as segmentVoxels() with the tiled engine, but the regularization map, labels and distances images
+    are memory mapped .npy files of the given folder, so only the tiles being propagated are in memory.
+    The background seeds labels are merged in place
+    Inputs:
+      * voxels: the 3D image to segment, indexed [k, j, i], usually a memory map (see memmapNrrd())
+      * folder: folder receiving the regularization.npy, labels.npy, distances.npy and settled.npy files
+      * the other inputs are the ones of segmentVoxels()
+    Outputs:
+      * imgLabel, imgDist: the labels and distances memory maps
+    """
+    from RegularizedFastMarchingLib.Segmentation import getMasks, getLabelType, getPropagationBox
+    if R is None:
+        R = regularizationTiled(voxels, int(regDiameter/2), folder)
+    masks = getMasks(voxels, seeds, nbLabel, marginMask)
+    labelType = getLabelType(max([seed.get("label") for seed in seeds] + [nbLabel]))
+    imgLabel, imgDist, settled = createTiledArrays(folder, voxels.shape, labelType, distance)
+    frontier = []
+    for seed in seeds:
+        pos = tuple(seed.get("pos"))
+        frontier.append(list(pos))
+        imgDist[pos] = 0
+        imgLabel[pos] = seed.get("label")
+
+    box, masks, frontier = getPropagationBox(masks, frontier, imgLabel)
+    propagateTiled(voxels[box], R[box], masks, frontier, imgLabel[box], imgDist[box], gamma, threshold, imageSpacing, stats, progress,
+        settled[box])
+
+    for tile in getTiles(imgLabel.shape):
+        np.minimum(imgLabel[tile], nbLabel, out=imgLabel[tile])
+    imgLabel.flush()
+    imgDist.flush()
+    return imgLabel, imgDist
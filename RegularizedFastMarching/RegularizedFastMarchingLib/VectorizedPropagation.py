@@ -0,0 +1,105 @@
+import numpy as np
+
+from RegularizedFastMarchingLib.CompiledPropagation import voisins, getMasksBounds
+from RegularizedFastMarchingLib.Instrumentation import setEngineCounters
+
+
+def scatterMin(q, dist, label):
+    """
+    Keep a single candidate for each target voxel: the smallest distance, the smallest label on ties
+    Inputs:
+      * q, dist, label: the candidates target flat indices, distances and labels
+    Outputs:
+      * q, dist, label: the winning candidates, one for each distinct target voxel
+    """
+    order = np.lexsort((label, dist, q))
+    q, dist, label = q[order], dist[order], label[order]
+    first = np.ones(q.shape[0], dtype=bool)
+    first[1:] = q[1:] != q[:-1]
+    return q[first], dist[first], label[first]
+
+
+def propagateVectorized(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, imageSpacing, stats=None, progress=None,
+    edgeCosts=None):
+    """
+    Wavefront propagation where each iteration relaxes the whole frontier with array operations.
+    All the frontier voxels are relaxed from the distances of the previous iteration (Bellman-Ford),
+    the conflicting updates of a voxel are resolved by a sort based scatter-min.
+    The labels can differ from the fast marching engines near the masks borders: a voxel first reached by a label relays it
+    even after another label takes the voxel with a shorter distance, so the voxels out of the mask of the new label keep
+    the first one. With the benchmark masks margins, 99.6% to 100% of the voxels of the 32 voxels phantoms get the heap labels.
+    The labels also differ from the wavefront engine, whose iterations keep the first update of a voxel instead of the smallest:
+    89% to 97% of the voxels get its labels
+    Inputs:
+      * frontier: list of the voxels [k, j, i] to start from, their label and distance being already set
+      * imgLabel, imgDist: the labels and distances images, updated in place
+      * stats: optional dict filled with the engine counters, see setEngineCounters()
+      * progress: optional callback progress(reachedVoxels, voxels) called after each iteration, see propagate()
+      * edgeCosts: optional precomputed edges costs, see getEdgeCosts()
+    """
+    shape = voxels.shape
+    strides = np.array([shape[1] * shape[2], shape[2], 1], dtype=np.int64)
+    deltas = np.array([imageSpacing[0], imageSpacing[0], imageSpacing[1], imageSpacing[2], imageSpacing[1], imageSpacing[2]], dtype=np.float64)
+    maskLo, maskHi = getMasksBounds(masks)
+
+    # Flat buffers computed with the distances image precision, R is truncated like in getDistanceBetweenVoxel
+    voxelsFlat = np.ascontiguousarray(voxels, dtype=imgDist.dtype).ravel()
+    if edgeCosts is None:
+        regularizationTerm = np.square(np.trunc(np.ascontiguousarray(R, dtype=imgDist.dtype).ravel()))
+        regularizationTerm *= gamma
+    else:
+        edgeCostsFlat = np.ascontiguousarray(edgeCosts).reshape(-1, 6)
+    labelsFlat = np.ascontiguousarray(imgLabel).ravel()
+    distFlat = np.ascontiguousarray(imgDist).ravel()
+    inThreshold = (voxelsFlat >= threshold[0]) & (voxelsFlat <= threshold[1])
+
+    current = np.unique(np.array([int(p[0]) * strides[0] + int(p[1]) * strides[1] + int(p[2]) for p in frontier], dtype=np.int64))
+    iterations = pushes = relaxations = 0
+    frontierHistogram = [0] * 64
+    reached = np.zeros(distFlat.shape[0], dtype=bool) if stats is not None or progress is not None else None
+    reachedCount = 0
+    while current.size > 0:
+        iterations += 1
+        frontierHistogram[int(current.size).bit_length()] += 1
+        coordinates = np.stack(np.unravel_index(current, shape), axis=1)
+        labelP = labelsFlat[current]
+        distP = distFlat[current]
+        voxelP = voxelsFlat[current]
+        lo = maskLo[labelP - 1]
+        hi = maskHi[labelP - 1]
+
+        candidatesQ, candidatesDist, candidatesLabel = [], [], []
+        for n in range(6):
+            coordinatesQ = coordinates + voisins[n]
+            keep = np.all((coordinatesQ >= lo) & (coordinatesQ <= hi), axis=1)
+            q = coordinatesQ[keep] @ strides
+            keep[keep] = inThreshold[q]
+            q = q[inThreshold[q]]
+
+            if edgeCosts is None:
+                diff = voxelP[keep] - voxelsFlat[q]
+                dist = distP[keep] + np.sqrt(deltas[n] * (diff * diff + regularizationTerm[q])).astype(distFlat.dtype)
+            else:
+                dist = distP[keep] + edgeCostsFlat[current[keep], n].astype(distFlat.dtype)
+            improved = dist < distFlat[q]
+            relaxations += q.size
+            candidatesQ.append(q[improved])
+            candidatesDist.append(dist[improved])
+            candidatesLabel.append(labelP[keep][improved])
+
+        q, dist, label = scatterMin(np.concatenate(candidatesQ), np.concatenate(candidatesDist), np.concatenate(candidatesLabel))
+        distFlat[q] = dist
+        labelsFlat[q] = label
+        current = q
+        pushes += q.size
+        if reached is not None:
+            reachedCount += q.size - np.count_nonzero(reached[q])
+            reached[q] = True
+        if progress is not None:
+            progress(reachedCount, distFlat.shape[0])
+
+    imgLabel[...] = labelsFlat.reshape(shape)
+    imgDist[...] = distFlat.reshape(shape)
+    if stats is not None:
+        setEngineCounters(stats, iterations, pushes, relaxations, reachedCount, frontierHistogram)
+    return imgLabel, imgDist
@@ -0,0 +1,275 @@
+"""
+Tests of the Slicer-free segmentation library on the benchmark phantoms.
+Run by CTest with slicer_add_python_unittest(), or from the RegularizedFastMarching folder with any Python having numpy and scipy:
+    python -m unittest discover -s Testing/Python -p "*Test.py"
+"""
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from RegularizedFastMarchingLib.Segmentation import (segmentVoxels, getMasks, updateSegmentation, updateSegmentationThreshold,
+    predecessorEngines)
+from RegularizedFastMarchingLib.Regularization import regularization
+from RegularizedFastMarchingLib.Benchmark import makePhantom, phantomKinds
+from RegularizedFastMarchingLib.TiledPropagation import propagateTiled
+from RegularizedFastMarchingLib.BucketPropagation import propagateBucket, bucketResolution
+from RegularizedFastMarchingLib.Sweep import sweepSegmentation
+from RegularizedFastMarchingLib.Pyramid import segmentPyramid
+
+# Engines giving the labels of the heap engine. The bucket engine rounds the edges costs, so its labels may differ
+# where the distances of two labels are within its error bound (see propagateBucket()).
+# The label correcting engines can keep another label near the masks borders (see propagateVectorized()).
+# The wavefront engine is the reference iterative propagation, whose labels are not the fast marching ones
+exactEngines = ["compiled", "parallel", "tiled"]
+
+# Smallest fraction of the voxels labelled like the heap engine by the bucket engine
+bucketAgreement = 0.99
+
+# Smallest fraction of the voxels of the 32 voxels phantoms labelled like the heap engine by the vectorized
+# and sweeping engines
+vectorizedAgreement = 0.99
+
+# Smallest fraction of the voxels labelled like the wavefront engine by the other engines, see propagateVectorized()
+wavefrontAgreement = 0.85
+
+# Smallest fraction of the voxels labelled like the full resolution segmentation by the coarse to fine segmentation
+# with a factor 4 and a band of 2 coarse voxels, see segmentPyramid()
+pyramidAgreement = 0.9
+
+gamma = 0.025
+regularizationDiameter = 4
+spacing = (1.0, 1.2, 0.8)
+
+
+def getPhantomParameters(kind, size, nbLabel):
+    """
+    Return the voxels, seeds, regularization map, mask margin, distance and threshold used by the benchmark on a phantom
+    """
+    voxels, seeds = makePhantom(kind, size, nbLabel)
+    R = regularization(voxels, int(regularizationDiameter / 2))
+    marginMask = int(size / (nbLabel - 1)) + 2
+    distance = float(np.iinfo(np.int32).max)
+    threshold = [int(voxels.min()), int(voxels.max())]
+    return voxels, seeds, R, marginMask, distance, threshold
+
+
+def segment(voxels, seeds, nbLabel, marginMask, distance, threshold, R, engine="heap", imgPred=None):
+    """
+    Return the labels (background seeds labels merged), the raw labels and the distances of a segmentation from scratch
+    """
+    imgLabelRaw = np.zeros(voxels.shape, dtype=int)
+    imgLabel, imgDist = segmentVoxels(voxels, spacing, [dict(seed) for seed in seeds], nbLabel, marginMask, distance, gamma,
+        regularizationDiameter, threshold, R=R, imgLabel=imgLabelRaw, engine=engine, imgPred=imgPred)
+    return imgLabel, imgLabelRaw, imgDist
+
+
+class EnginesTest(unittest.TestCase):
+    """
+    Labels of each engine compared to the heap engine, with the masks margins of the benchmark
+    """
+
+    def setUp(self):
+        self.size = 24
+
+    def assertAgreement(self, engine, referenceEngine, agreement, size, nbLabels=(3, 5)):
+        """
+        Check that at least the given fraction of the voxels of each phantom get the labels of the reference engine
+        """
+        for kind in phantomKinds:
+            for nbLabel in nbLabels:
+                voxels, seeds, R, marginMask, distance, threshold = getPhantomParameters(kind, size, nbLabel)
+                reference, _, _ = segment(voxels, seeds, nbLabel, marginMask, distance, threshold, R, referenceEngine)
+                with self.subTest(kind=kind, nbLabel=nbLabel, engine=engine, referenceEngine=referenceEngine):
+                    imgLabel, _, _ = segment(voxels, seeds, nbLabel, marginMask, distance, threshold, R, engine)
+                    self.assertGreaterEqual(np.mean(imgLabel == reference), agreement)
+
+    def test_exactEngines(self):
+        for kind in phantomKinds:
+            for nbLabel in (3, 5):
+                voxels, seeds, R, marginMask, distance, threshold = getPhantomParameters(kind, self.size, nbLabel)
+                reference, _, _ = segment(voxels, seeds, nbLabel, marginMask, distance, threshold, R)
+                for engine in exactEngines:
+                    with self.subTest(kind=kind, nbLabel=nbLabel, engine=engine):
+                        imgLabel, _, _ = segment(voxels, seeds, nbLabel, marginMask, distance, threshold, R, engine)
+                        np.testing.assert_array_equal(imgLabel, reference)
+
+    def test_bucketEngine(self):
+        self.assertAgreement("bucket", "heap", bucketAgreement, self.size)
+
+        # The frontier keys are rounded down, the float distances still never exceed the distance cutoff
+        voxels, seeds, R, marginMask, _, threshold = getPhantomParameters("spheres", self.size, 3)
+        distance = 50
+        masks = getMasks(voxels, seeds, 3, marginMask)
+        for resolution in (bucketResolution, 10.0):
+            with self.subTest(resolution=resolution):
+                imgLabel = np.zeros(voxels.shape, dtype=int)
+                imgDist = np.full(voxels.shape, distance, dtype=float)
+                frontier = [seed["pos"] for seed in seeds]
+                for seed in seeds:
+                    imgLabel[tuple(seed["pos"])] = seed["label"]
+                    imgDist[tuple(seed["pos"])] = 0.99 * resolution
+                propagateBucket(voxels, R, masks, frontier, imgLabel, imgDist, gamma, threshold, spacing, resolution=resolution)
+                self.assertGreater(np.count_nonzero(imgLabel), len(seeds))
+                self.assertTrue(np.all(imgDist[imgLabel > 0] < distance))
+
+    def test_vectorizedEngine(self):
+        self.assertAgreement("vectorized", "heap", vectorizedAgreement, 32)
+        self.assertAgreement("vectorized", "wavefront", wavefrontAgreement, self.size, (5,))
+
+    def test_wavefrontEngine(self):
+        self.assertAgreement("wavefront", "heap", wavefrontAgreement, self.size, (3,))
+        voxels, seeds, R, marginMask, distance, threshold = getPhantomParameters("bridges", self.size, 5)
+        stats = {}
+        imgLabel, _ = segmentVoxels(voxels, spacing, seeds, 5, marginMask, distance, gamma, regularizationDiameter, threshold, R=R,
+            engine="wavefront", stats=stats)
+        self.assertEqual(stats["reached"], np.count_nonzero(imgLabel) - len(seeds))
+        self.assertGreater(stats["iterations"], 1)
+
+    def test_sweepingEngine(self):
+        self.assertAgreement("sweeping", "heap", vectorizedAgreement, 32)
+        self.assertAgreement("sweeping", "wavefront", wavefrontAgreement, self.size, (5,))
+
+    def test_tiles(self):
+        # Tiles smaller than the phantom, so the propagation crosses the tiles borders
+        voxels, seeds, R, _, distance, threshold = getPhantomParameters("bridges", self.size, 5)
+        reference, _, referenceDist = segment(voxels, seeds, 5, self.size, distance, threshold, R)
+        masks = getMasks(voxels, seeds, 5, self.size)
+        imgLabel = np.zeros(voxels.shape, dtype=int)
+        imgDist = np.full(voxels.shape, distance)
+        for seed in seeds:
+            imgLabel[tuple(seed.get("pos"))] = seed.get("label")
+            imgDist[tuple(seed.get("pos"))] = 0
+        stats = {}
+        propagateTiled(voxels, R, masks, [seed.get("pos") for seed in seeds], imgLabel, imgDist, gamma, threshold, spacing, stats,
+            tileShape=(8, 8, 8))
+        self.assertGreater(stats["tileRuns"], 1)
+        np.testing.assert_array_equal(np.clip(imgLabel, 0, 5), reference)
+        np.testing.assert_allclose(imgDist, referenceDist)
+
+
+class IncrementalTest(unittest.TestCase):
+    """
+    Segmentations updated after the seeds or the thresholds changed compared to the segmentations from scratch
+    """
+
+    def setUp(self):
+        self.nbLabel = 5
+        self.voxels, self.seeds, self.R, self.marginMask, self.distance, self.threshold = getPhantomParameters("bridges", 24, self.nbLabel)
+
+    def assertUpdated(self, engine, imgLabel, imgDist, reference, referenceDist):
+        """
+        The bucket engine starts the update from the rounded distances of the previous segmentation, so its labels
+        may differ from the ones from scratch where the distances of two labels are within its error bound
+        """
+        if engine == "bucket":
+            self.assertGreaterEqual(np.mean(imgLabel == reference), bucketAgreement)
+        else:
+            np.testing.assert_array_equal(imgLabel, reference)
+            np.testing.assert_allclose(imgDist, referenceDist)
+
+    def getChangedSeeds(self):
+        """
+        Return the seeds moved, added and removed since self.seeds.
+        The moved seed changes the mask of its label, the added seed is out of the region of its label
+        """
+        moved = [dict(seed) for seed in self.seeds]
+        moved[1]["pos"] = [p + 2 for p in moved[1]["pos"]]
+        added = self.seeds + [{"id": len(self.seeds) + 1, "label": 3, "pos": [6, 12, 14]}]
+        removed = self.seeds[1:]
+        return (("moved", moved), ("added", added), ("removed", removed))
+
+    def test_updateSegmentation(self):
+        for engine in predecessorEngines:
+            for name, seeds in self.getChangedSeeds():
+                with self.subTest(engine=engine, seeds=name):
+                    imgPred = np.full(self.voxels.shape, -1, dtype=np.int8)
+                    _, imgLabelRaw, imgDist = segment(self.voxels, self.seeds, self.nbLabel, self.marginMask, self.distance,
+                        self.threshold, self.R, engine, imgPred)
+                    imgLabel, imgDist = updateSegmentation(self.voxels, spacing, self.R, [dict(seed) for seed in seeds], self.seeds,
+                        self.nbLabel, self.marginMask, self.distance, gamma, self.threshold, imgLabelRaw, imgDist, engine=engine,
+                        imgPred=imgPred)
+                    reference, _, referenceDist = segment(self.voxels, seeds, self.nbLabel, self.marginMask, self.distance,
+                        self.threshold, self.R, engine)
+                    self.assertUpdated(engine, imgLabel, imgDist, reference, referenceDist)
+
+    def test_updateSegmentationWithoutPredecessors(self):
+        # Without predecessors (the other engines, the memory lean and coarse to fine runs) the seeds are segmented from scratch
+        for engine in ("heap", "compiled", "vectorized", "parallel", "tiled", "sweeping", "wavefront"):
+            for name, seeds in self.getChangedSeeds():
+                with self.subTest(engine=engine, seeds=name):
+                    _, imgLabelRaw, imgDist = segment(self.voxels, self.seeds, self.nbLabel, self.marginMask, self.distance,
+                        self.threshold, self.R, engine)
+                    imgLabel, imgDist = updateSegmentation(self.voxels, spacing, self.R, [dict(seed) for seed in seeds], self.seeds,
+                        self.nbLabel, self.marginMask, self.distance, gamma, self.threshold, imgLabelRaw, imgDist, engine=engine)
+                    reference, _, referenceDist = segment(self.voxels, seeds, self.nbLabel, self.marginMask, self.distance,
+                        self.threshold, self.R, engine)
+                    self.assertUpdated(engine, imgLabel, imgDist, reference, referenceDist)
+
+        # Compact types of the memory lean runs
+        imgLabelRaw = np.zeros(self.voxels.shape, dtype=np.uint8)
+        _, imgDist = segmentVoxels(self.voxels, spacing, [dict(seed) for seed in self.seeds], self.nbLabel, self.marginMask,
+            self.distance, gamma, regularizationDiameter, self.threshold, R=self.R, imgLabel=imgLabelRaw, engine="compiled", compact=True)
+        _, moved = self.getChangedSeeds()[0]
+        imgLabel, _ = updateSegmentation(self.voxels, spacing, self.R, [dict(seed) for seed in moved], self.seeds, self.nbLabel,
+            self.marginMask, self.distance, gamma, self.threshold, imgLabelRaw, imgDist, engine="compiled")
+        reference, _, _ = segment(self.voxels, moved, self.nbLabel, self.marginMask, self.distance, self.threshold, self.R, "compiled")
+        np.testing.assert_array_equal(imgLabel, reference)
+
+    def test_updateSegmentationThreshold(self):
+        low, high = self.threshold
+        thresholds = [([low, high], [30, high]), ([30, high], [low, high]), ([30, 110], [10, 130])]
+        for engine in predecessorEngines:
+            for previousThreshold, threshold in thresholds:
+                with self.subTest(engine=engine, previousThreshold=previousThreshold, threshold=threshold):
+                    imgPred = np.full(self.voxels.shape, -1, dtype=np.int8)
+                    _, imgLabelRaw, imgDist = segment(self.voxels, self.seeds, self.nbLabel, self.marginMask, self.distance,
+                        previousThreshold, self.R, engine, imgPred)
+                    imgLabel, imgDist = updateSegmentationThreshold(self.voxels, spacing, self.R, self.seeds, self.nbLabel,
+                        self.marginMask, self.distance, gamma, threshold, previousThreshold, imgLabelRaw, imgDist, imgPred, engine=engine)
+                    reference, _, referenceDist = segment(self.voxels, self.seeds, self.nbLabel, self.marginMask, self.distance,
+                        threshold, self.R, engine)
+                    self.assertUpdated(engine, imgLabel, imgDist, reference, referenceDist)
+
+
+class SweepTest(unittest.TestCase):
+    """
+    Parameters sweep compared to the segmentations of each variant
+    """
+
+    def test_sweepSegmentation(self):
+        nbLabel = 3
+        voxels, seeds, R, marginMask, _, threshold = getPhantomParameters("spheres", 20, nbLabel)
+        marginMasks = [marginMask, marginMask // 2]
+        distances = [200, 1000]
+        gammas = [gamma, 2 * gamma]
+        thresholds = [threshold, [30, threshold[1]]]
+        labels, parameters = sweepSegmentation(voxels, spacing, seeds, nbLabel, marginMasks, distances, gammas, regularizationDiameter,
+            thresholds, R=R, engine="heap", useProcesses=False)
+        self.assertEqual(len(labels), len(parameters))
+        for variant, variantParameters in zip(labels, parameters):
+            with self.subTest(**variantParameters):
+                imgLabel, _ = segmentVoxels(voxels, spacing, [dict(seed) for seed in seeds], nbLabel, variantParameters["marginMask"],
+                    variantParameters["distance"], variantParameters["gamma"], regularizationDiameter, variantParameters["threshold"], R=R)
+                np.testing.assert_array_equal(variant, imgLabel)
+
+
+class PyramidTest(unittest.TestCase):
+    """
+    Coarse to fine segmentation compared to the full resolution segmentation
+    """
+
+    def test_segmentPyramid(self):
+        for kind in ("spheres", "bridges"):
+            voxels, seeds, R, marginMask, distance, threshold = getPhantomParameters(kind, 32, 5)
+            reference, _, _ = segment(voxels, seeds, 5, marginMask, distance, threshold, R)
+            with self.subTest(kind=kind):
+                imgLabel, _ = segmentPyramid(voxels, spacing, [dict(seed) for seed in seeds], 5, marginMask, distance, gamma,
+                    regularizationDiameter, threshold, R, factor=4, bandWidth=2)
+                self.assertGreaterEqual(np.mean(np.clip(imgLabel, 0, 5) == reference), pyramidAgreement)
+
+
+if __name__ == "__main__":
+    unittest.main()